@@ -14,7 +14,6 @@ from PyQt5.QtCore import pyqtSlot, pyqtSignal, Qt
 from PyQt5.QtWidgets import QApplication, QWidget, QDialog, QFileDialog, QTableWidgetItem
 from PyQt5.QtChart import QChart, QChartView, QLineSeries
 
-import jlink
 import xlink
 import gdbserver
 
@@ -81,6 +80,12 @@ class RTTView(QWidget):
         
         self.gdb = None
 
+        self.rtt_native = False
+
+        self.hss = None     # HSS 采样时每个采样的 struct.Struct
+
+        self.receiver = None    # AGDI Proxy 模式下接收 Keil 转发数据的线程
+
         self.tmrRTT = QtCore.QTimer()
         self.tmrRTT.setInterval(10)
         self.tmrRTT.timeout.connect(self.on_tmrRTT_timeout)
@@ -104,6 +109,8 @@ class RTTView(QWidget):
             self.conf.set('link', 'address', '["0x20000000"]')
             self.conf.set('link', 'variable', '{}')
             self.conf.set('link', 'gdbserver', '2331')
+            self.conf.set('link', 'rttapi', 'native')   # native: 探针支持时由探针自身轮询 RTT (J-Link RTTERMINAL)；manual: 读写 RingBuffer
+            self.conf.set('link', 'hssperiod', '100')   # 探针支持 HSS 时变量的采样周期，单位 us
 
         self.cmbMode.setCurrentIndex(zero_if(self.cmbMode.findText(self.conf.get('link', 'mode'))))
         self.cmbSpeed.setCurrentIndex(zero_if(self.cmbSpeed.findText(self.conf.get('link', 'speed'))))
@@ -198,15 +205,13 @@ class RTTView(QWidget):
                 item_data = self.cmbDLL.currentData()
 
                 if item_data == 'jlink':
-                    self.xlk = xlink.XLink(jlink.JLink(self.cmbDLL.currentText(), mode, core, speed))
+                    self.xlk = xlink.XLink(xlink.get_backend('jlink')(self.cmbDLL.currentText(), mode, core, speed))
                 
                 elif item_data == 'openocd':
-                    import openocd
-                    self.xlk = xlink.XLink(openocd.OpenOCD(mode=mode, core=core, speed=speed))
+                    self.xlk = xlink.XLink(xlink.get_backend('openocd')(mode=mode, core=core, speed=speed))
                 
                 elif item_data == 'keil':
-                    import keil
-                    self.xlk = xlink.XLink(keil.Keil())
+                    self.xlk = xlink.XLink(xlink.get_backend('keil')())
                     self.xlk.open(mode, core, speed)
                     self.txtMain.append(f'\n[Keil uVision COM] 连接成功。\n')
 
@@ -214,7 +219,7 @@ class RTTView(QWidget):
                     import agdi_receiver
                     self.receiver = agdi_receiver.AGDIReceiver()
                     self.receiver.start()
-                    self.xlk = xlink.XLink(agdi_receiver.AGDILink(self.receiver))
+                    self.xlk = xlink.XLink(xlink.get_backend('agdi')(self.receiver))
                     self.txtMain.append(f'\n[AGDI Proxy] 监听已启动 (Port 9999)。请确保 Keil 已加载 Proxy DLL。\n')
 
                 elif str(item_data).startswith('shared_'):
@@ -279,8 +284,13 @@ class RTTView(QWidget):
                     self.xlk = xlink.XLink(cortex_m.CortexM(None, _ap))
                 
                 if hasattr(self, 'xlk') and self.xlk:
+                    self.xlk.set_priority(self.xlk.PRIO_RTT)    # RTT and variable polling run in this (GUI) thread
+
                     port = int(self.conf.get('link', 'gdbserver', fallback='2331'))
-                    self.gdb = gdbserver.GDBServer(self.xlk, port)
+                    host = self.conf.get('link', 'gdbhost', fallback='localhost')
+                    rate = int(self.conf.get('link', 'gdbrate', fallback='0'))     # 每个 GDB 客户端的内存访问限速，字节/秒，0 不限速
+                    elfpath = self.cmbAddr.currentText() if os.path.isfile(self.cmbAddr.currentText()) else None
+                    self.gdb = gdbserver.GDBServer(self.xlk, port, elfpath, host, rate)
                     self.gdb.start()
 
                 if self.chkSave.isChecked():
@@ -300,7 +310,7 @@ class RTTView(QWidget):
 
                             data = self.xlk.read_mem_U8(self.RTTAddr, ctypes.sizeof(SEGGER_RTT_CB))
 
-                            rtt_cb = SEGGER_RTT_CB.from_buffer(bytearray(data))
+                            rtt_cb = SEGGER_RTT_CB.from_buffer_copy(data)
                             self.aUpAddr = self.RTTAddr + 16 + 4 + 4
                             self.aDownAddr = self.aUpAddr + ctypes.sizeof(RingBuffer) * rtt_cb.MaxNumUpBuffers
 
@@ -312,9 +322,15 @@ class RTTView(QWidget):
 
                     self.rtt_cb = True
 
+                    if self.xlk.caps & xlink.Backend.NATIVE_RTT and self.conf.get('link', 'rttapi', fallback='native') == 'native':
+                        self.rtt_native = self.rtt_native_start()
+
                 else:
                     self.rtt_cb = False
 
+                    if self.xlk.caps & xlink.Backend.HSS:
+                        self.hss = self.hss_start()
+
             except Exception as e:
                 self.txtMain.append(f'\nerror: {str(e)}\n')
                 if 'daplink' in locals():
@@ -339,6 +355,26 @@ class RTTView(QWidget):
                 self.gdb.stop()
                 self.gdb = None
 
+            if self.rtt_native:
+                self.rtt_native = False
+                try:
+                    self.xlk.rtt_stop()
+                except:
+                    pass
+
+            if self.hss:
+                self.hss = None
+                try:
+                    self.xlk.hss_stop()
+                except:
+                    pass
+
+            if self.receiver:
+                st = self.receiver.stats()
+                self.txtMain.append(f'\n[AGDI Proxy] 收到 {st["frames"]} 帧 {st["bytes"]} 字节，丢失 {st["drops"]} 帧，连接 {st["connects"]} 次；'
+                                    f'读取命中 {st["hits"]} 次，未命中 {st["misses"]} 次，过期 {st["stale"]} 次\n')
+                self.receiver = None
+
             try:
                 self.xlk.close()
             except:
@@ -364,32 +400,119 @@ class RTTView(QWidget):
             if probe and hasattr(probe, '_invalidate_cached_registers'):
                 probe._invalidate_cached_registers()
 
-    def aUpRead(self):
-        if isinstance(self.xlk, RawTCPLink):
-            return self.xlk.recv()
+    def rtt_native_start(self):
+        ''' 由探针自身轮询 RTT，失败返回 False，使用手动读写 RingBuffer 的方式 '''
+        try:
+            self.xlk.rtt_start(self.RTTAddr)
 
-        # 针对 DAP-Link 共享模式，每次读写前强制失效 SELECT 寄存器缓存，防止与 Keil 冲突
-        self.xlk_invalidate_cache()
+            start = time.time()
+            while self.xlk.rtt_get_num_buffers(0) < 0:  # < 0: 探针仍在查找控制块
+                if time.time() - start > 1.0:
+                    raise Exception('control block not found')
+                time.sleep(0.01)
 
-        data = self.xlk.read_mem_U8(self.aUpAddr, ctypes.sizeof(RingBuffer))
+            aUp, aDown = self.xlk.rtt_get_buffers(0), self.xlk.rtt_get_buffers(1)
 
-        aUp = RingBuffer.from_buffer(bytearray(data))
-        
-        if aUp.RdOff <= aUp.WrOff:
-            cnt = aUp.WrOff - aUp.RdOff
+        except Exception as e:
+            self.txtMain.append(f'\nRTT API 不可用，使用手动模式: {e}\n')
+            try:
+                self.xlk.rtt_stop()
+            except:
+                pass
+            return False
 
-        else:
-            cnt = aUp.SizeOfBuffer - aUp.RdOff
+        self.txtMain.append(f'\nRTT API: aUp {[f"{name}({size})" for name, size in aUp]}, aDown {[f"{name}({size})" for name, size in aDown]}\n')
+        return True
 
-        if 0 < cnt < 1024*1024:
-            data = self.xlk.read_mem_U8(ctypes.cast(aUp.pBuffer, ctypes.c_void_p).value + aUp.RdOff, cnt)
-            
-            aUp.RdOff = (aUp.RdOff + cnt) % aUp.SizeOfBuffer
+    def hss_start(self):
+        ''' 由探针以固定周期采样变量，返回每个采样的 struct.Struct，失败返回 None，使用轮询读取 '''
+        shown = [val for val in self.Vals.values() if val.show]
+        if not shown:
+            return None
+
+        period = int(self.conf.get('link', 'hssperiod', fallback='100'))
+        try:
+            max_blocks, max_freq = self.xlk.hss_get_caps()
+            if len(shown) > max_blocks:
+                raise Exception(f'too many variables, support {max_blocks} at most')
+            if max_freq:
+                period = max(period, (1000000 + max_freq - 1) // max_freq)
+
+            self.xlk.hss_start([(val.addr, val.size) for val in shown], period)
+
+        except Exception as e:
+            self.txtMain.append(f'\nHSS 不可用，使用轮询读取: {e}\n')
+            return None
+
+        self.hss_buff = b''
+        self.txtMain.append(f'\nHSS: {len(shown)} 个变量，采样周期 {period} us\n')
+        return struct.Struct('<' + ''.join(val.fmt for val in shown))
+
+    def hss_restart(self):
+        ''' 显示的变量改变后，按新的变量列表重新开始采样，免得新采样按旧的格式解析 '''
+        if self.hss:
+            self.hss = None
+            try:
+                self.xlk.hss_stop()
+            except:
+                pass
+
+        self.hss = self.hss_start()
+
+    def hss_read(self):
+        ''' 返回 HSS 采样数据，每个采样一行；失败返回 None，并切换到轮询读取 '''
+        try:
+            self.hss_buff += self.xlk.hss_read(0x10000)
+        except Exception as e:
+            self.hss = None
+            self.txtMain.append(f'\nHSS 读取失败，切换到轮询读取: {e}\n')
+            try:
+                self.xlk.hss_stop()
+            except:
+                pass
+            return None
+
+        n = len(self.hss_buff) // self.hss.size * self.hss.size     # 只处理完整的采样
+        rcvdbytes = b''.join(b'\t'.join(f'{val}'.encode() for val in vals) + b',\n' for vals in self.hss.iter_unpack(self.hss_buff[:n]))
+        self.hss_buff = self.hss_buff[n:]
+
+        return rcvdbytes
+
+    def aUpRead(self):
+        if self.rtt_native:
+            try:
+                return bytes(self.xlk.rtt_read(0, 0x4000))
+            except Exception as e:
+                self.rtt_native = False     # 回退到手动模式，探针已更新 RdOff，可以直接接着读
+                self.txtMain.append(f'\nRTT API 读取失败，切换到手动模式: {e}\n')
+                try:
+                    self.xlk.rtt_stop()
+                except:
+                    pass
+
+        with self.xlk.transaction():    # header read, data read and RdOff write must not interleave with GDB accesses
+            # 针对 DAP-Link 共享模式，每次读写前强制失效 SELECT 寄存器缓存，防止与 Keil 冲突
+            self.xlk_invalidate_cache()
+
+            data = self.xlk.read_mem_U8(self.aUpAddr, ctypes.sizeof(RingBuffer))
+
+            aUp = RingBuffer.from_buffer_copy(data)
             
-            self.xlk.write_U32(self.aUpAddr + 4*4, aUp.RdOff)
+            if aUp.RdOff <= aUp.WrOff:
+                cnt = aUp.WrOff - aUp.RdOff
 
-        else:
-            data = []
+            else:
+                cnt = aUp.SizeOfBuffer - aUp.RdOff
+
+            if 0 < cnt < 1024*1024:
+                data = self.xlk.read_mem_U8(ctypes.cast(aUp.pBuffer, ctypes.c_void_p).value + aUp.RdOff, cnt)
+                
+                aUp.RdOff = (aUp.RdOff + cnt) % aUp.SizeOfBuffer
+                
+                self.xlk.write_U32(self.aUpAddr + 4*4, aUp.RdOff)
+
+            else:
+                data = b''
         
         # 共享模式礼让
         if '[Shared]' in self.cmbDLL.currentText():
@@ -398,12 +521,20 @@ class RTTView(QWidget):
         return bytes(data)
 
     def aDownWrite(self, bytes):
+        if self.rtt_native:
+            self.xlk.rtt_write(0, bytes)
+            return
+
+        with self.xlk.transaction():
+            self._aDownWrite(bytes)
+
+    def _aDownWrite(self, bytes):
         # 针对 DAP-Link 共享模式，写操作前同样需要失效 SELECT 缓存
         self.xlk_invalidate_cache()
 
         data = self.xlk.read_mem_U8(self.aDownAddr, ctypes.sizeof(RingBuffer))
 
-        aDown = RingBuffer.from_buffer(bytearray(data))
+        aDown = RingBuffer.from_buffer_copy(data)
         
         if aDown.WrOff >= aDown.RdOff:
             if aDown.RdOff != 0: cnt = min(aDown.SizeOfBuffer - aDown.WrOff, len(bytes))
@@ -436,17 +567,23 @@ class RTTView(QWidget):
                     rcvdbytes = self.aUpRead()
 
                 else:
-                    vals = []
-                    for name, addr, size, typ, fmt, show in self.Vals.values():
-                        if show:
+                    rcvdbytes = self.hss_read() if self.hss else None
+
+                    if rcvdbytes is None:
+                        shown = [val for val in self.Vals.values() if val.show]
+
+                        # 所有变量批量读取；共享模式下分块读取，块间礼让，免得长时间独占调试器
+                        chunk = 8 if is_shared else max(len(shown), 1)
+                        vals = []
+                        for i in range(0, len(shown), chunk):
+                            if i: time.sleep(0.002) # 变量读取间隙
                             self.xlk_invalidate_cache()
-                            buf = self.xlk.read_mem_U8(addr, size)
-                            vals.append(struct.unpack(fmt, bytes(buf))[0])
-                            if is_shared: time.sleep(0.002) # 变量读取间隙
-                    
-                    if is_shared: time.sleep(0.005) # 完成一轮读取后的礼让
+                            bufs = self.xlk.read_many([(val.addr, val.size) for val in shown[i:i+chunk]])
+                            vals.extend(struct.unpack(val.fmt, buf)[0] for val, buf in zip(shown[i:i+chunk], bufs))
+                        
+                        if is_shared: time.sleep(0.005) # 完成一轮读取后的礼让
 
-                    rcvdbytes = b'\t'.join(f'{val}'.encode() for val in vals) + b',\n'
+                        rcvdbytes = b'\t'.join(f'{val}'.encode() for val in vals) + b',\n'
             
             except Exception as e:
                 rcvdbytes = b''
@@ -754,7 +891,7 @@ class RTTView(QWidget):
 
     @pyqtSlot(int, int)
     def on_tblVar_cellDoubleClicked(self, row, column):
-        if self.btnOpen.text() == '关闭连接': return
+        if self.btnOpen.text() == '关闭连接' and column != 3: return    # 连接时只能切换显示
 
         if column < 3:
             dlg = VarDialog(self, row)
@@ -777,6 +914,9 @@ class RTTView(QWidget):
 
                 self.PlotCurve[row].setVisible(self.Vals[row].show)
 
+                if self.btnOpen.text() == '关闭连接' and not self.rtt_cb and self.xlk.caps & xlink.Backend.HSS:
+                    self.hss_restart()
+
         elif column == 4:
             if self.tblVar.item(row, 4):
                 self.Vals.pop(row)
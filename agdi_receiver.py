@@ -1,14 +1,108 @@
+import time
 import socket
 import struct
 import threading
+import collections
+
+import xlink
+
+class MemoryShadow(object):
+    ''' sparse copy of target memory, built from the reads Keil forwards
+
+    Memory is kept in PAGE-sized bytearrays in a dict keyed by page number, so a lookup costs one
+    dict access per page touched no matter how much has been recorded. Each page has a byte mask of
+    which bytes have been seen and the time of its last update; the least recently used pages are
+    dropped beyond max_pages. Reads are counted as hits, misses (never seen) and stale (too old).
+    '''
+    PAGE = 256
+
+    def __init__(self, max_pages=4096):
+        self.max_pages = max_pages
+        self.pages = collections.OrderedDict()  # {page number: [data, valid mask, timestamp]}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def write(self, addr, data):
+        ''' merge data into the pages it covers, newer bytes replace older ones '''
+        data = memoryview(data)
+        now = time.time()
+        with self.lock:
+            while data:
+                pageno, offset = divmod(addr, self.PAGE)
+                n = min(self.PAGE - offset, len(data))
+
+                page = self.pages.get(pageno)
+                if page is None:
+                    page = self.pages[pageno] = [bytearray(self.PAGE), bytearray(self.PAGE), now]
+                else:
+                    self.pages.move_to_end(pageno)
+                    page[2] = now
+
+                page[0][offset:offset+n] = data[:n]
+                page[1][offset:offset+n] = b'\x01' * n
+
+                addr += n
+                data = data[n:]
+
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+
+    def read(self, addr, size, max_age=None):
+        ''' return bytes of [addr, addr + size), None if part of it has not been seen or is older than max_age seconds '''
+        chunks = []
+        oldest = time.time() - max_age if max_age is not None else 0
+        with self.lock:
+            while size > 0:
+                pageno, offset = divmod(addr, self.PAGE)
+                n = min(self.PAGE - offset, size)
+
+                page = self.pages.get(pageno)
+                if page is None or page[1].find(0, offset, offset+n) >= 0:
+                    self.misses += 1
+                    return None
+                if page[2] < oldest:
+                    self.stale += 1
+                    return None
+                self.pages.move_to_end(pageno)
+
+                chunks.append(page[0][offset:offset+n])
+                addr += n
+                size -= n
+
+            self.hits += 1
+
+        return b''.join(chunks)
+
+    def age(self, addr):
+        ''' seconds since the page holding addr was last updated, None if it has never been seen '''
+        page = self.pages.get(addr // self.PAGE)
+        return time.time() - page[2] if page else None
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+
 
 class AGDIReceiver(threading.Thread):
+    ''' receives the memory reads forwarded by the Keil proxy DLL, each frame is <addr:u32> <size:u32> <data> '''
+    RXSIZE = 1 << 20    # receive buffer, also the largest frame accepted
+
     def __init__(self, port=9999):
         super().__init__()
         self.port = port
         self.daemon = True
         self.running = False
-        self.mem_cache = {} # {addr: data}
+        self.conn = None
+        self.shadow = MemoryShadow()
+
+        self.frames = 0     # frames received
+        self.bytes = 0      # payload bytes received
+        self.drops = 0      # frames lost to disconnects or corrupt headers
+        self.connects = 0
+        self.last_stats = (time.time(), 0, 0)
 
     def run(self):
         self.running = True
@@ -16,45 +110,101 @@ class AGDIReceiver(threading.Thread):
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server.bind(('127.0.0.1', self.port))
         server.listen(1)
-        
-        while self.running:
+        server.settimeout(1.0)
+
+        while self.running:     # accept again whenever Keil disconnects, e.g. on restart
+            try:
+                conn, addr = server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            self.conn = conn
+            self.connects += 1
             try:
-                server.settimeout(1.0)
-                try:
-                    conn, addr = server.accept()
-                except socket.timeout:
-                    continue
-                
-                while self.running:
-                    header = conn.recv(8)
-                    if not header: break
-                    
-                    addr, size = struct.unpack('<II', header)
-                    data = b''
-                    while len(data) < size:
-                        chunk = conn.recv(size - len(data))
-                        if not chunk: break
-                        data += chunk
-                    
-                    if data:
-                        # 粒度可以是按页或者按块缓存
-                        self.mem_cache[addr] = data
+                conn.settimeout(1.0)
+                self._receive(conn)
+            except OSError:
+                pass
+            finally:
+                self.conn = None
                 conn.close()
-            except Exception as e:
+
+        server.close()
+
+    def _receive(self, conn):
+        buff = bytearray(self.RXSIZE)
+        view = memoryview(buff)
+        head = tail = 0     # frames are parsed from head, recv_into fills from tail
+
+        while self.running:
+            try:
+                n = conn.recv_into(view[tail:])
+            except socket.timeout:
+                continue
+            if not n:
+                if tail > head: self.drops += 1     # partial frame
+                return
+            tail += n
+
+            while tail - head >= 8:
+                addr, size = struct.unpack_from('<II', buff, head)
+                if size > self.RXSIZE - 8:      # the stream has no sync marker, so resync by reconnecting
+                    self.drops += 1
+                    return
+                if tail - head < 8 + size:
+                    break
+
+                self.shadow.write(addr, view[head+8:head+8+size])
+                head += 8 + size
+                self.frames += 1
+                self.bytes += size
+
+            # move the partial frame to the front, so there is always room for the rest of it
+            if head == tail:
+                head = tail = 0
+            elif tail == self.RXSIZE or head > self.RXSIZE // 2:
+                view[:tail-head] = view[head:tail]
+                head, tail = 0, tail - head
+
+    def stats(self):
+        ''' return frames/s and bytes/s since the previous call, and the running totals, shadow reads included '''
+        now = time.time()
+        last, frames, bytes = self.last_stats
+        self.last_stats = (now, self.frames, self.bytes)
+
+        dt = max(now - last, 1e-6)
+        return {'frames/s': (self.frames - frames) / dt, 'bytes/s': (self.bytes - bytes) / dt,
+                'frames': self.frames, 'bytes': self.bytes, 'drops': self.drops, 'connects': self.connects,
+                'hits': self.shadow.hits, 'misses': self.shadow.misses, 'stale': self.shadow.stale}
+
+    def stop(self):
+        self.running = False
+
+        conn = self.conn
+        if conn:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
                 pass
-                
-    def read_mem(self, addr, size):
-        # 从缓存中查找最接近的匹配
-        # 这只是个示意实现
-        for start_addr, data in self.mem_cache.items():
-            if start_addr <= addr and addr + size <= start_addr + len(data):
-                offset = addr - start_addr
-                return data[offset:offset+size]
-        return None
-
-class AGDILink:
-    def __init__(self, receiver):
+
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(2)
+
+    def read_mem(self, addr, size, max_age=None):
+        return self.shadow.read(addr, size, max_age)
+
+class AGDILink(xlink.Backend):
+    # reads are served from the memory Keil has already fetched, so they never stop the core
+    caps = xlink.Backend.BLOCK_READ | xlink.Backend.NON_HALTING
+
+    # memory Keil has not re-read for this many seconds no longer reflects the target, and reads as zeros like unseen memory
+    MAX_AGE = 2.0
+
+    def __init__(self, receiver, max_age=MAX_AGE):
         self.receiver = receiver
+        self.max_age = max_age
         self.mode = 'arm'
         self.core_regs = {}
 
@@ -65,10 +215,10 @@ class AGDILink:
         self.receiver.stop()
 
     def read_mem_U8(self, addr, count):
-        data = self.receiver.read_mem(addr, count)
+        data = self.receiver.read_mem(addr, count, self.max_age)
         if data:
-            return list(data)
-        return [0] * count
+            return data
+        return bytes(count)
 
     def write_mem_U8(self, addr, data):
         # AGDI Proxy 模式通常是只读被动监听，若要写需要额外实现控制逻辑
@@ -76,7 +226,7 @@ class AGDILink:
 
     def read_U32(self, addr):
         data = self.read_mem_U8(addr, 4)
-        return struct.unpack('<I', bytes(data))[0]
+        return struct.unpack('<I', data)[0]
 
     def write_U32(self, addr, val):
         pass
@@ -86,6 +236,4 @@ class AGDILink:
 
     def halted(self):
         return False
-                
-    def stop(self):
-        self.running = False
+
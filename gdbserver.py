@@ -2,74 +2,466 @@
 GDB Server Remote Serial Protocol Bridge for RTTView.
 Allows Ozone or other GDB clients to connect to the target via RTTView's connection.
 '''
-import socket
+import io
+import os
+import time
+import asyncio
 import threading
+import concurrent.futures
 import re
 import struct
 import logging
+from xml.etree.ElementTree import Element, SubElement, tostring
+
+from pyocd.debug.context import DebugContext
+
+import xlink
 
 LOG = logging.getLogger(__name__)
 
-class GDBServer(threading.Thread):
-    def __init__(self, xlk, port=2331):
-        super().__init__()
-        self.xlk = xlk
-        self.port = port
-        self.daemon = True
-        self.running = False
-        self.sock = None
-        self._regs = ['r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7', 'r8', 'r9', 'r10', 'r11', 'r12', 'sp', 'lr', 'pc', 'xpsr']
+
+class XLinkContext(DebugContext):
+    ''' pyOCD DebugContext on top of an XLink, so pyOCD contexts can be layered over any backend. '''
+    def read_memory(self, addr, transfer_size=32, now=True):
+        if transfer_size == 8:
+            val = self._core.read_mem_U8(addr, 1)[0]
+        elif transfer_size == 16:
+            val = self._core.read_mem_U16(addr, 1)[0]
+        else:
+            val = self._core.read_U32(addr)
+
+        return val if now else (lambda: val)
+
+    def read_memory_block8(self, addr, size):
+        return self._core.read_mem_U8(addr, size)
+
+    def read_memory_block32(self, addr, size):
+        return self._core.read_mem_U32(addr, size)
+
+    def write_memory(self, addr, value, transfer_size=32):
+        if transfer_size == 8:
+            self._core.write_U8(addr, value)
+        elif transfer_size == 16:
+            self._core.write_U16(addr, value)
+        else:
+            self._core.write_U32(addr, value)
+
+    def write_memory_block8(self, addr, data):
+        self._core.write_mem_U8(addr, data)
+
+    def write_memory_block32(self, addr, data):
+        self._core.write_mem_U32(addr, data)
+
+
+class RSPParser(object):
+    ''' GDB Remote Serial Protocol framing: splits received bytes into packets, acks and interrupts
+
+    Bytes are received straight into a buffer (RSPProtocol's get_buffer() returns space(), then
+    buffer_updated(n) calls filled(n)) and packets are cut out of it without per-byte copies;
+    checksums are validated and escapes/run-length encoding undone. feed() copies bytes in instead.
+    '''
+    def __init__(self, size=0x10000):
+        self.buff = bytearray(size)
+        self.view = memoryview(self.buff)
+        self.head = self.tail = 0   # parse from head, receive to tail
+
+    def space(self):
+        ''' return the free part of the buffer to receive into '''
+        if self.head:
+            self.view[:self.tail-self.head] = self.view[self.head:self.tail]
+            self.head, self.tail = 0, self.tail - self.head
+
+        if self.tail == len(self.buff):     # packet larger than the buffer
+            self.buff = self.buff + bytearray(len(self.buff))
+            self.view = memoryview(self.buff)
+
+        return self.view[self.tail:]
+
+    def filled(self, n):
+        self.tail += n
+
+    def feed(self, data):
+        data = memoryview(data)
+        index = 0
+        while index < len(data):
+            space = self.space()
+            n = min(len(space), len(data) - index)
+            space[:n] = data[index:index+n]
+            self.filled(n)
+            index += n
+
+    def events(self):
+        ''' yield (kind, payload): ('packet', bytes), ('bad', None) on checksum error, ('interrupt', None) or ('nak', None) '''
+        while self.head < self.tail:
+            c = self.buff[self.head]
+            if c == 0x24:       # '$'
+                end = self.buff.find(b'#', self.head + 1, self.tail)
+                if end < 0 or end + 3 > self.tail:
+                    return      # wait for the rest of the packet
+
+                payload = self.view[self.head+1:end]
+                try:
+                    checksum = int(self.buff[end+1:end+3], 16)
+                except ValueError:
+                    checksum = -1
+
+                if sum(payload) & 0xFF != checksum:
+                    self.head = end + 3
+                    yield 'bad', None
+                else:
+                    payload = self._decode(payload)
+                    self.head = end + 3
+                    yield 'packet', payload
+
+            elif c == 0x03:     # Ctrl-C
+                self.head += 1
+                yield 'interrupt', None
+
+            elif c == 0x2D:     # '-': resend the last reply
+                self.head += 1
+                yield 'nak', None
+
+            else:               # '+' and line noise
+                self.head += 1
+
+    @staticmethod
+    def _decode(payload):
+        data = bytes(payload)
+        if b'*' in data:        # run-length encoded: '*' n repeats the previous byte n - 29 times
+            out = bytearray()
+            i = 0
+            while i < len(data):
+                c = data[i]
+                if c == 0x7D:
+                    out.append(data[i+1] ^ 0x20)
+                    i += 2
+                elif c == 0x2A:
+                    out += out[-1:] * (data[i+1] - 29)
+                    i += 2
+                else:
+                    out.append(c)
+                    i += 1
+            return bytes(out)
+
+        if b'}' in data:        # '}' escapes the next byte, xored with 0x20
+            parts = data.split(b'}')
+            return parts[0] + b''.join([bytes([part[0] ^ 0x20]) + part[1:] for part in parts[1:]])
+
+        return data
+
+
+class RSPProtocol(asyncio.BufferedProtocol):
+    ''' one client connection: the event loop receives straight into the parser's buffer
+
+    The server's _serve task waits on received for packets, and on drain() to respect the
+    transport's write flow control. Reading pauses while more than READ_AHEAD bytes wait to be parsed.
+    '''
+    READ_AHEAD = 0x20000
+
+    def __init__(self, server):
+        self.server = server
+        self.parser = RSPParser()
+        self.transport = None
+        self.received = asyncio.Event()
+        self.closed = False
+        self.reading = True
+        self.writable = None    # future waited on by drain() while writing is paused
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.loop.create_task(self.server._serve(self))
+
+    def get_buffer(self, sizehint):
+        return self.parser.space()
+
+    def buffer_updated(self, nbytes):
+        self.parser.filled(nbytes)
+        self.received.set()
+
+        if self.parser.tail - self.parser.head > self.READ_AHEAD:
+            self.transport.pause_reading()
+            self.reading = False
+
+    def resume_reading(self):
+        if not self.reading and not self.closed:
+            self.reading = True
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        self.closed = True
+        self.received.set()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.received.set()
+        self.resume_writing()
+
+    def pause_writing(self):
+        self.writable = self.server.loop.create_future()
+
+    def resume_writing(self):
+        if self.writable and not self.writable.done():
+            self.writable.set_result(None)
+        self.writable = None
+
+    async def drain(self):
+        if self.writable and not self.closed:
+            await self.writable
+
+
+class RateLimiter(object):
+    ''' token bucket: on average at most rate bytes per second, in bursts of up to burst bytes; rate 0 is unlimited '''
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate / 4
+        self.tokens = self.burst
+        self.time = time.monotonic()
+
+    def charge(self, n):
+        ''' take n bytes from the bucket, return how many seconds to wait before the access '''
+        if not self.rate:
+            return 0
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class GDBSession(object):
+    ''' state of one client connection
+
+    process() runs in a worker thread of the server and never touches the socket: replies are
+    collected in out and written by the server's event loop.
+    '''
+    # while the target runs, DHCSR is polled for a halt; the interval starts short after a resume
+    # and backs off to POLL_MAX, so a long run costs the RTT poller only a few probe accesses per second
+    POLL_MIN = 0.01
+    POLL_MAX = 0.2
+
+    def __init__(self, server, rate=0):
+        self.server = server
+        self.xlk = server.xlk
+        self.limiter = RateLimiter(rate)
+
+        self.out = bytearray()  # replies not yet sent
+        self.noack = False      # QStartNoAckMode negotiated
+        self.nonstop = False    # QNonStop:1, stops are reported as %Stop notifications
+        self.target_running = False
+        self.regvals = None     # {name: value} of the current halt, see _read_regs
+        self.stop_signal = 5    # signal of the next stop reply: SIGTRAP, SIGINT after Ctrl-C, 0 after vCont;t
+        self.poll = self.POLL_MIN
+        self.next_poll = 0
+        self.last = b''         # last packet sent, resent on '-'
+
+    def cost(self, packet):
+        ''' bytes of target memory a packet accesses, what the rate limit counts '''
+        m = re.match(rb'[mMX][0-9a-fA-F]+,([0-9a-fA-F]+)', packet)
+        return int(m.group(1), 16) if m else 0
+
+    def process(self, kind, payload):
+        ''' handle one event from RSPParser.events(), kind None only polls the run state '''
+        if kind == 'packet':
+            if not self.noack: self.out += b'+'
+            self._handle_packet(payload.decode('latin-1'))
+
+        elif kind == 'bad':
+            if not self.noack: self.out += b'-'
+
+        elif kind == 'nak':
+            self.out += self.last
+
+        elif kind == 'interrupt':
+            try:
+                self.xlk.halt()
+            except Exception as e:
+                LOG.warning('halt fail: %s', e)
+                if not self.target_running:
+                    self._send_packet('E01')
+                # else _monitor keeps polling, and reports the stop if the core halts after all
+            else:
+                self.regvals = None
+                self.stop_signal = 2    # SIGINT
+                if self.target_running:
+                    self.next_poll = 0  # _monitor reports the stop
+                else:
+                    self._send_packet(self._stop_reply())
+
+        self._monitor()
+
+        out, self.out = bytes(self.out), bytearray()
+        return out
+
+    @staticmethod
+    def _escape(data):
+        ''' escape binary reply data, '}' first so the escapes themselves are not escaped again '''
+        for c in '}#$*':
+            data = data.replace(c, '}' + chr(ord(c) ^ 0x20))
+        return data
 
     def _checksum(self, data):
         return sum(data.encode('latin-1')) % 256
 
-    def _send_packet(self, conn, data):
+    def _send_packet(self, data):
         packet = f'${data}#{self._checksum(data):02x}'.encode('latin-1')
-        conn.sendall(packet)
+        self.last = packet
+        self.out += packet
+
+    def _read_regs(self):
+        ''' return {name: value} of all registers, read with one XLink.read_regs and kept until the core runs '''
+        if self.regvals is None:
+            names = [name for name, bitsize in self.server.regs]
+            try:
+                self.regvals = self.xlk.read_regs(names)
+            except Exception:
+                self.regvals = {}   # some registers can't be read, e.g. no FPU: read one by one
+                for name in names:
+                    try:
+                        self.regvals[name] = self.xlk.read_reg(name)
+                    except Exception:
+                        pass
+
+        return self.regvals
+
+    @staticmethod
+    def _reg_hex(val, bitsize):
+        if val is None:
+            return 'xx' * (bitsize // 8)    # unavailable
+
+        return (val & ((1 << bitsize) - 1)).to_bytes(bitsize // 8, 'little').hex()
+
+    def _send_notification(self, data):
+        self.out += f'%{data}#{self._checksum(data):02x}'.encode('latin-1')
+
+    def _stop_reply(self):
+        return f'T{self.stop_signal:02x}thread:1;'
+
+    def _resumed(self):
+        self.regvals = None
+        self.target_running = True
+        self.stop_signal = 5
+        self.poll = self.POLL_MIN
+        self.next_poll = time.time() + self.poll
+
+    def _monitor(self):
+        ''' poll the run state while the target runs, and report the halt once it happens '''
+        if not self.target_running or time.time() < self.next_poll:
+            return
+
+        try:
+            halted = self.xlk.halted()
+        except Exception as e:
+            LOG.warning('halt poll fail: %s', e)
+            halted = False  # try again at the next poll
+
+        if halted:
+            self.target_running = False
+            self.regvals = None
+            if self.nonstop:
+                self._send_notification('Stop:' + self._stop_reply())
+            else:
+                self._send_packet(self._stop_reply())
+        else:
+            self.poll = min(self.poll * 1.5, self.POLL_MAX)
+            self.next_poll = time.time() + self.poll
 
-    def _handle_packet(self, conn, packet):
+    def _handle_packet(self, packet):
         if packet.startswith('qSupported'):
-            self._send_packet(conn, 'PacketSize=1000;qXfer:features:read+')
-        
-        elif packet == 'qXfer:features:read:target.xml:0,ffb':
-            # Ozone likes to see architecture
-            xml = '<?xml version="1.0"?><!DOCTYPE target SYSTEM "gdb-target.dtd"><target><architecture>arm</architecture></target>'
-            self._send_packet(conn, 'l' + xml)
+            features = f'PacketSize={self.server.PACKET_SIZE:x};qXfer:features:read+;QStartNoAckMode+;QNonStop+'
+            if self.server.memory_map:
+                features += ';qXfer:memory-map:read+'
+            self._send_packet(features)
+
+        elif packet == 'QStartNoAckMode':
+            self._send_packet('OK')
+            self.noack = True
+
+        elif packet.startswith('qXfer:'): # qXfer:OBJECT:read:ANNEX:OFFSET,LENGTH
+            m = re.match(r'qXfer:([\w-]+):read:([^:]*):([0-9a-fA-F]+),([0-9a-fA-F]+)', packet)
+            if m and m.group(1) == 'features' and m.group(2) == 'target.xml':
+                doc = self.server.target_xml
+            elif m and m.group(1) == 'memory-map' and self.server.memory_map:
+                doc = self.server.memory_map_xml()
+            else:
+                doc = None
+
+            if doc is None:
+                self._send_packet('')
+            else:
+                offset, length = int(m.group(3), 16), int(m.group(4), 16)
+                chunk = doc[offset:offset+length]
+                self._send_packet(('l' if offset + length >= len(doc) else 'm') + self._escape(chunk))
+
+        elif packet.startswith('QNonStop:'):
+            self.nonstop = packet == 'QNonStop:1'
+            self._send_packet('OK')
+            if self.nonstop:
+                try:
+                    running = not self.xlk.halted()
+                except Exception as e:
+                    LOG.warning('halt poll fail: %s', e)
+                    running = True  # state unknown: monitor it, a halt is then reported once seen
+                if running:
+                    self._resumed()     # a running target is monitored so its halt gets reported
 
         elif packet == '?':
-            self._send_packet(conn, 'S05') # Stop reason: SIGTRAP
+            if self.nonstop and self.target_running:
+                self._send_packet('OK')
+            else:
+                self._send_packet(self._stop_reply())
+
+        elif packet == 'vStopped':
+            self._send_packet('OK')   # single thread, at most one stop is ever pending
+
+        elif packet == 'qfThreadInfo':
+            self._send_packet('m1')
+
+        elif packet == 'qsThreadInfo':
+            self._send_packet('l')
+
+        elif packet == 'qC':
+            self._send_packet('QC1')
+
+        elif packet.startswith('H') or packet.startswith('T'):
+            self._send_packet('OK')
 
         elif packet == 'g':
-            # All registers
-            vals = []
-            for r in self._regs:
-                try:
-                    v = self.xlk.read_reg(r)
-                    vals.append(struct.pack('<I', v).hex())
-                except:
-                    vals.append('00000000')
-            self._send_packet(conn, ''.join(vals))
+            # All registers, read in one batch
+            vals = self._read_regs()
+            self._send_packet(''.join([self._reg_hex(vals.get(name), bitsize) for name, bitsize in self.server.regs]))
 
         elif packet.startswith('p'): # pIDX
             try:
                 idx = int(packet[1:], 16)
-                if idx < len(self._regs):
-                    v = self.xlk.read_reg(self._regs[idx])
-                    self._send_packet(conn, struct.pack('<I', v).hex())
+                if idx < len(self.server.regs):
+                    name, bitsize = self.server.regs[idx]
+                    self._send_packet(self._reg_hex(self._read_regs().get(name), bitsize))
                 else:
-                    self._send_packet(conn, '00000000')
+                    self._send_packet('E01')
+            except:
+                self._send_packet('E01')
+
+        elif packet.startswith('P'): # PIDX=VALUE
+            try:
+                idx, val = packet[1:].split('=')
+                name, bitsize = self.server.regs[int(idx, 16)]
+                self.xlk.write_reg(name, int.from_bytes(bytes.fromhex(val), 'little'))
+                self.regvals = None
+                self._send_packet('OK')
             except:
-                self._send_packet(conn, 'E01')
+                self._send_packet('E01')
 
         elif packet.startswith('m'): # mADDR,LEN
             m = re.match(r'm([0-9a-fA-F]+),([0-9a-fA-F]+)', packet)
             if m:
                 addr, length = int(m.group(1), 16), int(m.group(2), 16)
                 try:
-                    data = self.xlk.read_mem_U8(addr, length)
-                    self._send_packet(conn, bytes(data).hex())
+                    data = self.server.mem.read_memory_block8(addr, length)
+                    self._send_packet(data.hex())
                 except:
-                    self._send_packet(conn, 'E01')
+                    self._send_packet('E01')
 
         elif packet.startswith('M'): # MADDR,LEN:DATA
             m = re.match(r'M([0-9a-fA-F]+),([0-9a-fA-F]+):(.*)', packet)
@@ -77,89 +469,282 @@ class GDBServer(threading.Thread):
                 addr, length = int(m.group(1), 16), int(m.group(2), 16)
                 data = bytes.fromhex(m.group(3))
                 try:
-                    self.xlk.write_mem_U8(addr, list(data))
-                    self._send_packet(conn, 'OK')
+                    self.xlk.write_mem_U8(addr, data)
+                    self._send_packet('OK')
+                except:
+                    self._send_packet('E01')
+
+        elif packet.startswith('X'): # XADDR,LEN:BINARY
+            m = re.match(r'X([0-9a-fA-F]+),([0-9a-fA-F]+):', packet)
+            if m:
+                addr, length = int(m.group(1), 16), int(m.group(2), 16)
+                data = packet[m.end():].encode('latin-1')
+                try:
+                    if length:  # X with no data probes for X support
+                        self.xlk.write_mem_U8(addr, data[:length])
+                    self._send_packet('OK')
                 except:
-                    self._send_packet(conn, 'E01')
+                    self._send_packet('E01')
+
+        elif packet[:1] in ('Z', 'z'): # ZTYPE,ADDR,KIND  0: sw, 1: hw breakpoint, 2: write, 3: read, 4: access watchpoint
+            m = re.match(r'([Zz])([0-4]),([0-9a-fA-F]+),([0-9a-fA-F]+)', packet)
+            if not m or not self.xlk.caps & xlink.Backend.HW_BREAK:
+                self._send_packet('')   # unsupported, the client falls back to its own breakpoints
+                return
+
+            insert, type, addr, kind = m.group(1) == 'Z', int(m.group(2)), int(m.group(3), 16), int(m.group(4), 16)
+            try:
+                if type < 2:    # all breakpoints are hardware ones: flash can't take BKPT instructions
+                    if insert: self.xlk.set_breakpoint(addr)
+                    else:   self.xlk.remove_breakpoint(addr)
+                else:
+                    wtype = {2: 'w', 3: 'r', 4: 'rw'}[type]
+                    if insert: self.xlk.set_watchpoint(addr, kind, wtype)
+                    else:   self.xlk.remove_watchpoint(addr, kind, wtype)
+                self._send_packet('OK')
+            except NotImplementedError:
+                self._send_packet('')
+            except Exception as e:
+                LOG.warning('%s fail: %s', packet, e)
+                self._send_packet('E01')
 
         elif packet == 'vCont?':
-            self._send_packet(conn, 'vCont;c;s;t')
+            self._send_packet('vCont;c;s;t')
 
         elif packet.startswith('vCont;c') or packet == 'c':
             try:
                 self.xlk.go()
-                # We don't reply until stopped, but if we want Ozone to stay connected while target runs:
-                # Actually, GDB RSP 'c' is expected to block. 
-                # But RTTView needs to keep going. 
-                # For a bridge, we'll just not reply 'OK' and let the client wait or timeout?
-                # Actually, some servers reply 'OK' then send 'T05' later.
-                pass
+                self._resumed()
+                if self.nonstop:
+                    self._send_packet('OK')
+                # all-stop: the stop reply is sent by _monitor when the core halts
             except:
-                self._send_packet(conn, 'E01')
+                self._send_packet('E01')
 
         elif packet.startswith('vCont;s') or packet == 's':
             try:
                 self.xlk.step()
-                self._send_packet(conn, 'S05')
+                self.regvals = None
+                self.stop_signal = 5
+                if self.nonstop:
+                    self._send_packet('OK')
+                    self._send_notification('Stop:' + self._stop_reply())
+                else:
+                    self._send_packet(self._stop_reply())
             except:
-                self._send_packet(conn, 'E01')
+                self._send_packet('E01')
+
+        elif packet.startswith('vCont;t'):
+            try:
+                self.xlk.halt()
+                self.regvals = None
+                self._send_packet('OK')
+                self.target_running = True  # _monitor reports the stop
+                self.stop_signal = 0
+                self.next_poll = 0
+            except Exception as e:
+                LOG.warning('halt fail: %s', e)
+                self._send_packet('E01')
 
         elif packet == 'D':
-            self._send_packet(conn, 'OK')
+            self._send_packet('OK')
 
         else:
-            self._send_packet(conn, '')
+            self._send_packet('')
+
+
+class GDBServer(threading.Thread):
+    ''' asyncio GDB server in its own thread, serving any number of clients at once
+
+    Every client has its own GDBSession; packets are handled in a small thread pool at XLink's bulk
+    priority, so probe accesses of all clients are arbitrated against the RTT poller, and each client's
+    memory traffic is limited to rate bytes per second.
+    '''
+    PACKET_SIZE = 0x4000    # largest packet we accept, X/M writes and m replies are sized by it
+
+    WORKERS = 4
+
+    # registers of the org.gnu.gdb.arm.m-profile feature, used when the backend can't describe the core
+    REGS = ['r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7', 'r8', 'r9', 'r10', 'r11', 'r12', 'sp', 'lr', 'pc', 'xpsr']
+
+    def __init__(self, xlk, port=2331, elfpath=None, host='localhost', rate=0):
+        super().__init__()
+        self.xlk = xlk
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.daemon = True
+        self.running = False
+        self.loop = None
+        self.stopped = None
+        self.sessions = {}      # {GDBSession: task serving it}
+        self.regs = [(name, 32) for name in self.REGS]     # (name, bitsize) in GDB register number order
+        self.target_xml = self._build_target_xml()
+        self.memory_map = None
+        self.elfmap = None      # the ELF's read-only sections, memory map for backends without one
+        self.load_lock = threading.Lock()
+
+        # Memory reads go through mem; with an ELF loaded, reads of its read-only sections are
+        # served from the file instead of the probe.
+        self.elfpath = elfpath
+        self.elffile = None     # (path, mtime) of the ELF currently layered into mem
+        self.mem = XLinkContext(xlk)
+
+    def _load_elf(self):
+        ''' (re)load the ELF if it changed, and serve its read-only sections from the file '''
+        if not self.elfpath or not os.path.isfile(self.elfpath):
+            return
+
+        key = (self.elfpath, os.path.getmtime(self.elfpath))
+        if self.elffile == key:
+            return
+
+        self.mem = XLinkContext(self.xlk)
+
+        from elftools.elf.constants import SH_FLAGS
+        from elftools.elf.elffile import ELFFile
+        from pyocd.core.memory_map import MemoryMap, MemoryRegion, MemoryType
+        from pyocd.debug.elf.elf import ELFBinaryFile
+        from pyocd.debug.elf.flash_reader import FlashReaderContext
+
+        # Read the file into memory rather than mapping it, so the linker can still rewrite it.
+        with open(self.elfpath, 'rb') as f:
+            image = io.BytesIO(f.read())
+
+        # No target memory map here: treat the ELF's loaded, non-writable sections as flash.
+        regions = [MemoryRegion(type=MemoryType.FLASH, start=sect['sh_addr'], length=sect['sh_size'], name=sect.name)
+                   for sect in ELFFile(image).iter_sections()
+                   if sect['sh_type'] == 'SHT_PROGBITS' and sect['sh_size'] and not (sect['sh_flags'] & SH_FLAGS.SHF_WRITE)
+                   and sect['sh_flags'] & (SH_FLAGS.SHF_ALLOC | SH_FLAGS.SHF_EXECINSTR)]
+        elf = ELFBinaryFile(image, MemoryMap(regions))
+        self.elfmap = MemoryMap(*[MemoryRegion(type=MemoryType.ROM, start=region.start, length=region.length, name=region.name) for region in regions])
+
+        # Only trust the ELF if it matches what is actually programmed.
+        for sect in elf.sections:
+            if sect.region is None:
+                continue
+            n = min(sect.length, 64)
+            if self.xlk.read_mem_U8(sect.start, n) != sect.data[:n]:
+                print(f"GDB Server: {os.path.basename(self.elfpath)} section {sect.name} differs from target, reading memory from target")
+                return
+
+        self.mem = FlashReaderContext(self.mem, elf)
+        self.elffile = key
+
+    def _load_target(self):
+        ''' take the register list, target.xml and memory map from the backend where it has them '''
+        desc = self.xlk.target_description()
+        if desc:
+            self.target_xml, self.regs = desc
+
+        self.memory_map = self.xlk.memory_map() or self.elfmap
+
+    def _build_target_xml(self):
+        root = Element('target')
+        SubElement(root, 'architecture').text = 'arm'
+        feature = SubElement(root, 'feature', name='org.gnu.gdb.arm.m-profile')
+        for name, bitsize in self.regs:
+            SubElement(feature, 'reg', name=name, bitsize=str(bitsize), type='int')
+
+        return '<?xml version="1.0"?><!DOCTYPE target SYSTEM "gdb-target.dtd">' + tostring(root).decode()
+
+    def memory_map_xml(self):
+        ''' GDB memory map of self.memory_map, the gaps between its regions are reported as RAM
+            because GDB refuses to access memory outside the map '''
+        root = Element('memory-map')
+        addr = 0
+        for region in sorted(self.memory_map.regions, key=lambda region: region.start):
+            if region.start > addr:
+                SubElement(root, 'memory', type='ram', start=f'{addr:#x}', length=f'{region.start - addr:#x}')
+
+            # we can't program flash, so GDB gets it as ROM and won't try to load into it
+            SubElement(root, 'memory', type='ram' if region.is_ram else 'rom', start=f'{region.start:#x}', length=f'{region.length:#x}')
+            addr = region.end + 1
+
+        if addr < 1 << 32:
+            SubElement(root, 'memory', type='ram', start=f'{addr:#x}', length=f'{(1 << 32) - addr:#x}')
+
+        return '<?xml version="1.0"?><!DOCTYPE memory-map PUBLIC "+//IDN gnu.org//DTD GDB Memory Map V1.0//EN" "http://sourceware.org/gdb/gdb-memory-map.dtd">' + tostring(root).decode()
+
+    def _connect(self):
+        with self.load_lock:    # clients connecting at the same time load once
+            try:
+                self._load_elf()
+            except Exception as e:
+                print(f"GDB Server: load {self.elfpath} fail: {e}")
+            try:
+                self._load_target()
+            except Exception as e:
+                print(f"GDB Server: read target description fail: {e}")
 
     def run(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.WORKERS, initializer=self.xlk.set_priority, initargs=(self.xlk.PRIO_BULK,))
+
         try:
-            self.sock.bind(('localhost', self.port))
+            server = await self.loop.create_server(lambda: RSPProtocol(self), self.host, self.port, reuse_address=True)
         except Exception as e:
             print(f"GDB Server bind failed: {e}")
             return
 
-        self.sock.listen(1)
         self.running = True
-        print(f"GDB Server listening on port {self.port}")
+        print(f"GDB Server listening on {self.host}:{self.port}")
 
-        while self.running:
-            try:
-                self.sock.settimeout(1.0)
-                conn, addr = self.sock.accept()
-                with conn:
-                    print(f"GDB Client connected from {addr}")
-                    conn.settimeout(5.0)
-                    while self.running:
-                        try:
-                            data = conn.recv(1)
-                            if not data: break
-                            if data == b'\x03': # Interrupt
-                                self.xlk.halt()
-                                self._send_packet(conn, 'S05')
-                                continue
-                            if data == b'$':
-                                payload = b''
-                                while True:
-                                    c = conn.recv(1)
-                                    if c == b'#': break
-                                    payload += c
-                                checksum = conn.recv(2)
-                                conn.sendall(b'+')
-                                self._handle_packet(conn, payload.decode('latin-1'))
-                        except socket.timeout:
-                            continue
-                        except Exception as e:
-                            print(f"GDB Connection error: {e}")
-                            break
-            except socket.timeout:
-                continue
-            except Exception as e:
-                if self.running:
-                    print(f"GDB Server accept error: {e}")
-                break
+        async with server:
+            await self.stopped.wait()
+
+            tasks = list(self.sessions.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.pool.shutdown(wait=False)
+
+    async def _serve(self, proto):
+        transport, parser = proto.transport, proto.parser
+        print(f"GDB Client connected from {transport.get_extra_info('peername')}")
+        session = GDBSession(self, self.rate)
+        self.sessions[session] = asyncio.current_task()
+        try:
+            await self.loop.run_in_executor(self.pool, self._connect)
+
+            while self.running:
+                proto.received.clear()
+                events = list(parser.events())
+                if not events:
+                    if proto.closed: break
+                    proto.resume_reading()  # everything received has been parsed
+
+                    timeout = max(session.next_poll - time.time(), 0.001) if session.target_running else None
+                    try:
+                        await asyncio.wait_for(proto.received.wait(), timeout)
+                        continue
+                    except asyncio.TimeoutError:
+                        events = [(None, None)]     # only poll the run state
+
+                for kind, payload in events:
+                    if kind == 'packet':
+                        delay = session.limiter.charge(session.cost(payload))
+                        if delay:
+                            await asyncio.sleep(delay)
+
+                    transport.write(await self.loop.run_in_executor(self.pool, session.process, kind, payload))
+                    await proto.drain()
+
+        except asyncio.CancelledError:
+            pass    # server stopping
+        except Exception as e:
+            if self.running:
+                print(f"GDB Connection error: {e}")
+        finally:
+            self.sessions.pop(session, None)
+            transport.close()
 
     def stop(self):
         self.running = False
-        if self.sock:
-            self.sock.close()
+        if self.loop and self.stopped:
+            self.loop.call_soon_threadsafe(self.stopped.set)
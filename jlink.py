@@ -1,10 +1,18 @@
 import ctypes
+import struct
 
+import xlink
+
+
+class JLink(xlink.Backend):
+    caps = xlink.Backend.BLOCK_READ | xlink.Backend.NON_HALTING | xlink.Backend.REG_LIST | xlink.Backend.NATIVE_RTT | xlink.Backend.HSS | xlink.Backend.HW_BREAK
 
-class JLink(object):
     def __init__(self, dllpath, mode='arm', core='Cortex-M0', speed=4000):
         self.jlk = ctypes.cdll.LoadLibrary(dllpath)
 
+        self.bp_handles = {}    # {addr: DLL handle}
+        self.wp_handles = {}    # {(addr, size, type): DLL handle}
+
         self.open(mode, core, speed)
 
     def open(self, mode='arm', core='Cortex-M0', speed=4000):
@@ -55,20 +63,23 @@ class JLink(object):
         self.jlk.JLINKARM_WriteU64(addr, val)
 
     def write_mem_U8(self, addr, data):
-        buffer = (ctypes.c_uint8 * len(data))(*data)
+        if isinstance(data, bytearray):
+            buffer = (ctypes.c_uint8 * len(data)).from_buffer(data)
+        elif isinstance(data, bytes):
+            buffer = data   # passed to the DLL as a pointer to the bytes object's own storage
+        else:
+            buffer = bytes(data)
 
         self.jlk.JLINKARM_WriteMem(addr, len(data), buffer)
 
     def write_mem_U32(self, addr, data):
-        buffer = (ctypes.c_uint32 * len(data))(*data)
-
-        self.write_mem_U8(addr, bytes(buffer))  # MCU and PC both little-endian
+        self.write_mem_U8(addr, struct.pack('<%dI' % len(data), *data))
 
     def read_mem_U8(self, addr, count):
-        buffer = (ctypes.c_uint8 * count)()
-        self.jlk.JLINKARM_ReadMemU8(addr, count, buffer, 0)
+        data = bytearray(count)
+        self.jlk.JLINKARM_ReadMemU8(addr, count, (ctypes.c_uint8 * count).from_buffer(data), 0)
 
-        return buffer[:]
+        return data
 
     def read_mem_U16(self, addr, count):
         buffer = (ctypes.c_uint16 * count)()
@@ -132,6 +143,110 @@ class JLink(object):
     def close(self):
         self.jlk.JLINKARM_Close()
 
+    def set_breakpoint(self, addr):
+        if addr in self.bp_handles:
+            return
+
+        handle = self.jlk.JLINKARM_SetBPEx(addr & ~1, BPType.HW | BPType.THUMB)
+        if handle <= 0:
+            raise Exception(f'JLINKARM_SetBPEx fail: {handle}')
+
+        self.bp_handles[addr] = handle
+
+    def remove_breakpoint(self, addr):
+        if addr in self.bp_handles:
+            self.jlk.JLINKARM_ClrBPEx(self.bp_handles.pop(addr))
+
+    def set_watchpoint(self, addr, size, type):
+        if (addr, size, type) in self.wp_handles:
+            return
+
+        # mask bits set are "don't care": any data, any access size, direction only matters for 'r' or 'w'
+        ctrl = WPCtrl.DIR_WR if type == 'w' else WPCtrl.DIR_RD
+        ctrl_mask = 0xFFFFFFFF if type == 'rw' else (0xFFFFFFFF & ~WPCtrl.DIR_MASK)
+        handle = self.jlk.JLINKARM_SetWP(addr, size - 1, 0, 0xFFFFFFFF, ctrl, ctrl_mask)
+        if handle <= 0:
+            raise Exception(f'JLINKARM_SetWP fail: {handle}')
+
+        self.wp_handles[(addr, size, type)] = handle
+
+    def remove_watchpoint(self, addr, size, type):
+        if (addr, size, type) in self.wp_handles:
+            self.jlk.JLINKARM_ClrWP(self.wp_handles.pop((addr, size, type)))
+
+    def target_description(self):
+        ''' from the DLL's register list: all of its Cortex-M registers are 32 bits, FPU as FPS0..FPS31 '''
+        return self.arm_target_description()
+
+    # RTT polled inside the DLL (JLINK_RTTERMINAL_*), much faster than reading the ring buffers from Python
+    def rtt_start(self, addr=None):
+        ''' addr: _SEGGER_RTT control block address, None to let the DLL search for it '''
+        start = RTTStart(ConfigBlockAddress = addr or 0)
+        res = self.jlk.JLINK_RTTERMINAL_Control(RTTCmd.START, ctypes.byref(start))
+        if res < 0:
+            raise Exception(f'JLINK_RTTERMINAL_Control(START) fail: {res}')
+
+    def rtt_stop(self):
+        self.jlk.JLINK_RTTERMINAL_Control(RTTCmd.STOP, None)
+
+    def rtt_get_num_buffers(self, direction):
+        ''' return number of buffers, < 0 while the DLL is still looking for the control block '''
+        dir = ctypes.c_uint32(direction)
+        return self.jlk.JLINK_RTTERMINAL_Control(RTTCmd.GETNUMBUF, ctypes.byref(dir))
+
+    def rtt_get_buffers(self, direction):
+        ''' return [(name, size)] of the up (direction = 0) or down (direction = 1) buffers '''
+        buffers = []
+        for i in range(self.rtt_get_num_buffers(direction)):
+            desc = RTTBufDesc(BufferIndex = i, Direction = direction)
+            if self.jlk.JLINK_RTTERMINAL_Control(RTTCmd.GETDESC, ctypes.byref(desc)) >= 0:
+                buffers.append((desc.acName.decode('latin-1'), desc.SizeOfBuffer))
+        return buffers
+
+    def rtt_read(self, index, size):
+        data = bytearray(size)
+        n = self.jlk.JLINK_RTTERMINAL_Read(index, (ctypes.c_uint8 * size).from_buffer(data), size)
+        if n < 0:
+            raise Exception(f'JLINK_RTTERMINAL_Read fail: {n}')
+
+        return data[:n]
+
+    def rtt_write(self, index, data):
+        ''' return number of bytes written, may be less than len(data) if the down buffer is full '''
+        data = bytes(data)
+        n = self.jlk.JLINK_RTTERMINAL_Write(index, data, len(data))
+        if n < 0:
+            raise Exception(f'JLINK_RTTERMINAL_Write fail: {n}')
+
+        return n
+
+    # High-Speed Sampling: the probe firmware reads a list of memory blocks at a fixed period
+    def hss_get_caps(self):
+        ''' return (max number of blocks, max sampling frequency in Hz) '''
+        caps = HSSCaps()
+        if self.jlk.JLINK_HSS_GetCaps(ctypes.byref(caps)) < 0:
+            raise Exception('HSS not supported')
+
+        return caps.MaxBlocks, caps.MaxFreq
+
+    def hss_start(self, blocks, period_us):
+        ''' blocks: [(addr, size)], each sample is the data of all blocks back to back '''
+        desc = (HSSMemBlockDesc * len(blocks))(*[HSSMemBlockDesc(Addr = addr, NumBytes = size) for addr, size in blocks])
+        res = self.jlk.JLINK_HSS_Start(desc, len(blocks), period_us, 0)
+        if res < 0:
+            raise Exception(f'JLINK_HSS_Start fail: {res}')
+
+    def hss_read(self, size):
+        data = bytearray(size)
+        n = self.jlk.JLINK_HSS_Read((ctypes.c_uint8 * size).from_buffer(data), size)
+        if n < 0:
+            raise Exception(f'JLINK_HSS_Read fail: {n}')
+
+        return data[:n]
+
+    def hss_stop(self):
+        self.jlk.JLINK_HSS_Stop()
+
 
 class TIF:
     JTAG  = 0
@@ -139,6 +254,57 @@ class TIF:
     CJTAG = 7
 
 
+class BPType:
+    THUMB = 0x00000002
+    HW    = 0xFFFFFF00
+
+
+class WPCtrl:
+    DIR_RD   = (0 << 0)
+    DIR_WR   = (1 << 0)
+    DIR_MASK = (1 << 0)
+
+
+class RTTCmd:
+    START     = 0
+    STOP      = 1
+    GETDESC   = 2
+    GETNUMBUF = 3
+    GETSTAT   = 4
+
+
+class RTTStart(ctypes.Structure):
+    _fields_ = [
+        ('ConfigBlockAddress', ctypes.c_uint32),
+        ('Reserved',           ctypes.c_uint32 * 3),
+    ]
+
+class HSSCaps(ctypes.Structure):
+    _fields_ = [
+        ('MaxBlocks', ctypes.c_uint32),
+        ('MaxFreq',   ctypes.c_uint32),
+        ('Caps',      ctypes.c_uint32),
+        ('Dummy',     ctypes.c_uint32 * 13),
+    ]
+
+class HSSMemBlockDesc(ctypes.Structure):
+    _fields_ = [
+        ('Addr',     ctypes.c_uint32),
+        ('NumBytes', ctypes.c_uint32),
+        ('Flags',    ctypes.c_uint32),
+        ('Dummy',    ctypes.c_uint32),
+    ]
+
+class RTTBufDesc(ctypes.Structure):
+    _fields_ = [
+        ('BufferIndex',  ctypes.c_int32),
+        ('Direction',    ctypes.c_uint32),  # 0: up (target -> host), 1: down (host -> target)
+        ('acName',       ctypes.c_char * 32),
+        ('SizeOfBuffer', ctypes.c_uint32),
+        ('Flags',        ctypes.c_uint32),
+    ]
+
+
 
 if __name__ == '__main__':
     jlk = JLink(r'D:\Program\Segger\JLink_V688\JLink_x64.dll')
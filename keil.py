@@ -1,10 +1,21 @@
 import win32com.client
 import pywintypes
+import os
 import time
+import struct
+import tempfile
+
+import xlink
+
+class Keil(xlink.Backend):
+    caps = xlink.Backend.NON_HALTING | xlink.Backend.BLOCK_READ
+
+    SAVE_MIN = 64   # reads at least this long dump the range with one SAVE command, shorter ones use _RDWORD
 
-class Keil(object):
     def __init__(self):
         self.uv = None
+        self.save_ok = True     # cleared if uVision refuses the SAVE command or its output can't be parsed, reads then always use _RDWORD/_RBYTE
+        self.save_path = os.path.join(tempfile.gettempdir(), f'rttview_{os.getpid()}.hex')
         self.mode = 'arm'
         self.core_regs = {'pc': 15, 'sp': 13, 'lr': 14}
 
@@ -22,6 +33,9 @@ class Keil(object):
     def close(self):
         self.uv = None
 
+        if os.path.exists(self.save_path):
+            os.remove(self.save_path)
+
     def read_U32(self, addr):
         return self.uv.Evaluate(f"_RDWORD(0x{addr:08X})") & 0xFFFFFFFF
 
@@ -29,17 +43,82 @@ class Keil(object):
         self.uv.Evaluate(f"_WDWORD(0x{addr:08X}, 0x{val:08X})")
 
     def read_mem_U8(self, addr, count):
-        # Optimization: Loop is slow but compatible. 
-        # For RTT, we'll try to read as much as possible in one go if Keil supports it,
-        # but the standard COM Evaluate doesn't return large blocks easily.
-        data = []
-        for i in range(count):
-            data.append(self.uv.Evaluate(f"_RBYTE(0x{addr+i:08X})") & 0xFF)
+        if count >= self.SAVE_MIN and self.save_ok:
+            try:
+                return self._save_read(addr, count)
+            except Exception:
+                pass    # this read falls back, SAVE is tried again on the next one unless it was refused or its output was unusable
+
+        data = bytearray()
+        for addr, count, width in self._spans(addr, count):
+            if width == 32:
+                data += struct.pack(f'<{count}I', *self.read_mem_U32(addr, count))
+            else:
+                data += bytes([self.uv.Evaluate(f"_RBYTE(0x{addr+i:08X})") & 0xFF for i in range(count)])
+        return data
+
+    def _save_read(self, addr, count):
+        ''' dump [addr, addr + count) to an Intel HEX file with uVision's SAVE command, one COM call for the whole range '''
+        if os.path.exists(self.save_path):
+            os.remove(self.save_path)
+
+        try:
+            self.uv.Execute(f'SAVE "{self.save_path}" 0x{addr:08X}, 0x{addr+count-1:08X}')
+        except pywintypes.com_error:
+            self.save_ok = False
+            raise
+
+        try:
+            data = self._parse_hex(addr, count)
+        except Exception:
+            self.save_ok = False    # uVision's output can't be used, so every read falls back from now on
+            raise
+
+        return data
+
+    def _parse_hex(self, addr, count):
+        ''' the [addr, addr + count) bytes of the SAVE output; uVision pads and aligns its records, so they are clipped to the range '''
+        data = bytearray(count)
+        filled = 0
+        base = 0
+        with open(self.save_path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line.startswith(':'):
+                    continue
+
+                rec = bytes.fromhex(line[1:])
+                if len(rec) < 5 or len(rec) != rec[0] + 5 or sum(rec) & 0xFF:
+                    raise Exception(f'bad HEX record: {line}')
+
+                n, offset, type = rec[0], (rec[1] << 8) | rec[2], rec[3]
+                if type == 0x00:
+                    start = base + offset - addr
+                    lo, hi = max(start, 0), min(start + n, count)
+                    if lo < hi:
+                        data[lo:hi] = rec[4+lo-start : 4+hi-start]
+                        filled += hi - lo
+                elif type == 0x02:  # extended segment address
+                    base = ((rec[4] << 8) | rec[5]) << 4
+                elif type == 0x04:  # extended linear address
+                    base = ((rec[4] << 8) | rec[5]) << 16
+                elif type == 0x01:
+                    break
+
+        if filled != count:
+            raise Exception(f'SAVE returned {filled} of {count} bytes')
+
         return data
 
     def write_mem_U8(self, addr, data):
-        for i, b in enumerate(data):
-            self.uv.Evaluate(f"_WBYTE(0x{addr+i:08X}, 0x{b:02X})")
+        data = bytes(data)
+        for addr_, count, width in self._spans(addr, len(data)):
+            span = data[addr_-addr : addr_-addr + count * (width // 8)]
+            if width == 32:
+                self.write_mem_U32(addr_, struct.unpack(f'<{count}I', span))
+            else:
+                for i, b in enumerate(span):
+                    self.uv.Evaluate(f"_WBYTE(0x{addr_+i:08X}, 0x{b:02X})")
 
     def read_mem_U32(self, addr, count):
         data = []
@@ -4,55 +4,138 @@ OpenOCD Tcl RPC python wrapper.
 import re
 import time
 import socket
+import struct
+import asyncio
+import threading
+import collections
+import concurrent.futures
 
+import xlink
 
-class OpenOCD:
-    def __init__(self, host="localhost", port=6666, mode='rv', core='risc-v', speed=4000):
+
+class OpenOCD(xlink.Backend):
+    caps = xlink.Backend.BLOCK_READ | xlink.Backend.BATCHED_READ | xlink.Backend.RESET_HALT | xlink.Backend.NATIVE_RTT | xlink.Backend.HW_BREAK
+
+    CHUNK = 4096    # bytes per read_memory/write_memory command
+
+    def __init__(self, host="localhost", port=6666, mode='rv', core='risc-v', speed=4000, halt_mem=None, rtt_port=9090):
         self.host = host
         self.port = port
 
+        # OpenOCD serves RTT channel n on TCP port rtt_port + n
+        self.rtt_port = rtt_port
+        self.rtt_socks = {}
+
         self.debug = False
+
+        # halt_mem: halt the core around memory accesses. None: only for RISC-V, Cortex-M MEM-AP accesses memory while running
+        self.halt_mem = halt_mem
         
         self.open(mode, core, speed)
 
     def open(self, mode='rv', core='risc-v', speed=4000):
         self.mode = mode.lower()
 
+        if self.halt_mem is None:
+            self.halt_mem = not self.mode.startswith('arm')
+
+        if not self.halt_mem:
+            self.caps = OpenOCD.caps | xlink.Backend.NON_HALTING
+
         self.sock = socket.create_connection((self.host, self.port), timeout=1)
 
+        # responses come back in command order, so each one completes the oldest pending future
+        self.pending = collections.deque()
+        self.txlock = threading.Lock()
+        self.connected = True
+
+        self.reader = threading.Thread(target=self._reader, daemon=True)
+        self.reader.start()
+
         self.get_registers()
-    
-    def _exec(self, cmd):
+
+    def submit(self, cmd, callback=None):
+        ''' send cmd without waiting for its response, and return a concurrent.futures.Future for it
+            callback(response) is called from the reader thread when the response arrives '''
         if self.debug:
             print('<- ', cmd)
 
-        self.sock.send(f'{cmd}\x1a'.encode('latin-1'))
-        return self._read()
+        fut = concurrent.futures.Future()
+        if callback:
+            fut.add_done_callback(lambda f: f.exception() or callback(f.result()))
 
-    def _read(self):
-        resp = bytes()
-        start = time.time()
-        while time.time() < start + 2:
-            resp += self.sock.recv(4096)
-            if resp.endswith(b'\x1a'):
-                break
+        with self.txlock:   # keep send order and pending order the same
+            if not self.connected:  # the reader has exited, nothing would complete fut
+                fut.set_exception(Exception('OpenOCD connection closed'))
+                return fut
 
-        resp = resp[:-1].decode('latin-1').strip()
+            self.pending.append(fut)
+            self.sock.sendall(f'{cmd}\x1a'.encode('latin-1'))
 
-        if self.debug:
-            print('-> ', resp)
+        return fut
 
-        return resp
+    async def aexec(self, cmd):
+        return await asyncio.wrap_future(self.submit(cmd))
+
+    def _exec(self, cmd):
+        return self._exec_many([cmd])[0]
+
+    def _exec_many(self, cmds, timeout=2):
+        ''' send all commands before waiting for any response, so a batch costs one round trip '''
+        futs = [self.submit(cmd) for cmd in cmds]
+
+        try:
+            return [fut.result(timeout) for fut in futs]
+        except concurrent.futures.TimeoutError:
+            raise Exception('OpenOCD response timeout') from None
+
+    def _reader(self):
+        rxbuf = bytearray()
+        try:
+            while True:
+                try:
+                    chunk = self.sock.recv(65536)
+                except socket.timeout:
+                    continue
+                if not chunk:
+                    break
+                rxbuf += chunk
+
+                start = 0
+                while (end := rxbuf.find(b'\x1a', start)) >= 0:
+                    resp = rxbuf[start:end].decode('latin-1').strip()
+                    start = end + 1
+
+                    if self.debug:
+                        print('-> ', resp)
+
+                    if self.pending:
+                        self.pending.popleft().set_result(resp)
+                del rxbuf[:start]      # keep the partial response that follows
+
+        except OSError:
+            pass
+
+        with self.txlock:
+            self.connected = False
+
+        while self.pending:
+            self.pending.popleft().set_exception(Exception('OpenOCD connection closed'))
 
     def get_registers(self):
         self.core_regs = {}  # 'name: index' pair
+        self.reg_bits = {}   # 'name: bitsize' pair
         for line in self._exec('reg').splitlines():
             match = re.match(r'\((\d+)\)\s+(\w+)\s+\(/(\d+)\)', line)
             if match:
                 self.core_regs[match.group(2)] = match.group(1)
+                self.reg_bits[match.group(2).lower()] = int(match.group(3))
 
     def halt_required(func):
         def wrapper(self, *args, **kwargs):
+            if not self.halt_mem:
+                return func(self, *args, **kwargs)
+
             halted = self.halted()
             if not halted: self.halt()
             res = func(self, *args, **kwargs)
@@ -78,42 +161,91 @@ class OpenOCD:
     def write_U64(self, addr, val):
         self._exec(f'mwd {addr:#x} {val:#x}')
 
+    def _chunks(self, addr, count, width):
+        ''' split into (addr, index, count) chunks of at most CHUNK bytes '''
+        n = self.CHUNK // (width // 8)
+        return [(addr + index * (width // 8), index, min(n, count - index)) for index in range(0, count, n)]
+
     @halt_required
     def write_mem_(self, addr, data, width):
-        index = 0
-        while index < len(data):
-            s = ' '.join([f'{x:#x}' for x in data[index:index+128]])
-            
-            self._exec(f'write_memory {addr:#x} {width} {{{s}}}')
+        cmds = []
+        for addr, index, n in self._chunks(addr, len(data), width):
+            s = ' '.join([f'{x:#x}' for x in data[index:index+n]])
+            cmds.append(f'write_memory {addr:#x} {width} {{{s}}}')
 
-            addr += 128 * (width // 8)
-            index += 128
+        self._exec_many(cmds)
 
     def write_mem_U8(self, addr, data):
-        self.write_mem_(addr, data, 8)
+        data = memoryview(bytes(data))
+        for addr_, count, width in self._spans(addr, len(data)):
+            span = data[addr_-addr : addr_-addr + count * (width // 8)]
+            self.write_mem_(addr_, span.cast('I') if width == 32 else span, width)
 
     def write_mem_U32(self, addr, data):
         self.write_mem_(addr, data, 32)
 
     @halt_required
     def read_mem_(self, addr, count, width):
+        chunks = self._chunks(addr, count, width)
+        cmds = [f'read_memory {addr:#x} {width} {n}' for addr, index, n in chunks]
+
         data = []
-        index = 0
-        while index < count:    # read too much one-time will cause timeout
-            res = self._exec(f'read_memory {addr:#x} {width} {min(128, count)}')
-            if res:
-                data.extend([int(x, 16) for x in res.split()])
+        for (addr, index, n), res in zip(chunks, self._exec_many(cmds)):
+            data.extend(self._read_values(res, addr, n))
 
-                addr += 128 * (width // 8)
-                index += 128
+        return data
 
-            else:
-                break
+    @staticmethod
+    def _read_values(res, addr, count):
+        ''' values of a read_memory reply, which on failure is OpenOCD's error message or empty '''
+        try:
+            vals = [int(x, 16) for x in res.split()]
+        except ValueError:
+            vals = None
+        if vals is None or len(vals) != count:
+            raise Exception(f'read_memory {addr:#x} fail: {res.strip() or "empty reply"}')
+        return vals
 
+    def read_mem_U8(self, addr, count):
+        data = bytearray()
+        for addr, count, width in self._spans(addr, count):
+            if width == 32:     # words carry the same bytes in half the text
+                words = self.read_mem_(addr, count, 32)
+                data += struct.pack(f'<{len(words)}I', *words)
+            else:
+                data += bytes(self.read_mem_(addr, count, 8))
         return data
 
-    def read_mem_U8(self, addr, count):
-        return self.read_mem_(addr, count, 8)
+    @halt_required
+    def read_many(self, ranges):
+        ''' read all ranges with one Tcl script, so the whole batch costs one RPC round trip '''
+        result = [None] * len(ranges)
+        batch = []
+        for i, (addr, size) in enumerate(ranges):
+            if size > 128:
+                result[i] = memoryview(self.read_mem_U8(addr, size))
+            else:
+                batch.append(i)
+
+        groups = [batch[index:index+32] for index in range(0, len(batch), 32)]
+        cmds = []
+        for group in groups:
+            reads = ' '.join([f'[read_memory {ranges[i][0]:#x} 8 {ranges[i][1]}]' for i in group])
+            cmds.append(f'join [list {reads}] "|"')
+
+        for group, res in zip(groups, self._exec_many(cmds)):
+            fields = res.split('|')
+            try:
+                if len(fields) != len(group):    # the script failed and res is the error message
+                    raise Exception(res)
+                for i, r in zip(group, fields):
+                    result[i] = memoryview(bytes(self._read_values(r, ranges[i][0], ranges[i][1])))
+            except Exception:
+                # read the batch's ranges one by one, so the error names the range that failed
+                for i in group:
+                    result[i] = memoryview(self.read_mem_U8(*ranges[i]))
+
+        return result
 
     def read_mem_U16(self, addr, count):
         return self.read_mem_(addr, count, 16)
@@ -136,7 +268,9 @@ class OpenOCD:
         return int(res.split(':')[1].strip(), 16)
 
     def read_regs(self, rlist):
-        return {reg : self.read_reg(reg) for reg in rlist}
+        res = self._exec_many([f'reg {self.core_regs[reg]}' for reg in rlist])
+
+        return {reg : int(r.split(':')[1].strip(), 16) for reg, r in zip(rlist, res)}
 
     def write_reg(self, reg, val):
         self._exec(f'reg {self.core_regs[reg]} {val:#x}')
@@ -160,15 +294,117 @@ class OpenOCD:
         else:
             self._exec(f'resume {addr:#x}') # resume the target to specified address
 
+    def go(self):
+        self.resume()
+
     def halted(self):
         res = self._exec('targets')
         
         return 'halted' in res
 
+    def set_breakpoint(self, addr):
+        res = self._exec(f'bp {addr & ~1:#x} 2 hw')
+        if 'error' in res.lower() or 'fail' in res.lower():
+            raise Exception(f'bp fail: {res}')
+
+    def remove_breakpoint(self, addr):
+        self._exec(f'rbp {addr & ~1:#x}')
+
+    def set_watchpoint(self, addr, size, type):
+        res = self._exec(f'wp {addr:#x} {size} {"a" if type == "rw" else type}')
+        if 'error' in res.lower() or 'fail' in res.lower():
+            raise Exception(f'wp fail: {res}')
+
+    def remove_watchpoint(self, addr, size, type):
+        self._exec(f'rwp {addr:#x}')
+
+    def target_description(self):
+        ''' from OpenOCD's register list, with the bitsizes it reports (d0..d15 of the FPU are 64 bits) '''
+        return self.arm_target_description(self.reg_bits)
+
+    # RTT: OpenOCD polls the ring buffers itself and streams each channel over its own TCP server
+    def rtt_start(self, addr=None):
+        ''' addr: _SEGGER_RTT control block address, None to search the first 64 KiB of RAM at 0x20000000 '''
+        if addr is None:
+            self._exec('rtt setup 0x20000000 0x10000 "SEGGER RTT"')
+        else:
+            self._exec(f'rtt setup {addr:#x} 32 "SEGGER RTT"')
+
+        res = self._exec('rtt start')
+        if 'error' in res.lower() or 'fail' in res.lower():
+            raise Exception(f'rtt start fail: {res}')
+
+        self._rtt_sock(0)   # connect now so that channel 0 data is already streaming on the first rtt_read
+
+    def rtt_stop(self):
+        for index, sock in self.rtt_socks.items():
+            sock.close()
+            self._exec(f'rtt server stop {self.rtt_port + index}')
+        self.rtt_socks = {}
+
+        self._exec('rtt stop')
+
+    def rtt_get_num_buffers(self, direction):
+        ''' return number of buffers, < 0 while OpenOCD has not found the control block '''
+        match = re.search(r'up=(\d+),\s*down=(\d+)', self._exec('rtt channels'))
+        if not match:
+            return -1
+
+        return int(match.group(direction + 1))
+
+    def rtt_get_buffers(self, direction):
+        ''' return [(name, size)] of the up (direction = 0) or down (direction = 1) buffers '''
+        res = self._exec('rtt channels')
+        if direction == 0:
+            res = res.partition('Up-channels:')[2].partition('Down-channels:')[0]
+        else:
+            res = res.partition('Down-channels:')[2]
+
+        return [(name, int(size)) for name, size in re.findall(r'^\s*\d+:\s*(.*?)\s+(\d+)\s+\d+\s*$', res, re.M)]
+
+    def _rtt_sock(self, index):
+        if index not in self.rtt_socks:
+            self._exec(f'rtt server start {self.rtt_port + index} {index}')
+
+            sock = socket.create_connection((self.host, self.rtt_port + index), timeout=1)
+            sock.setblocking(False)
+            self.rtt_socks[index] = sock
+
+        return self.rtt_socks[index]
+
+    def rtt_read(self, index, size):
+        ''' return the bytes OpenOCD has streamed so far, without waiting '''
+        sock = self._rtt_sock(index)
+
+        data = bytearray(size)
+        view = memoryview(data)
+        n = 0
+        while n < size:
+            try:
+                k = sock.recv_into(view[n:])
+            except BlockingIOError:
+                break
+            if not k:
+                raise Exception('OpenOCD RTT server closed')
+            n += k
+
+        return data[:n]
+
+    def rtt_write(self, index, data):
+        sock = self._rtt_sock(index)
+        sock.setblocking(True)
+        try:
+            sock.sendall(data)
+        finally:
+            sock.setblocking(False)
+
+        return len(data)
+
     def close(self):
         try:
-            self._exec('exit')
+            self.submit('exit')
         finally:
+            self.sock.shutdown(socket.SHUT_RDWR)    # wake up the reader thread
             self.sock.close()
 
         time.sleep(0.01)
@@ -18,6 +18,7 @@ from ..core import (exceptions, memory_interface)
 from .rom_table import ROMTable
 from ..utility import conversion
 import logging
+import struct
 
 # Set to True to enable logging of all DP and AP accesses.
 LOG_DAP = False
@@ -340,29 +341,48 @@ class MEM_AP(AccessPort, memory_interface.MemoryInterface):
 
     ## @brief Read a single transaction's worth of aligned words.
     #
-    # The transaction must not cross the MEM-AP's auto-increment boundary.
-    def _read_block32(self, addr, size):
+    # The transaction must not cross the MEM-AP's auto-increment boundary. If _now_ is False, a
+    # callback returning the words is returned instead, so that further transfers can be queued.
+    # If _buffer_ (size * 4 writable bytes) is given, the words are stored in it little endian
+    # and it is returned in place of a list.
+    def _read_block32(self, addr, size, now=True, buffer=None):
         assert (addr & 0x3) == 0
         num = self.dp.next_access_number
         if LOG_DAP:
             self.logger.info("_read_block32:%06d (addr=0x%08x, size=%d) {", num, addr, size)
+
+        def handle_error(error):
+            self._handle_error(error, num)
+            if isinstance(error, exceptions.TransferFaultError):
+                # Annotate error with target address.
+                error.fault_address = addr
+                error.fault_length = size * 4
+
         # put address in TAR
         self.write_reg(MEM_AP_CSW, CSW_VALUE | CSW_SIZE32)
         self.write_reg(MEM_AP_TAR, addr)
         try:
-            resp = self.link.read_ap_multiple((self.ap_num << APSEL_SHIFT) | MEM_AP_DRW, size)
-        except exceptions.TransferFaultError as error:
-            # Annotate error with target address.
-            self._handle_error(error, num)
-            error.fault_address = addr
-            error.fault_length = size * 4
-            raise
+            result = self.link.read_ap_multiple((self.ap_num << APSEL_SHIFT) | MEM_AP_DRW, size, now=now, buffer=buffer)
         except exceptions.Error as error:
-            self._handle_error(error, num)
+            handle_error(error)
             raise
-        if LOG_DAP:
-            self.logger.info("_read_block32:%06d }", num)
-        return resp
+
+        def read_block32_cb():
+            try:
+                resp = result()
+            except exceptions.Error as error:
+                handle_error(error)
+                raise
+            if LOG_DAP:
+                self.logger.info("_read_block32:%06d }", num)
+            return resp
+
+        if now:
+            if LOG_DAP:
+                self.logger.info("_read_block32:%06d }", num)
+            return result
+        else:
+            return read_block32_cb
 
     ## @brief Write a block of aligned words in memory.
     def _write_memory_block32(self, addr, data):
@@ -380,18 +400,61 @@ class MEM_AP(AccessPort, memory_interface.MemoryInterface):
 
     ## @brief Read a block of aligned words in memory.
     #
+    # The transfers of all auto-increment pages are queued before any result is read, so the
+    # probe keeps as many packets in flight as it supports across page boundaries.
+    #
     # @return An array of word values
     def _read_memory_block32(self, addr, size):
         assert (addr & 0x3) == 0
-        resp = []
-        while size > 0:
-            n = self.auto_increment_page_size - (addr & (self.auto_increment_page_size - 1))
-            if size*4 < n:
-                n = (size*4) & 0xfffffffc
-            resp += self._read_block32(addr, n//4)
-            size -= n//4
+        return list(struct.unpack('<%dI' % size, self._read_block32_into(addr, size)))
+
+    ## @brief Queue the reads of a block of aligned words into one buffer.
+    #
+    # @return A bytearray of size * 4 bytes holding the words little endian.
+    def _read_block32_into(self, addr, size):
+        data = bytearray(size * 4)
+        view = memoryview(data)
+        callbacks = []
+        pos = 0
+        while pos < len(data):
+            n = min(len(data) - pos, self.auto_increment_page_size - (addr & (self.auto_increment_page_size - 1)))
+            callbacks.append(self._read_block32(addr, n // 4, now=False, buffer=view[pos:pos + n]))
+            pos += n
             addr += n
-        return resp
+        for cb in callbacks:
+            cb()
+        return data
+
+    ## @brief Read several ranges of bytes, queueing the transfers of all of them before any
+    # result is read.
+    #
+    # Each range is read as whole aligned words, so the probe can pipeline the transfers of all
+    # ranges into as few packets as possible. Only use this on memory where reading the bytes
+    # around a range has no side effects.
+    #
+    # @param ranges Sequence of (address, byte count) pairs.
+    # @return A list with a read-only memoryview of the bytes of each range.
+    def read_memory_many(self, ranges):
+        # Accelerated memory interfaces can't defer block reads.
+        if self.read_memory_block32 != self._read_memory_block32:
+            return [memoryview(bytes(self.read_memory_block8(addr, size))) for addr, size in ranges]
+
+        pending = []
+        callbacks = []
+        for addr, size in ranges:
+            start = addr & ~0x3
+            end = (addr + size + 3) & ~0x3
+            data = memoryview(bytearray(end - start))
+            pos = 0
+            while start + pos < end:
+                n = min(end - start - pos, self.auto_increment_page_size - ((start + pos) & (self.auto_increment_page_size - 1)))
+                callbacks.append(self._read_block32(start + pos, n // 4, now=False, buffer=data[pos:pos + n]))
+                pos += n
+            pending.append((addr & 0x3, size, data))
+
+        for cb in callbacks:
+            cb()
+        return [data[offset:offset + size].toreadonly() for offset, size, data in pending]
 
     def _handle_error(self, error, num):
         self.dp._handle_error(error, num)
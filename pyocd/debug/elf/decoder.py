@@ -18,15 +18,37 @@ import sys
 import os
 from elftools.elf.elffile import ELFFile
 from elftools.dwarf.constants import DW_LNE_set_address
+from elftools.dwarf.ranges import BaseAddressEntry
 from intervaltree import IntervalTree
 from collections import namedtuple
 from itertools import islice
+from bisect import bisect_right
+from array import array
+import hashlib
+import json
 import logging
 
 FunctionInfo = namedtuple('FunctionInfo', 'name subprogram low_pc high_pc')
 LineInfo = namedtuple('LineInfo', 'cu filename dirname line')
 SymbolInfo = namedtuple('SymbolInfo', 'name address size type')
 
+# Compact per-CU lookup tables. Each is a set of parallel arrays sorted by (start, end) address.
+# maxends[i] is the largest end address of entries 0..i, so nested or overlapping entries can be
+# searched with a bisect.
+_FunctionTable = namedtuple('_FunctionTable', 'starts ends maxends names offsets')
+_LineTable = namedtuple('_LineTable', 'starts ends maxends lines files filetable')
+# Entries of every CU's tables of one kind, with the CU each came from. Only built once all of them
+# have been parsed, so that a lookup outside them all is a single bisect.
+_AddressIndex = namedtuple('_AddressIndex', 'starts ends maxends cus')
+
+def _running_max(values):
+    result = array('Q')
+    top = 0
+    for v in values:
+        top = max(top, v)
+        result.append(top)
+    return result
+
 class ElfSymbolDecoder(object):
     def __init__(self, elf):
         assert isinstance(elf, ELFFile)
@@ -101,7 +123,26 @@ class ElfSymbolDecoder(object):
 
 
 class DwarfAddressDecoder(object):
-    def __init__(self, elf):
+    """! @brief Maps addresses to functions and source lines using DWARF debug info.
+
+    Nothing beyond the compile unit address ranges is parsed at construction. The function and
+    line tables of a compile unit are built the first time it is searched, and are kept as
+    parallel sorted arrays so a lookup is a bisect rather than an interval tree search. The CU
+    ranges are only used to pick which CU to search first.
+
+    If a cache path is given, the tables built so far can be written to it with save_cache() and
+    are reloaded by later instances for the same (unmodified) ELF file. The cache is plain JSON
+    and is only used if its key matches the ELF's size, mtime and SHA-1 digest. The ELF is only
+    hashed when a cache with a matching size and mtime is found, or when the cache is written.
+    """
+
+    ## Bump whenever the layout of the cached tables changes.
+    CACHE_VERSION = 2
+
+    ## Number of addresses outside every table that are remembered.
+    MISS_CACHE_SIZE = 1024
+
+    def __init__(self, elf, cache_path=None):
         assert isinstance(elf, ELFFile)
         self.elffile = elf
 
@@ -110,35 +151,175 @@ class DwarfAddressDecoder(object):
 
         self.dwarfinfo = self.elffile.get_dwarf_info()
 
-        self.subprograms = None
-        self.function_tree = None
-        self.line_tree = None
-
-        # Build indices.
-        self._get_subprograms()
-        self._build_function_search_tree()
-        self._build_line_search_tree()
+        self._subprograms = None
+        self._cache_path = cache_path
+        self._cache_stat = self._get_cache_stat()
+        self._cache_key = None
+        self._cache_dirty = False
+
+        # Per-CU tables, keyed by CU offset.
+        self._line_tables = {}
+        self._function_tables = {}
+        self._line_index = None
+        self._function_index = None
+        self._line_misses = set()
+        self._function_misses = set()
+
+        if not self._load_cache():
+            self._build_cu_index()
+
+    @property
+    def subprograms(self):
+        if self._subprograms is None:
+            self._get_subprograms()
+        return self._subprograms
 
     def get_function_for_address(self, addr):
-        try:
-            return sorted(self.function_tree[addr])[0].data
-        except IndexError:
+        if addr in self._function_misses:
             return None
+        if self._function_index is None and len(self._function_tables) == len(self._all_cus):
+            self._function_index = self._build_index(self._function_tables)
+        for cu_offset in self._cu_offsets_for_address(addr, self._function_index):
+            table = self._function_tables.get(cu_offset)
+            if table is None:
+                table = self._build_function_table(cu_offset)
+            i = self._table_index(table, addr)
+            if i is not None:
+                cu = self.dwarfinfo.get_CU_at(cu_offset)
+                prog = self.dwarfinfo.get_DIE_from_refaddr(table.offsets[i], cu)
+                return FunctionInfo(name=table.names[i], subprogram=prog,
+                                    low_pc=table.starts[i], high_pc=table.ends[i])
+        self._add_miss(self._function_misses, addr)
+        return None
 
     def get_line_for_address(self, addr):
-        try:
-            return sorted(self.line_tree[addr])[0].data
-        except IndexError:
+        if addr in self._line_misses:
             return None
+        if self._line_index is None and len(self._line_tables) == len(self._all_cus):
+            self._line_index = self._build_index(self._line_tables)
+        for cu_offset in self._cu_offsets_for_address(addr, self._line_index):
+            table = self._line_tables.get(cu_offset)
+            if table is None:
+                table = self._build_line_table(cu_offset)
+            i = self._table_index(table, addr)
+            if i is not None:
+                filename, dirname = table.filetable[table.files[i]]
+                return LineInfo(cu=self.dwarfinfo.get_CU_at(cu_offset), filename=filename,
+                                dirname=dirname, line=table.lines[i])
+        self._add_miss(self._line_misses, addr)
+        return None
+
+    def _add_miss(self, misses, addr):
+        if len(misses) >= self.MISS_CACHE_SIZE:
+            misses.clear()
+        misses.add(addr)
+
+    @staticmethod
+    def _table_index(table, addr):
+        # The first entry whose running max end is past addr is the containing entry with the
+        # lowest (start, end), provided it starts at or before addr. This matches the outermost
+        # match the interval tree search used to return.
+        i = bisect_right(table.maxends, addr)
+        if i < len(table.starts) and table.starts[i] <= addr:
+            return i
+        return None
+
+    def _cu_offsets_for_address(self, addr, index=None):
+        hint = None
+        i = bisect_right(self._cu_starts, addr) - 1
+        if i >= 0 and addr < self._cu_ends[i]:
+            hint = self._cu_offsets[i]
+            yield hint
+        # Once every CU's table is built, the index says which CU, if any, has the address.
+        if index is not None:
+            i = self._table_index(index, addr)
+            if i is not None and index.cus[i] != hint:
+                yield index.cus[i]
+            return
+        # Some toolchains (armcc) emit CU ranges that do not cover all of the CU's code, so the
+        # remaining CUs still have to be searched. Each is only parsed once.
+        for cu_offset in self._all_cus:
+            if cu_offset != hint:
+                yield cu_offset
+
+    @staticmethod
+    def _build_index(tables):
+        entries = sorted((start, end, cu_offset) for cu_offset, table in tables.items()
+                         for start, end in zip(table.starts, table.ends))
+        return _AddressIndex(starts=array('Q', (e[0] for e in entries)),
+                             ends=array('Q', (e[1] for e in entries)),
+                             maxends=_running_max(e[1] for e in entries),
+                             cus=array('Q', (e[2] for e in entries)))
+
+    def _build_cu_index(self):
+        ranges = []
+        self._all_cus = []
+
+        aranges = self.dwarfinfo.get_aranges()
+        if aranges is not None:
+            for entry in aranges.entries:
+                if entry.begin_addr != 0 and entry.length != 0:
+                    ranges.append((entry.begin_addr, entry.begin_addr + entry.length, entry.info_offset))
+            covered = set(r[2] for r in ranges)
+        else:
+            covered = set()
+
+        for cu in self.dwarfinfo.iter_CUs():
+            self._all_cus.append(cu.cu_offset)
+            if cu.cu_offset in covered:
+                continue
+            try:
+                ranges.extend((low, high, cu.cu_offset) for low, high in self._get_cu_ranges(cu))
+            except Exception as e:
+                logging.debug("Failed to get address ranges of CU at 0x%x: %s", cu.cu_offset, e)
+
+        ranges.sort()
+        self._cu_starts = array('Q', (r[0] for r in ranges))
+        self._cu_ends = array('Q', (r[1] for r in ranges))
+        self._cu_offsets = array('Q', (r[2] for r in ranges))
+        self._cache_dirty = True
+
+    def _get_cu_ranges(self, cu):
+        top = cu.get_top_DIE()
+        attrs = top.attributes
+
+        low_pc = attrs['DW_AT_low_pc'].value if 'DW_AT_low_pc' in attrs else 0
+        if 'DW_AT_high_pc' in attrs:
+            high_pc = attrs['DW_AT_high_pc'].value
+            if attrs['DW_AT_high_pc'].form != 'DW_FORM_addr':
+                high_pc = low_pc + high_pc
+            return [(low_pc, high_pc)] if low_pc != 0 else []
+
+        if 'DW_AT_ranges' in attrs:
+            result = []
+            base = low_pc
+            rangelists = self.dwarfinfo.range_lists()
+            for entry in rangelists.get_range_list_at_offset(attrs['DW_AT_ranges'].value, cu=cu):
+                if isinstance(entry, BaseAddressEntry):
+                    base = entry.base_address
+                    continue
+                if getattr(entry, 'is_absolute', False):
+                    low, high = entry.begin_offset, entry.end_offset
+                else:
+                    low, high = base + entry.begin_offset, base + entry.end_offset
+                # Skip ranges excluded from the link.
+                if low != 0 and high > low:
+                    result.append((low, high))
+            return result
+
+        return []
 
     def _get_subprograms(self):
-        self.subprograms = []
+        self._subprograms = []
         for CU in self.dwarfinfo.iter_CUs():
-            self.subprograms.extend([d for d in CU.iter_DIEs() if d.tag == 'DW_TAG_subprogram'])
+            self._subprograms.extend([d for d in CU.iter_DIEs() if d.tag == 'DW_TAG_subprogram'])
 
-    def _build_function_search_tree(self):
-        self.function_tree = IntervalTree()
-        for prog in self.subprograms:
+    def _build_function_table(self, cu_offset):
+        entries = []
+        cu = self.dwarfinfo.get_CU_at(cu_offset)
+        for prog in cu.iter_DIEs():
+            if prog.tag != 'DW_TAG_subprogram':
+                continue
             try:
                 name = prog.attributes['DW_AT_name'].value
                 low_pc = prog.attributes['DW_AT_low_pc'].value
@@ -153,62 +334,208 @@ class DwarfAddressDecoder(object):
                 if prog.attributes['DW_AT_high_pc'].form != 'DW_FORM_addr':
                     high_pc = low_pc + high_pc
 
-                fninfo = FunctionInfo(name=name, subprogram=prog, low_pc=low_pc, high_pc=high_pc)
-
-                self.function_tree.addi(low_pc, high_pc, fninfo)
+                entries.append((low_pc, high_pc, name, prog.offset))
             except KeyError:
                 pass
 
-    def _build_line_search_tree(self):
-        self.line_tree = IntervalTree()
-        for cu in self.dwarfinfo.iter_CUs():
-            lineprog = self.dwarfinfo.line_program_for_CU(cu)
-            prevstate = None
-            skipThisSequence = False
-            for entry in lineprog.get_entries():
-                # Look for a DW_LNE_set_address command with a 0 address. This indicates
-                # code that is not actually included in the link.
-                #
-                # TODO: find a better way to determine the code is really not present and
-                #       doesn't have a real address of 0
-                if entry.is_extended and entry.command == DW_LNE_set_address \
-                        and len(entry.args) == 1 and entry.args[0] == 0:
-                    skipThisSequence = True
-
-                # We're interested in those entries where a new state is assigned
-                if entry.state is None:
-                    continue
+        entries.sort(key=lambda e: (e[0], e[1]))
+        table = _FunctionTable(starts=array('Q', (e[0] for e in entries)),
+                               ends=array('Q', (e[1] for e in entries)),
+                               maxends=_running_max(e[1] for e in entries),
+                               names=[e[2] for e in entries],
+                               offsets=array('Q', (e[3] for e in entries)))
+        self._function_tables[cu_offset] = table
+        self._cache_dirty = True
+        return table
+
+    def _build_line_table(self, cu_offset):
+        entries = []
+        filetable = []
+        fileindex = {}
+        cu = self.dwarfinfo.get_CU_at(cu_offset)
+        lineprog = self.dwarfinfo.line_program_for_CU(cu)
+        if lineprog is None:
+            self._line_tables[cu_offset] = _LineTable(array('Q'), array('Q'), array('Q'), array('L'), array('L'), [])
+            return self._line_tables[cu_offset]
+
+        prevstate = None
+        skipThisSequence = False
+        for entry in lineprog.get_entries():
+            # Look for a DW_LNE_set_address command with a 0 address. This indicates
+            # code that is not actually included in the link.
+            #
+            # TODO: find a better way to determine the code is really not present and
+            #       doesn't have a real address of 0
+            if entry.is_extended and entry.command == DW_LNE_set_address \
+                    and len(entry.args) == 1 and entry.args[0] == 0:
+                skipThisSequence = True
+
+            # We're interested in those entries where a new state is assigned
+            if entry.state is None:
+                continue
 
-                # Looking for a range of addresses in two consecutive states.
-                if prevstate and not skipThisSequence:
+            # Looking for a range of addresses in two consecutive states.
+            if prevstate and not skipThisSequence:
+                try:
+                    fileinfo = lineprog['file_entry'][prevstate.file - 1]
+                    filename = fileinfo.name
                     try:
-                        fileinfo = lineprog['file_entry'][prevstate.file - 1]
-                        filename = fileinfo.name
-                        try:
-                            dirname = lineprog['include_directory'][fileinfo.dir_index - 1]
-                        except IndexError:
-                            dirname = ""
+                        dirname = lineprog['include_directory'][fileinfo.dir_index - 1]
                     except IndexError:
-                        filename = ""
                         dirname = ""
-                    info = LineInfo(cu=cu, filename=filename, dirname=dirname, line=prevstate.line)
-                    fromAddr = prevstate.address
-                    toAddr = entry.state.address
-                    try:
-                        if fromAddr != 0 and toAddr != 0:
-                            if fromAddr == toAddr:
-                                toAddr += 1
-                            self.line_tree.addi(fromAddr, toAddr, info)
-                    except:
-                        logging.debug("Problematic lineprog:")
-                        self._dump_lineprog(lineprog)
-                        raise
-
-                if entry.state.end_sequence:
-                    prevstate = None
-                    skipThisSequence = False
-                else:
-                    prevstate = entry.state
+                except IndexError:
+                    filename = ""
+                    dirname = ""
+                fromAddr = prevstate.address
+                toAddr = entry.state.address
+                if fromAddr != 0 and toAddr != 0:
+                    if fromAddr == toAddr:
+                        toAddr += 1
+                    key = (filename, dirname)
+                    if key not in fileindex:
+                        fileindex[key] = len(filetable)
+                        filetable.append(key)
+                    entries.append((fromAddr, toAddr, prevstate.line, fileindex[key]))
+
+            if entry.state.end_sequence:
+                prevstate = None
+                skipThisSequence = False
+            else:
+                prevstate = entry.state
+
+        entries.sort()
+        table = _LineTable(starts=array('Q', (e[0] for e in entries)),
+                           ends=array('Q', (e[1] for e in entries)),
+                           maxends=_running_max(e[1] for e in entries),
+                           lines=array('L', (e[2] for e in entries)),
+                           files=array('L', (e[3] for e in entries)),
+                           filetable=filetable)
+        self._line_tables[cu_offset] = table
+        self._cache_dirty = True
+        return table
+
+    def _get_cache_stat(self):
+        if self._cache_path is None:
+            return None
+        try:
+            st = os.fstat(self.elffile.stream.fileno())
+        except (AttributeError, OSError, ValueError):
+            return None
+        return [self.CACHE_VERSION, st.st_size, st.st_mtime_ns]
+
+    def _get_cache_key(self):
+        # Hashing reads the whole ELF, so it is done at most once and only when needed.
+        if self._cache_key is None and self._cache_stat is not None:
+            stream = self.elffile.stream
+            try:
+                pos = stream.tell()
+                digest = hashlib.sha1()
+                stream.seek(0)
+                for chunk in iter(lambda: stream.read(1 << 20), b''):
+                    digest.update(chunk)
+                stream.seek(pos)
+            except (AttributeError, OSError, ValueError):
+                self._cache_stat = None
+                return None
+            self._cache_key = self._cache_stat + [digest.hexdigest()]
+        return self._cache_key
+
+    # DWARF names are bytes, but fall back to str where an entry is missing, so the type is
+    # kept in the cache.
+    @staticmethod
+    def _encode_name(name):
+        if isinstance(name, bytes):
+            return 'b' + name.decode('latin-1')
+        return 's' + name
+
+    @staticmethod
+    def _decode_name(name):
+        if name[0] == 'b':
+            return name[1:].encode('latin-1')
+        return name[1:]
+
+    def _load_cache(self):
+        if self._cache_stat is None or not os.path.exists(self._cache_path):
+            return False
+        try:
+            with open(self._cache_path, 'r') as f:
+                cache = json.load(f)
+            if cache['key'][:3] != self._cache_stat or cache['key'] != self._get_cache_key():
+                return False
+            decode = self._decode_name
+            cus = cache['cus']
+            cu_starts = array('Q', cus['starts'])
+            cu_ends = array('Q', cus['ends'])
+            cu_offsets = array('Q', cus['offsets'])
+            all_cus = list(cus['all'])
+            line_tables = {}
+            for offset, t in cache['lines'].items():
+                table = _LineTable(starts=array('Q', t['starts']),
+                                   ends=array('Q', t['ends']),
+                                   maxends=_running_max(t['ends']),
+                                   lines=array('L', t['lines']),
+                                   files=array('L', t['files']),
+                                   filetable=[(decode(f), decode(d)) for f, d in t['filetable']])
+                if not (len(table.starts) == len(table.ends) == len(table.lines) == len(table.files)) \
+                        or any(i >= len(table.filetable) for i in table.files):
+                    raise ValueError("malformed line table for CU at 0x%x" % int(offset))
+                line_tables[int(offset)] = table
+            function_tables = {}
+            for offset, t in cache['functions'].items():
+                table = _FunctionTable(starts=array('Q', t['starts']),
+                                       ends=array('Q', t['ends']),
+                                       maxends=_running_max(t['ends']),
+                                       names=[decode(n) for n in t['names']],
+                                       offsets=array('Q', t['offsets']))
+                if not (len(table.starts) == len(table.ends) == len(table.names) == len(table.offsets)):
+                    raise ValueError("malformed function table for CU at 0x%x" % int(offset))
+                function_tables[int(offset)] = table
+            if not (len(cu_starts) == len(cu_ends) == len(cu_offsets)):
+                raise ValueError("malformed CU index")
+        except Exception as e:
+            logging.debug("Not using DWARF cache %s: %s", self._cache_path, e)
+            return False
+        self._cu_starts, self._cu_ends, self._cu_offsets = cu_starts, cu_ends, cu_offsets
+        self._all_cus = all_cus
+        self._line_tables = line_tables
+        self._function_tables = function_tables
+        return True
+
+    ## @brief Write the tables built so far to the cache file, if one was given.
+    def save_cache(self):
+        if not self._cache_dirty or self._get_cache_key() is None:
+            return
+        encode = self._encode_name
+        cache = {
+            'key': self._cache_key,
+            'cus': {
+                'starts': self._cu_starts.tolist(),
+                'ends': self._cu_ends.tolist(),
+                'offsets': self._cu_offsets.tolist(),
+                'all': self._all_cus,
+                },
+            'lines': dict((str(offset), {
+                'starts': t.starts.tolist(),
+                'ends': t.ends.tolist(),
+                'lines': t.lines.tolist(),
+                'files': t.files.tolist(),
+                'filetable': [(encode(f), encode(d)) for f, d in t.filetable],
+                }) for offset, t in self._line_tables.items()),
+            'functions': dict((str(offset), {
+                'starts': t.starts.tolist(),
+                'ends': t.ends.tolist(),
+                'names': [encode(n) for n in t.names],
+                'offsets': t.offsets.tolist(),
+                }) for offset, t in self._function_tables.items()),
+            }
+        tmp_path = self._cache_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(cache, f, separators=(',', ':'))
+            os.replace(tmp_path, self._cache_path)
+            self._cache_dirty = False
+        except Exception as e:
+            logging.debug("Failed to write DWARF cache %s: %s", self._cache_path, e)
 
     def _dump_lineprog(self, lineprog):
         for i, e in enumerate(lineprog.get_entries()):
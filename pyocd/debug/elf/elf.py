@@ -18,6 +18,9 @@ from ...core.memory_map import (MemoryRange, MemoryMap)
 from .decoder import (ElfSymbolDecoder, DwarfAddressDecoder)
 from elftools.elf.elffile import ELFFile
 from elftools.elf.constants import SH_FLAGS
+from bisect import bisect_right
+import io
+import mmap
 import logging
 import six
 
@@ -31,8 +34,9 @@ import six
 # accessible via the instance's _region_ attribute. Otherwise _region_ will be `None`. A maximum of
 # one associated memory region is supported, even if the section spans multiple regions.
 #
-# The contents of the ELF section can be read via the `data` property as a `bytearray`. The data is
-# read from the file only once and cached.
+# The contents of the ELF section can be read via the `data` property. For sections with file
+# contents this is a read-only `memoryview` into the ELF file's mapping, so slicing it does not
+# copy. `SHT_NOBITS` sections have no file contents and yield an empty `bytearray`.
 class ELFSection(MemoryRange):
     def __init__(self, elf, sect):
         self._elf = elf
@@ -63,7 +67,11 @@ class ELFSection(MemoryRange):
     @property
     def data(self):
         if self._data is None:
-            self._data = bytearray(self._section.data())
+            if self.type == 'SHT_NOBITS':
+                self._data = bytearray(self._section.data())
+            else:
+                offset = self._section['sh_offset']
+                self._data = self._elf._image[offset:offset + self.length]
         return self._data
 
     @property
@@ -115,14 +123,28 @@ class ELFBinaryFile(object):
         self._symbol_decoder = None
         self._address_decoder = None
 
+        self._map_file()
         self._extract_sections()
         self._compute_regions()
+        self._build_segment_index()
 
     ## @brief Close the ELF file if it is owned by this instance.
     def __del__(self):
         if self._owns_file:
             self.close()
 
+    ## @brief Map the whole file so section and segment data can be sliced without copying.
+    #
+    # Streams that cannot be mapped (e.g. BytesIO) are read into memory once instead.
+    def _map_file(self):
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._image = memoryview(self._mmap)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            self._mmap = None
+            self._file.seek(0)
+            self._image = memoryview(self._file.read())
+
     def _extract_sections(self):
         # Get list of interesting sections.
         self._sections = []
@@ -172,7 +194,29 @@ class ELFBinaryFile(object):
         self._used = used
         self._unused = unused
 
+    ## @brief Build the sorted lookup index of loadable segments used by read().
+    def _build_segment_index(self):
+        segments = []
+        for segment in self._elf.iter_segments():
+            seg_size = min(segment["p_memsz"], segment["p_filesz"])
+            if seg_size == 0:
+                continue
+            offset = segment["p_offset"]
+            segments.append((segment["p_paddr"], seg_size, self._image[offset:offset + seg_size]))
+        segments.sort(key=lambda x: x[0])
+        self._segment_starts = [seg[0] for seg in segments]
+        self._segments = segments
+
     def close(self):
+        if self._address_decoder is not None:
+            self._address_decoder.save_cache()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Section or segment views are still referenced by a caller; the mapping is
+                # released once the last of them is dropped.
+                pass
         self._file.close()
         self._owns_file = False
 
@@ -181,22 +225,17 @@ class ELFBinaryFile(object):
 
         @param addr Physical address (load address) to read from.
         @param size Number of bytes to read.
-        @return Requested data or None if address is unmapped.
+        @return Read-only memoryview of the requested data, or None if the range is not fully
+            contained in one segment.
         """
-        for segment in self._elf.iter_segments():
-            seg_addr = segment["p_paddr"]
-            seg_size = min(segment["p_memsz"], segment["p_filesz"])
-            if addr >= seg_addr + seg_size:
-                continue
-            if addr + size <= seg_addr:
-                continue
-            # There is at least some overlap
-
-            if addr >= seg_addr and addr + size <= seg_addr + seg_size:
-                # Region is fully contained
-                data = segment.data()
-                start = addr - seg_addr
-                return data[start:start + size]
+        i = bisect_right(self._segment_starts, addr) - 1
+        if i < 0:
+            return None
+        seg_addr, seg_size, data = self._segments[i]
+        if addr + size > seg_addr + seg_size:
+            return None
+        start = addr - seg_addr
+        return data[start:start + size]
 
     ##
     # @brief Access the list of sections in the ELF file.
@@ -228,8 +267,15 @@ class ELFBinaryFile(object):
     @property
     def address_decoder(self):
         if self._address_decoder is None:
-            self._address_decoder = DwarfAddressDecoder(self._elf)
+            self._address_decoder = DwarfAddressDecoder(self._elf, self._dwarf_cache_path())
         return self._address_decoder
 
+    ## @brief Path of the DWARF index cache kept next to the ELF file, or None for unnamed streams.
+    def _dwarf_cache_path(self):
+        path = getattr(self._file, 'name', None)
+        if not isinstance(path, six.string_types):
+            return None
+        return path + '.dwarfcache'
+
 
 
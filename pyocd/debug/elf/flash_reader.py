@@ -17,10 +17,16 @@
 from ..context import DebugContext
 from ...utility import conversion
 import logging
-from intervaltree import (Interval, IntervalTree)
+import struct
+from bisect import bisect_right
 
 ## @brief Reads flash memory regions from an ELF file instead of the target.
+#
+# Section data is a memoryview into the mapped ELF file, so block reads that hit a flash section
+# are returned as memoryview slices without copying.
 class FlashReaderContext(DebugContext):
+    _UNPACK = {8: struct.Struct('<B'), 16: struct.Struct('<H'), 32: struct.Struct('<I')}
+
     def __init__(self, parentContext, elf):
         super(FlashReaderContext, self).__init__(parentContext.core)
         self._parent = parentContext
@@ -30,50 +36,56 @@ class FlashReaderContext(DebugContext):
         self._build_regions()
 
     def _build_regions(self):
-        self._tree = IntervalTree()
+        # Flash sections never overlap, so a list sorted by start address is enough to find the
+        # one containing an address with a bisect.
+        self._sections = []
         for sect in [s for s in self._elf.sections if (s.region and s.region.is_flash)]:
-            start = sect.start
-            length = sect.length
-            sect.data # Go ahead and read the data from the file.
-            self._tree.addi(start, start + length, sect)
-            self._log.debug("created flash section [%x:%x] for section %s", start, start + length, sect.name)
+            if sect.length == 0:
+                continue
+            sect.data # Go ahead and map the data from the file.
+            self._sections.append(sect)
+            self._log.debug("created flash section [%x:%x] for section %s", sect.start, sect.start + sect.length, sect.name)
+        self._sections.sort(key=lambda s: s.start)
+        self._starts = [s.start for s in self._sections]
+
+    ## @brief Return the flash section wholly containing [addr, addr+length), or None.
+    def _find_section(self, addr, length):
+        i = bisect_right(self._starts, addr) - 1
+        if i < 0:
+            return None
+        section = self._sections[i]
+        if addr + length > section.start + section.length:
+            return None
+        return section
 
     def read_memory(self, addr, transfer_size=32, now=True):
         length = transfer_size // 8
-        matches = self._tree.overlap(addr, addr + length)
-        # Must match only one interval (ELF section).
-        if len(matches) != 1:
+        section = self._find_section(addr, length)
+        if section is None:
             return self._parent.read_memory(addr, transfer_size, now)
-        section = matches.pop().data
-        addr -= section.start
+        if transfer_size not in self._UNPACK:
+            raise ValueError("invalid transfer_size (%d)" % transfer_size)
+        offset = addr - section.start
 
         def read_memory_cb():
-            self._log.debug("read flash data [%x:%x] from section %s", section.start + addr, section.start + addr  + length, section.name)
-            data = section.data[addr:addr + length]
-            if transfer_size == 8:
-                return data[0]
-            elif transfer_size == 16:
-                return conversion.byte_list_to_u16le_list(data)[0]
-            elif transfer_size == 32:
-                return conversion.byte_list_to_u32le_list(data)[0]
-            else:
-                raise ValueError("invalid transfer_size (%d)" % transfer_size)
+            self._log.debug("read flash data [%x:%x] from section %s", addr, addr + length, section.name)
+            return self._UNPACK[transfer_size].unpack_from(section.data, offset)[0]
 
         if now:
             return read_memory_cb()
         else:
             return read_memory_cb
 
+    ## @brief Read a block of bytes.
+    #
+    # Reads served from the ELF return a read-only memoryview rather than a list.
     def read_memory_block8(self, addr, size):
-        matches = self._tree.overlap(addr, addr + size)
-        # Must match only one interval (ELF section).
-        if len(matches) != 1:
+        section = self._find_section(addr, size)
+        if section is None:
             return self._parent.read_memory_block8(addr, size)
-        section = matches.pop().data
-        addr -= section.start
-        data = section.data[addr:addr + size]
-        self._log.debug("read flash data [%x:%x]", section.start + addr, section.start + addr  + size)
-        return list(data)
+        offset = addr - section.start
+        self._log.debug("read flash data [%x:%x]", addr, addr + size)
+        return section.data[offset:offset + size]
 
     def read_memory_block32(self, addr, size):
         return conversion.byte_list_to_u32le_list(self.read_memory_block8(addr, size))
@@ -319,7 +319,7 @@ class CMSISDAPProbe(DebugProbe):
 
         return True
 
-    def read_ap_multiple(self, addr, count=1, now=True):
+    def read_ap_multiple(self, addr, count=1, now=True, buffer=None):
         assert type(addr) in (six.integer_types)
         ap_reg = self.REG_ADDR_TO_ID_MAP[self.AP, (addr & self.A32)]
         
@@ -327,7 +327,7 @@ class CMSISDAPProbe(DebugProbe):
             # Select the AP and bank.
             self.write_dp(self.DP_SELECT, addr & self.APSEL_APBANKSEL)
             
-            result = self._link.reg_read_repeat(count, ap_reg, dap_index=0, now=now)
+            result = self._link.reg_read_repeat(count, ap_reg, dap_index=0, now=now, buffer=buffer)
         except DAPAccess.Error as exc:
             self._invalidate_cached_registers()
             six.raise_from(self._convert_exception(exc), exc)
@@ -132,7 +132,11 @@ class DebugProbe(object):
     def write_ap(self, addr, data):
         raise NotImplementedError()
 
-    def read_ap_multiple(self, addr, count=1, now=True):
+    ## @brief Read an AP register count times.
+    #
+    # If _buffer_ is given it must be a writable buffer of count * 4 bytes. The words are
+    # stored in it, little endian, and it is returned in place of a list of words.
+    def read_ap_multiple(self, addr, count=1, now=True, buffer=None):
         raise NotImplementedError()
 
     def write_ap_multiple(self, addr, values):
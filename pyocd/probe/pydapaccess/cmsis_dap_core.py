@@ -509,3 +509,27 @@ class CMSISDAPProtocol(object):
             raise DAPAccessIntf.DeviceError()
 
         return resp[1:]
+
+    def execute_commands(self, commands=()):
+        """! @brief Run a list of raw commands with DAP_ExecuteCommands.
+
+        An empty list is used to test whether the firmware implements the
+        command. Returns the concatenated responses, or None if the probe
+        answered with DAP_Invalid.
+        """
+        cmd = []
+        cmd.append(Command.DAP_EXECUTE_COMMANDS)
+        cmd.append(len(commands))
+        for command in commands:
+            cmd.extend(command)
+        self.interface.write(cmd)
+
+        resp = self.interface.read()
+        if resp[0] != Command.DAP_EXECUTE_COMMANDS:
+            # Older firmware replies with DAP_Invalid (0xFF)
+            return None
+
+        if resp[1] != len(commands):
+            raise DAPAccessIntf.CommandError()
+
+        return resp[2:]
@@ -15,6 +15,7 @@
 # limitations under the License.
 
 
+import asyncio
 from enum import Enum
 
 
@@ -235,6 +236,28 @@ class DAPAccessIntf(object):
         """Write one or more words to the same DP or AP register"""
         raise NotImplementedError()
 
-    def reg_read_repeat(self, num_repeats, reg_id, dap_index=0, now=True):
-        """Read one or more words from the same DP or AP register"""
+    def reg_read_repeat(self, num_repeats, reg_id, dap_index=0, now=True, buffer=None):
+        """Read one or more words from the same DP or AP register
+
+        If buffer is given the words are stored in it little endian, in place
+        of being returned as a list, and the buffer is returned instead.
+        """
+        raise NotImplementedError()
+
+    def read_reg_async(self, reg_id, dap_index=0):
+        """Start a read of a DP or AP register and return a concurrent.futures.Future
+        for its value. Completion does not depend on the caller forcing the read."""
         raise NotImplementedError()
+
+    def reg_read_repeat_async(self, num_repeats, reg_id, dap_index=0):
+        """Start reading one or more words from the same DP or AP register and
+        return a concurrent.futures.Future for the list of values."""
+        raise NotImplementedError()
+
+    def aread_reg(self, reg_id, dap_index=0):
+        """Awaitable form of read_reg_async for use from an asyncio event loop"""
+        return asyncio.wrap_future(self.read_reg_async(reg_id, dap_index))
+
+    def areg_read_repeat(self, num_repeats, reg_id, dap_index=0):
+        """Awaitable form of reg_read_repeat_async for use from an asyncio event loop"""
+        return asyncio.wrap_future(self.reg_read_repeat_async(num_repeats, reg_id, dap_index))
@@ -19,12 +19,15 @@ import re
 import logging
 import time
 import collections
+import struct
+import threading
+import concurrent.futures
 import six
 from .dap_settings import DAPSettings
 from .dap_access_api import DAPAccessIntf
 from .cmsis_dap_core import CMSISDAPProtocol
 from .interface import (INTERFACE, USB_BACKEND, USB_BACKEND_V2)
-from .cmsis_dap_core import (Command, Pin, Capabilities, DAP_TRANSFER_OK,
+from .cmsis_dap_core import (Command, Pin, Capabilities, DAP_OK, DAP_TRANSFER_OK,
                              DAP_TRANSFER_FAULT, DAP_TRANSFER_WAIT,
                              DAPSWOTransport, DAPSWOMode, DAPSWOControl,
                              DAPSWOStatus)
@@ -47,6 +50,28 @@ class SWOStatus:
 # Set to True to enable logging of packet filling logic.
 LOG_PACKET_BUILDS = False
 
+# Precompiled packet layouts used by _Command.
+_TRANSFER_HEADER = struct.Struct('<BBB')
+_TRANSFER_BLOCK_HEADER = struct.Struct('<BBHB')
+_TRANSFER_WRITE = struct.Struct('<BI')
+_TRANSFER_BLOCK_RESPONSE = struct.Struct('<BHB')
+
+# DAP_ExecuteCommands/DAP_QueueCommands header: command ID and command count.
+_BATCH_HEADER = 2
+# Don't start another command in a packet with less room than this
+# (a DAP_Transfer with one write, or a DAP_TransferBlock with one read).
+_BATCH_MIN_COMMAND = 8
+# Runs of at least this many writes to one register are moved into their
+# own DAP_TransferBlock, which needs 4 bytes per word instead of 5.
+_BATCH_MIN_BLOCK_WRITE = 8
+
+def _locked(func):
+    """Serialize a DAPAccessCMSISDAP method with other callers and the I/O thread"""
+    def wrapper(self, *args, **kwargs):
+        with self._lock, self._io_cond:
+            return func(self, *args, **kwargs)
+    return wrapper
+
 def _get_interfaces():
     """Get the connected USB devices"""
     # Get CMSIS-DAPv1 interfaces.
@@ -79,7 +104,7 @@ class _Transfer(object):
     """
 
     def __init__(self, daplink, dap_index, transfer_count,
-                 transfer_request, transfer_data):
+                 transfer_request, transfer_data, buffer=None):
         # Writes should not need a transfer object
         # since they don't have any response data
         assert isinstance(dap_index, six.integer_types)
@@ -94,8 +119,50 @@ class _Transfer(object):
         self._size_bytes = 0
         if transfer_request & READ:
             self._size_bytes = transfer_count * 4
+        # Response data is copied straight out of each packet into this
+        # buffer, so a transfer spanning several packets is assembled
+        # without any intermediate concatenation.  A caller supplied
+        # buffer is filled in place and becomes the result.
+        if buffer is None:
+            self._buf = bytearray(self._size_bytes)
+            self._external = False
+        else:
+            assert len(buffer) == self._size_bytes
+            self._buf = buffer
+            self._external = True
+        self._filled = 0
         self._result = None
         self._error = None
+        self._future = None
+        self._single = False
+
+    def set_future(self, future, single=False):
+        """
+        Complete future with the result of this transfer
+
+        The future is resolved by the transfer I/O thread, so the
+        caller never has to force the read itself.  With single set
+        the future's value is the one word read, not a list.
+        """
+        self._future = future
+        self._single = single
+        # Adding the transfer may have waited for a free slot, during
+        # which the I/O thread can already have completed it.
+        if self._result is not None or self._error is not None:
+            self.daplink._resolved.append(self)
+
+    def resolve(self):
+        """
+        Pass the result or error of a completed transfer to its future
+        """
+        if self._future is None or self._future.done():
+            return
+        if self._error is not None:
+            self._future.set_exception(self._error)
+        elif self._single:
+            self._future.set_result(self._result[0])
+        else:
+            self._future.set_result(self._result)
 
     def get_data_size(self):
         """
@@ -107,16 +174,21 @@ class _Transfer(object):
         """
         Add data read from the remote device to this object.
 
-        The size of data added must match exactly the size
-        that get_data_size returns.
+        Data may arrive in several pieces; the number of bytes
+        consumed from data is returned.  Once get_data_size bytes
+        have been added the result is decoded.
         """
-        assert len(data) == self._size_bytes
-        result = []
-        for i in range(0, self._size_bytes, 4):
-            word = ((data[0 + i] << 0) | (data[1 + i] << 8) |
-                    (data[2 + i] << 16) | (data[3 + i] << 24))
-            result.append(word)
-        self._result = result
+        size = min(len(data), self._size_bytes - self._filled)
+        self._buf[self._filled:self._filled + size] = data[:size]
+        self._filled += size
+        if self._filled == self._size_bytes:
+            if self._external:
+                self._result = self._buf
+            else:
+                self._result = list(struct.unpack_from('<%dI' % self.transfer_count, self._buf))
+            if self._future is not None:
+                self.daplink._resolved.append(self)
+        return size
 
     def add_error(self, error):
         """
@@ -124,17 +196,20 @@ class _Transfer(object):
         """
         assert isinstance(error, Exception)
         self._error = error
+        if self._future is not None:
+            self.daplink._resolved.append(self)
 
     def get_result(self):
         """
         Get the result of this transfer.
         """
-        while self._result is None:
-            if len(self.daplink._commands_to_read) > 0:
-                self.daplink._read_packet()
-            else:
-                assert not self.daplink._crnt_cmd.get_empty()
-                self.daplink.flush()
+        with self.daplink._lock, self.daplink._io_cond:
+            while self._result is None and self._error is None:
+                if len(self.daplink._commands_to_read) > 0:
+                    self.daplink._wait_packet()
+                else:
+                    assert self.daplink._batch or not self.daplink._crnt_cmd.get_empty()
+                    self.daplink.flush()
 
         if self._error is not None:
             # Pylint is confused and thinks self._error is None
@@ -157,10 +232,14 @@ class _Command(object):
     decides if it is more efficient to use DAP_Transfer or DAP_TransferBlock.
     The payload to send over the layer below is constructed with
     encode_data.  The response to the command is decoded with decode_data.
+
+    When several commands share a packet through DAP_ExecuteCommands the
+    request and response budgets differ, so they are tracked separately.
     """
 
-    def __init__(self, size):
+    def __init__(self, size, response_size=None):
         self._size = size
+        self._response_size = size if response_size is None else response_size
         self._read_count = 0
         self._write_count = 0
         self._block_allowed = True
@@ -187,7 +266,7 @@ class _Command(object):
             #   BYTE | SHORT *********| BYTE *************| WORD *********|
             # < 0x06 | Transfer Count | Transfer Response | Transfer Data |
             #  ******|****************|*******************|+++++++++++++++|
-            recv = self._size - 4 - 4 * self._read_count
+            recv = self._response_size - 4 - 4 * self._read_count
 
             if isRead:
                 return recv // 4
@@ -204,7 +283,7 @@ class _Command(object):
             #   BYTE | BYTE **********| BYTE *************| WORD *********|
             # < 0x05 | Transfer Count | Transfer Response | Transfer Data |
             #  ******|****************|*******************|+++++++++++++++|
-            recv = self._size - 3 - 4 * self._read_count
+            recv = self._response_size - 3 - 4 * self._read_count
 
             if isRead:
                 # 1 request byte in request packet, 4 data bytes in response packet
@@ -257,6 +336,28 @@ class _Command(object):
         """
         return len(self._data) == 0
 
+    def get_block_allowed(self, request):
+        """
+        Return True if request could still be sent with DAP_TransferBlock
+        """
+        return self._block_allowed and self._block_request in (None, request)
+
+    def get_request_size(self):
+        """
+        Return the number of bytes encode_data will produce
+        """
+        if self._block_allowed:
+            return 5 + 4 * self._write_count
+        return 3 + self._read_count + 5 * self._write_count
+
+    def get_response_size(self):
+        """
+        Return the number of bytes in a successful response
+        """
+        if self._block_allowed:
+            return 4 + 4 * self._read_count
+        return 3 + 4 * self._read_count
+
     def add(self, count, request, data, dap_index):
         """
         Add a single or block register transfer operation to this command
@@ -282,39 +383,27 @@ class _Command(object):
             self._logger.debug("add(%d, %02x:%s) -> [wc=%d, rc=%d, ba=%d]" %
                 (count, request, 'r' if (request & READ) else 'w', self._write_count, self._read_count, self._block_allowed))
 
-    def _encode_transfer_data(self):
+    def _encode_transfer_data(self, buf, pos):
         """
         Encode this command into a byte array that can be sent
 
-        The data returned by this function is a bytearray in
-        the format that of a DAP_Transfer CMSIS-DAP command.
+        The command is written to buf at pos in the format
+        of a DAP_Transfer CMSIS-DAP command.
         """
         assert self.get_empty() is False
-        buf = bytearray(self._size)
         transfer_count = self._read_count + self._write_count
-        pos = 0
-        buf[pos] = Command.DAP_TRANSFER
-        pos += 1
-        buf[pos] = self._dap_index
-        pos += 1
-        buf[pos] = transfer_count
-        pos += 1
+        _TRANSFER_HEADER.pack_into(buf, pos, Command.DAP_TRANSFER,
+                                   self._dap_index, transfer_count)
+        pos += _TRANSFER_HEADER.size
         for count, request, write_list in self._data:
             assert write_list is None or len(write_list) <= count
-            write_pos = 0
-            for _ in range(count):
-                buf[pos] = request
-                pos += 1
-                if not request & READ:
-                    buf[pos] = (write_list[write_pos] >> (8 * 0)) & 0xff
-                    pos += 1
-                    buf[pos] = (write_list[write_pos] >> (8 * 1)) & 0xff
-                    pos += 1
-                    buf[pos] = (write_list[write_pos] >> (8 * 2)) & 0xff
-                    pos += 1
-                    buf[pos] = (write_list[write_pos] >> (8 * 3)) & 0xff
-                    pos += 1
-                    write_pos += 1
+            if request & READ:
+                buf[pos:pos + count] = bytes((request,)) * count
+                pos += count
+            else:
+                for value in write_list:
+                    _TRANSFER_WRITE.pack_into(buf, pos, request, value)
+                    pos += _TRANSFER_WRITE.size
         return buf
 
     def _decode_transfer_data(self, data):
@@ -341,46 +430,29 @@ class _Command(object):
         if data[1] != self._read_count + self._write_count:
             raise DAPAccessIntf.TransferError()
 
-        return data[3:3 + 4 * self._read_count]
+        return memoryview(data)[3:3 + 4 * self._read_count]
 
-    def _encode_transfer_block_data(self):
+    def _encode_transfer_block_data(self, buf, pos):
         """
         Encode this command into a byte array that can be sent
 
-        The data returned by this function is a bytearray in
-        the format that of a DAP_TransferBlock CMSIS-DAP command.
+        The command is written to buf at pos in the format
+        of a DAP_TransferBlock CMSIS-DAP command.
         """
         assert self.get_empty() is False
-        buf = bytearray(self._size)
         transfer_count = self._read_count + self._write_count
         assert not (self._read_count != 0 and self._write_count != 0)
         assert self._block_request is not None
-        pos = 0
-        buf[pos] = Command.DAP_TRANSFER_BLOCK
-        pos += 1
-        buf[pos] = self._dap_index
-        pos += 1
-        buf[pos] = transfer_count & 0xff
-        pos += 1
-        buf[pos] = (transfer_count >> 8) & 0xff
-        pos += 1
-        buf[pos] = self._block_request
-        pos += 1
+        _TRANSFER_BLOCK_HEADER.pack_into(buf, pos, Command.DAP_TRANSFER_BLOCK,
+                                         self._dap_index, transfer_count,
+                                         self._block_request)
+        pos += _TRANSFER_BLOCK_HEADER.size
         for count, request, write_list in self._data:
             assert write_list is None or len(write_list) <= count
             assert request == self._block_request
-            write_pos = 0
             if not request & READ:
-                for _ in range(count):
-                    buf[pos] = (write_list[write_pos] >> (8 * 0)) & 0xff
-                    pos += 1
-                    buf[pos] = (write_list[write_pos] >> (8 * 1)) & 0xff
-                    pos += 1
-                    buf[pos] = (write_list[write_pos] >> (8 * 2)) & 0xff
-                    pos += 1
-                    buf[pos] = (write_list[write_pos] >> (8 * 3)) & 0xff
-                    pos += 1
-                    write_pos += 1
+                struct.pack_into('<%dI' % len(write_list), buf, pos, *write_list)
+                pos += 4 * len(write_list)
         return buf
 
     def _decode_transfer_block_data(self, data):
@@ -391,39 +463,42 @@ class _Command(object):
         and return it as an array of bytes.
         """
         assert self.get_empty() is False
-        if data[0] != Command.DAP_TRANSFER_BLOCK:
+        command, transfer_count, response = _TRANSFER_BLOCK_RESPONSE.unpack_from(data)
+        if command != Command.DAP_TRANSFER_BLOCK:
             raise ValueError('DAP_TRANSFER_BLOCK response error')
 
-        if data[3] != DAP_TRANSFER_OK:
-            if data[3] == DAP_TRANSFER_FAULT:
+        if response != DAP_TRANSFER_OK:
+            if response == DAP_TRANSFER_FAULT:
                 raise DAPAccessIntf.TransferFaultError()
-            elif data[3] == DAP_TRANSFER_WAIT:
+            elif response == DAP_TRANSFER_WAIT:
                 raise DAPAccessIntf.TransferTimeoutError()
             raise DAPAccessIntf.TransferError()
 
         # Check for count mismatch after checking for DAP_TRANSFER_FAULT
         # This allows TransferFaultError or TransferTimeoutError to get
         # thrown instead of TransferFaultError
-        transfer_count = data[1] | (data[2] << 8)
         if transfer_count != self._read_count + self._write_count:
             raise DAPAccessIntf.TransferError()
 
-        return data[4:4 + 4 * self._read_count]
+        return memoryview(data)[4:4 + 4 * self._read_count]
 
-    def encode_data(self):
+    def encode_data(self, buf=None, pos=0):
         """
         Encode this command into a byte array that can be sent
 
         The actual command this is encoded into depends on the data
-        that was added.
+        that was added.  If buf is given the command is written into
+        it at pos, otherwise a new packet sized buffer is returned.
         """
         assert self.get_empty() is False
         self._data_encoded = True
+        if buf is None:
+            buf = bytearray(self._size)
         if self._block_allowed:
-            data = self._encode_transfer_block_data()
+            self._encode_transfer_block_data(buf, pos)
         else:
-            data = self._encode_transfer_data()
-        return data
+            self._encode_transfer_data(buf, pos)
+        return buf
 
     def decode_data(self, data):
         """
@@ -437,6 +512,43 @@ class _Command(object):
             data = self._decode_transfer_data(data)
         return data
 
+class _SWJSequence(object):
+    """
+    A DAP_SWJ_Sequence command carried by the deferred transfer engine.
+
+    This lets line resets and JTAG-to-SWD switches share a packet with
+    transfers when the probe supports DAP_ExecuteCommands.  It has the
+    same encode/decode interface as _Command but no response data.
+    """
+
+    def __init__(self, data):
+        assert 0 < len(data) <= 32
+        self._data = bytes(bytearray(data))
+
+    def get_empty(self):
+        return False
+
+    def get_request_size(self):
+        return 2 + len(self._data)
+
+    def get_response_size(self):
+        return 2
+
+    def encode_data(self, buf=None, pos=0):
+        if buf is None:
+            buf = bytearray(self.get_request_size())
+        buf[pos] = Command.DAP_SWJ_SEQUENCE
+        buf[pos + 1] = (len(self._data) * 8) & 0xff
+        buf[pos + 2:pos + 2 + len(self._data)] = self._data
+        return buf
+
+    def decode_data(self, data):
+        if data[0] != Command.DAP_SWJ_SEQUENCE:
+            raise ValueError('DAP_SWJ_SEQUENCE response error')
+        if data[1] != DAP_OK:
+            raise DAPAccessIntf.CommandError()
+        return memoryview(b'')
+
 class DAPAccessCMSISDAP(DAPAccessIntf):
     """
     An implementation of the DAPAccessIntf layer for DAPLINK boards
@@ -538,8 +650,27 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
         self._crnt_cmd = None
         self._packet_size = None
         self._commands_to_read = None
-        self._command_response_buf = None
+        self._batch = None
+        self._has_batching = False
+        self._queue_open = False
         self._swo_status = None
+        # _lock is held for a whole API call, so a transfer is never
+        # split by another caller's.  The engine state is shared with the
+        # transfer I/O thread (started by the first asynchronous read)
+        # under _io_cond, which is released while waiting for a response.
+        self._lock = threading.RLock()
+        self._io_cond = threading.Condition(threading.RLock())
+        self._io_thread = None
+        self._io_stop = False
+        self._io_exception = None
+        self._packets_read = 0
+        # Counts calls to _abort_all_transfers, so a caller that waited
+        # for a free slot can tell its transfer was aborted meanwhile.
+        self._aborts = 0
+        self._abort_error = None
+        # Transfers with futures that completed under the lock and are
+        # resolved by the I/O thread once it has released it.
+        self._resolved = []
         self._logger = logging.getLogger(__name__)
 
     @property
@@ -579,16 +710,24 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
             self._swo_buffer_size = 0
         self._swo_status = SWOStatus.DISABLED
 
+        # DAP_ExecuteCommands/DAP_QueueCommands were added in CMSIS-DAP 1.1
+        # and have no capability bit, so probe for them directly.
+        self._has_batching = (DAPSettings.batch_commands and
+                              self._protocol.execute_commands() is not None)
+        self._logger.debug("Command batching %s", "enabled" if self._has_batching else "disabled")
+
         self._init_deferred_buffers()
 
     def close(self):
         assert self._interface is not None
         self.flush()
+        self._stop_io_thread()
         self._interface.close()
 
     def get_unique_id(self):
         return self._unique_id
 
+    @_locked
     def reset(self):
         self.flush()
         self._protocol.set_swj_pins(0, Pin.nRESET)
@@ -596,6 +735,7 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
         self._protocol.set_swj_pins(Pin.nRESET, Pin.nRESET)
         time.sleep(0.1)
 
+    @_locked
     def assert_reset(self, asserted):
         self.flush()
         if asserted:
@@ -603,11 +743,13 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
         else:
             self._protocol.set_swj_pins(Pin.nRESET, Pin.nRESET)
     
+    @_locked
     def is_reset_asserted(self):
         self.flush()
         pins = self._protocol.set_swj_pins(0, Pin.NONE)
         return (pins & Pin.nRESET) == 0
 
+    @_locked
     def set_clock(self, frequency):
         self.flush()
         self._protocol.set_swj_clock(frequency)
@@ -616,6 +758,7 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
     def get_swj_mode(self):
         return self._dap_port
 
+    @_locked
     def set_deferred_transfer(self, enable):
         """
         Allow transfers to be delayed and buffered
@@ -642,17 +785,20 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
             self.flush()
         self._deferred_transfer = enable
 
+    @_locked
     def flush(self):
         # Send current packet
         self._send_packet()
         # Read all backlogged
-        for _ in range(len(self._commands_to_read)):
-            self._read_packet()
+        while len(self._commands_to_read) > 0:
+            self._wait_packet()
 
+    @_locked
     def identify(self, item):
         assert isinstance(item, DAPAccessIntf.ID)
         return self._protocol.dap_info(item)
 
+    @_locked
     def vendor(self, index, data=None):
         if data is None:
             data = []
@@ -661,6 +807,7 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
     # ------------------------------------------- #
     #             Target access functions
     # ------------------------------------------- #
+    @_locked
     def connect(self, port=DAPAccessIntf.PORT.DEFAULT):
         assert isinstance(port, DAPAccessIntf.PORT)
         actual_port = self._protocol.connect(port.value)
@@ -670,6 +817,7 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
         # configure transfer
         self._protocol.transfer_configure()
 
+    @_locked
     def swj_sequence(self):
         if self._dap_port == DAPAccessIntf.PORT.SWD:
             # configure swd protocol
@@ -680,10 +828,12 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
             # configure jtag protocol
             self._protocol.jtag_configue(4)
             # Test logic reset, run test idle
-            self._protocol.swj_sequence([0x1F])
+            self._add_command(_SWJSequence([0x1F]))
+            self.flush()
         else:
             assert False
 
+    @_locked
     def disconnect(self):
         self.flush()
         self._protocol.disconnect()
@@ -691,6 +841,7 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
     def has_swo(self):
         return self._has_swo_uart
     
+    @_locked
     def swo_configure(self, enabled, rate):
         # Don't send any commands if the SWO commands aren't supported.
         if not self._has_swo_uart:
@@ -731,6 +882,7 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
         finally:
             self._swo_status = SWOStatus.DISABLED
     
+    @_locked
     def swo_control(self, start):
         # Don't send any commands if the SWO commands aren't supported.
         if not self._has_swo_uart:
@@ -751,6 +903,7 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
     def get_swo_status(self):
         return self._protocol.swo_status()
     
+    @_locked
     def swo_read(self, count=None):
         if self._interface.has_swo_ep:
             return self._interface.read_swo()
@@ -760,6 +913,7 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
             status, count, data = self._protocol.swo_data(count)
             return bytearray(data)
 
+    @_locked
     def write_reg(self, reg_id, value, dap_index=0):
         assert reg_id in self.REG
         assert isinstance(value, six.integer_types)
@@ -773,6 +927,7 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
         request |= (reg_id.value % 4) * 4
         self._write(dap_index, 1, request, [value])
 
+    @_locked
     def read_reg(self, reg_id, dap_index=0, now=True):
         assert reg_id in self.REG
         assert isinstance(dap_index, six.integer_types)
@@ -798,6 +953,7 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
         else:
             return read_reg_cb
 
+    @_locked
     def reg_write_repeat(self, num_repeats, reg_id, data_array, dap_index=0):
         assert isinstance(num_repeats, six.integer_types)
         assert num_repeats == len(data_array)
@@ -812,8 +968,9 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
         request |= (reg_id.value % 4) * 4
         self._write(dap_index, num_repeats, request, data_array)
 
+    @_locked
     def reg_read_repeat(self, num_repeats, reg_id, dap_index=0,
-                        now=True):
+                        now=True, buffer=None):
         assert isinstance(num_repeats, six.integer_types)
         assert reg_id in self.REG
         assert isinstance(dap_index, six.integer_types)
@@ -825,18 +982,63 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
         else:
             request |= AP_ACC
         request |= (reg_id.value % 4) * 4
-        transfer = self._write(dap_index, num_repeats, request, None)
+        transfer = self._write(dap_index, num_repeats, request, None, buffer)
         assert transfer is not None
 
         def reg_read_repeat_cb():
             res = transfer.get_result()
-            assert len(res) == num_repeats
+            assert buffer is not None or len(res) == num_repeats
             return res
 
         if now:
             return reg_read_repeat_cb()
         else:
             return reg_read_repeat_cb
+
+    @_locked
+    def read_reg_async(self, reg_id, dap_index=0):
+        assert reg_id in self.REG
+        assert isinstance(dap_index, six.integer_types)
+
+        request = READ
+        if reg_id.value < 4:
+            request |= DP_ACC
+        else:
+            request |= AP_ACC
+        request |= (reg_id.value % 4) << 2
+        future = concurrent.futures.Future()
+        try:
+            transfer = self._add_transfer(dap_index, 1, request, None)
+        except DAPAccessIntf.Error as error:
+            # Aborted by an earlier transfer's error while being queued
+            future.set_exception(error)
+            return future
+        transfer.set_future(future, single=True)
+        self._start_io()
+        return future
+
+    @_locked
+    def reg_read_repeat_async(self, num_repeats, reg_id, dap_index=0):
+        assert isinstance(num_repeats, six.integer_types)
+        assert reg_id in self.REG
+        assert isinstance(dap_index, six.integer_types)
+
+        request = READ
+        if reg_id.value < 4:
+            request |= DP_ACC
+        else:
+            request |= AP_ACC
+        request |= (reg_id.value % 4) * 4
+        future = concurrent.futures.Future()
+        try:
+            transfer = self._add_transfer(dap_index, num_repeats, request, None)
+        except DAPAccessIntf.Error as error:
+            # Aborted by an earlier transfer's error while being queued
+            future.set_exception(error)
+            return future
+        transfer.set_future(future)
+        self._start_io()
+        return future
     # ------------------------------------------- #
     #          Private functions
     # ------------------------------------------- #
@@ -852,14 +1054,20 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
         # not completed (started by write_reg, read_reg,
         # reg_write_repeat and reg_read_repeat)
         self._transfer_list = collections.deque()
-        # The current packet - this can contain multiple
+        # The current command - this can contain multiple
         # different transfers
         self._crnt_cmd = _Command(self._packet_size)
-        # Packets that have been sent but not read
+        # Completed commands sharing the current packet with
+        # _crnt_cmd, and the request/response bytes they use
+        self._batch = []
+        self._batch_request = _BATCH_HEADER
+        self._batch_response = _BATCH_HEADER
+        # Packets that have been sent but not read, as
+        # (commands, batched) pairs
         self._commands_to_read = collections.deque()
-        # Buffer for data returned for completed commands.
-        # This data will be added to transfers
-        self._command_response_buf = bytearray()
+        # Set while the probe holds DAP_QueueCommands packets
+        # that have not been followed by an executing packet
+        self._queue_open = False
 
     def _read_packet(self):
         """
@@ -869,42 +1077,213 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
         stores the data from it in the current Command
         object
         """
+        # Queued packets are only executed once the probe
+        # receives a packet that isn't DAP_QueueCommands.
+        if self._queue_open:
+            self._send_packet()
+
         # Grab command, send it and decode response
-        cmd = self._commands_to_read.popleft()
+        commands, batched = self._commands_to_read.popleft()
         try:
             raw_data = self._interface.read()
-            raw_data = bytearray(raw_data)
-            decoded_data = cmd.decode_data(raw_data)
         except Exception as exception:
             self._abort_all_transfers(exception)
             raise
+        self._decode_packet(commands, batched, raw_data)
 
-        decoded_data = bytearray(decoded_data)
-        self._command_response_buf.extend(decoded_data)
+    def _decode_packet(self, commands, batched, raw_data):
+        """
+        Decode a response and attach its data to the waiting transfers
+        """
+        self._packets_read += 1
+        try:
+            # The USB backends return an array.array which can be used
+            # in place; the HID backends return a list of ints.
+            if isinstance(raw_data, list):
+                raw_data = bytearray(raw_data)
+            if batched:
+                responses = self._decode_batch(commands, raw_data)
+            else:
+                responses = [commands[0].decode_data(raw_data)]
+        except Exception as exception:
+            self._abort_all_transfers(exception)
+            raise
 
-        # Attach data to transfers
-        pos = 0
+        # Attach data to transfers.  A transfer whose data continues
+        # in the next packet stays at the head of the list.
+        for decoded_data in responses:
+            pos = 0
+            size_left = len(decoded_data)
+            while size_left > 0:
+                transfer = self._transfer_list[0]
+                size = transfer.add_response(decoded_data[pos:])
+                pos += size
+                size_left -= size
+                if transfer._result is not None:
+                    self._transfer_list.popleft()
+
+    def _wait_packet(self):
+        """
+        Wait until the oldest outstanding packet has been read
+
+        The packet is read here unless the I/O thread is running, in
+        which case it is the only reader and this waits for it instead.
+        Must be called with _io_cond held.
+        """
+        if self._io_thread is None or threading.current_thread() is self._io_thread:
+            self._read_packet()
+            return
+        count = self._packets_read
+        while self._packets_read == count and len(self._commands_to_read) > 0:
+            self._io_cond.wait()
+        if self._io_exception is not None:
+            exception, self._io_exception = self._io_exception, None
+            raise exception
+
+    def _start_io(self):
+        """
+        Get the packets holding newly added asynchronous reads moving
+
+        The current packet is sent straight away if the probe has a
+        free slot; otherwise more requests can be added to it and the
+        I/O thread sends it as soon as a response frees a slot.
+        """
+        if self._io_thread is None:
+            self._io_stop = False
+            self._io_thread = threading.Thread(target=self._io_task,
+                                               name="CMSIS-DAP transfer I/O")
+            self._io_thread.daemon = True
+            self._io_thread.start()
+        if len(self._commands_to_read) < self._interface.get_packet_count():
+            self._send_packet()
+        self._io_cond.notify_all()
+
+    def _stop_io_thread(self):
+        if self._io_thread is None:
+            return
+        with self._io_cond:
+            self._io_stop = True
+            self._io_cond.notify_all()
+        self._io_thread.join()
+        self._io_thread = None
+
+    def _io_task(self):
+        """
+        Read responses while packets are in flight, resolving futures
+
+        Only this thread reads from the interface while it runs.  The
+        engine is released while waiting for a response so other threads
+        can keep adding transfers, and each freed slot is refilled with
+        the current packet so up to the probe's packet count stay queued.
+        Futures are resolved on this thread; their callbacks must not
+        call back into the synchronous API.
+        """
         while True:
-            size_left = len(self._command_response_buf) - pos
-            if size_left == 0:
-                # If size left is 0 then the transfer list might
-                # be empty, so don't try to access element 0
-                break
-            transfer = self._transfer_list[0]
-            size = transfer.get_data_size()
-            if size > size_left:
-                break
-
-            self._transfer_list.popleft()
-            data = self._command_response_buf[pos:pos + size]
-            pos += size
-            transfer.add_response(data)
-
-        # Remove used data from _command_response_buf
-        if pos > 0:
-            self._command_response_buf = self._command_response_buf[pos:]
-
-    def _send_packet(self):
+            with self._io_cond:
+                while (not self._io_stop and not self._resolved and
+                        len(self._commands_to_read) == 0):
+                    self._io_cond.wait()
+                resolved, self._resolved = self._resolved, []
+                if self._io_stop and len(self._commands_to_read) == 0:
+                    break
+                if self._queue_open:
+                    self._send_packet()
+                pending = len(self._commands_to_read) > 0
+
+            for transfer in resolved:
+                transfer.resolve()
+            if not pending:
+                continue
+
+            # Only this thread pops from _commands_to_read, so the head
+            # can't change while the lock is released.
+            try:
+                raw_data = self._interface.read()
+                error = None
+            except Exception as exception:
+                error = exception
+
+            with self._io_cond:
+                try:
+                    if error is not None:
+                        self._packets_read += 1
+                        self._abort_all_transfers(error)
+                        raise error
+                    commands, batched = self._commands_to_read.popleft()
+                    self._decode_packet(commands, batched, raw_data)
+                    # Refill the slot that was just freed.
+                    self._send_packet()
+                except Exception as exception:
+                    # Errors are delivered to the futures of the aborted
+                    # transfers; keep one that nobody received for flush().
+                    if not self._resolved:
+                        self._io_exception = exception
+                    self._logger.debug("Transfer I/O error: %s", exception)
+                self._io_cond.notify_all()
+
+        for transfer in resolved:
+            transfer.resolve()
+
+    def _decode_batch(self, commands, data):
+        """
+        Split a DAP_ExecuteCommands response between its commands
+        """
+        data = memoryview(data)
+        # The probe answers queued packets as if they were executed.
+        if data[0] not in (Command.DAP_EXECUTE_COMMANDS, Command.DAP_QUEUE_COMMANDS):
+            raise ValueError('DAP_EXECUTE_COMMANDS response error')
+        if data[1] != len(commands):
+            raise DAPAccessIntf.TransferError()
+        responses = []
+        pos = _BATCH_HEADER
+        for cmd in commands:
+            responses.append(cmd.decode_data(data[pos:]))
+            pos += cmd.get_response_size()
+        return responses
+
+    def _start_command(self):
+        """
+        Close the current command and start another in the same packet
+
+        Returns False if the probe can't batch commands or the
+        packet doesn't have room for another useful command.
+        """
+        cmd = self._crnt_cmd
+        if not self._has_batching or cmd.get_empty() or len(self._batch) == 0xff:
+            return False
+        request = self._batch_request + cmd.get_request_size()
+        response = self._batch_response + cmd.get_response_size()
+        if self._packet_size - max(request, response) < _BATCH_MIN_COMMAND:
+            return False
+        self._batch.append(cmd)
+        self._batch_request = request
+        self._batch_response = response
+        self._crnt_cmd = _Command(self._packet_size - request,
+                                  self._packet_size - response)
+        return True
+
+    def _add_command(self, command):
+        """
+        Add a non-transfer command such as _SWJSequence to the packet stream
+
+        The command is not flushed even when deferred transfers are
+        off, so callers can batch several before calling flush().
+        """
+        aborts = self._aborts
+        if not self._crnt_cmd.get_empty() and not self._start_command():
+            self._send_packet(queue=True)
+            self._check_aborted(aborts)
+        cmd = self._crnt_cmd
+        if (command.get_request_size() > cmd._size or
+                command.get_response_size() > cmd._response_size):
+            self._send_packet(queue=True)
+            self._check_aborted(aborts)
+        self._crnt_cmd = command
+        if not self._start_command():
+            self._send_packet(queue=True)
+            self._check_aborted(aborts)
+
+    def _send_packet(self, queue=False):
         """
         Send a single packet to the interface
 
@@ -912,38 +1291,87 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
         that are stored in daplink's buffer (the number of
         packets written but not read) does not exceed the
         number supported by the given device.
+
+        With queue set the packet may be sent as DAP_QueueCommands,
+        which the probe holds until the next executing packet.
         """
-        cmd = self._crnt_cmd
-        if cmd.get_empty():
+        # An empty DAP_ExecuteCommands still releases a held queue.
+        if self._crnt_cmd.get_empty() and not self._batch and not self._queue_open:
             return
 
         max_packets = self._interface.get_packet_count()
-        if len(self._commands_to_read) >= max_packets:
-            self._read_packet()
-        data = cmd.encode_data()
+        while len(self._commands_to_read) >= max_packets:
+            self._wait_packet()
+
+        # Collect the packet only now; the I/O thread may have sent
+        # it while we waited for a free slot.
+        cmd = self._crnt_cmd
+        commands = list(self._batch)
+        if not cmd.get_empty():
+            commands.append(cmd)
+        if not commands and not self._queue_open:
+            return
+
+        # Packets sent while more transfers are being built can be
+        # queued, as long as a slot is left for the executing packet.
+        request_size = _BATCH_HEADER + sum(c.get_request_size() for c in commands)
+        response_size = _BATCH_HEADER + sum(c.get_response_size() for c in commands)
+        queue = (queue and self._has_batching and
+                 len(self._commands_to_read) + 2 <= max_packets and
+                 max(request_size, response_size) <= self._packet_size)
+        batched = queue or len(commands) != 1
+        if batched:
+            data = bytearray(self._packet_size)
+            data[0] = Command.DAP_QUEUE_COMMANDS if queue else Command.DAP_EXECUTE_COMMANDS
+            data[1] = len(commands)
+            pos = _BATCH_HEADER
+            for command in commands:
+                command.encode_data(data, pos)
+                pos += command.get_request_size()
+        else:
+            data = commands[0].encode_data()
         try:
-            self._interface.write(list(data))
+            self._interface.write(data)
         except Exception as exception:
             self._abort_all_transfers(exception)
             raise
-        self._commands_to_read.append(cmd)
+        self._commands_to_read.append((commands, batched))
+        self._queue_open = queue
+        if self._io_thread is not None:
+            self._io_cond.notify_all()
         self._crnt_cmd = _Command(self._packet_size)
+        self._batch = []
+        self._batch_request = _BATCH_HEADER
+        self._batch_response = _BATCH_HEADER
 
     def _write(self, dap_index, transfer_count,
-               transfer_request, transfer_data):
+               transfer_request, transfer_data, buffer=None):
         """
         Write one or more commands
         """
+        transfer = self._add_transfer(dap_index, transfer_count,
+                                      transfer_request, transfer_data, buffer)
+        if not self._deferred_transfer:
+            self.flush()
+
+        return transfer
+
+    def _add_transfer(self, dap_index, transfer_count,
+                      transfer_request, transfer_data, buffer=None):
+        """
+        Add one or more commands to the packet stream without flushing
+        """
         assert dap_index == 0  # dap index currently unsupported
         assert isinstance(transfer_count, six.integer_types)
         assert isinstance(transfer_request, six.integer_types)
         assert transfer_data is None or len(transfer_data) > 0
+        aborts = self._aborts
 
         # Create transfer and add to transfer list
         transfer = None
         if transfer_request & READ:
             transfer = _Transfer(self, dap_index, transfer_count,
-                                 transfer_request, transfer_data)
+                                 transfer_request, transfer_data, buffer)
             self._transfer_list.append(transfer)
 
         # Build physical packet by adding it to command
@@ -952,14 +1380,23 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
         size_to_transfer = transfer_count
         trans_data_pos = 0
         while size_to_transfer > 0:
+            # When batching, give a long run of writes its own block command.
+            if (not is_read and size_to_transfer >= _BATCH_MIN_BLOCK_WRITE and
+                    not cmd.get_empty() and not cmd.get_block_allowed(transfer_request) and
+                    self._start_command()):
+                cmd = self._crnt_cmd
+
             # Get the size remaining in the current packet for the given request.
             size = cmd.get_request_space(size_to_transfer, transfer_request, dap_index)
 
-            # This request doesn't fit in the packet so send it.
+            # This request doesn't fit in the command, so start another
+            # command in the same packet or send the packet.
             if size == 0:
-                if LOG_PACKET_BUILDS:
-                    self._logger.debug("_write: send packet [size==0]")
-                self._send_packet()
+                if not self._start_command():
+                    if LOG_PACKET_BUILDS:
+                        self._logger.debug("_write: send packet [size==0]")
+                    self._send_packet(queue=True)
+                    self._check_aborted(aborts)
                 cmd = self._crnt_cmd
                 continue
 
@@ -976,43 +1413,66 @@ class DAPAccessCMSISDAP(DAPAccessIntf):
             if cmd.get_full():
                 if LOG_PACKET_BUILDS:
                     self._logger.debug("_write: send packet [full]")
-                self._send_packet()
+                self._send_packet(queue=self._deferred_transfer or size_to_transfer > 0)
+                self._check_aborted(aborts)
                 cmd = self._crnt_cmd
 
-        if not self._deferred_transfer:
-            self.flush()
-
         return transfer
 
+    def _check_aborted(self, aborts):
+        """
+        Raise the error that aborted all transfers since aborts was read
+
+        Sending a packet can wait for a free slot, and while it waits the
+        I/O thread may hit an error and abort everything, including the
+        transfer being added.  Its remaining requests must not be added
+        to the new packet stream, where their responses would be
+        credited to the next transfer.
+        """
+        if self._aborts != aborts:
+            if self._io_exception is self._abort_error:
+                self._io_exception = None
+            raise self._abort_error
+
     def _jtag_to_swd(self):
         """
         Send the command to switch from SWD to jtag
         """
         data = [0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff]
-        self._protocol.swj_sequence(data)
+        self._add_command(_SWJSequence(data))
 
         data = [0x9e, 0xe7]
-        self._protocol.swj_sequence(data)
+        self._add_command(_SWJSequence(data))
 
         data = [0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff]
-        self._protocol.swj_sequence(data)
+        self._add_command(_SWJSequence(data))
 
         data = [0x00]
-        self._protocol.swj_sequence(data)
+        self._add_command(_SWJSequence(data))
+        self.flush()
 
     def _abort_all_transfers(self, exception):
         """
         Abort any ongoing transfers and clear all buffers
         """
         pending_reads = len(self._commands_to_read)
+        queue_open = self._queue_open
         # invalidate _transfer_list
         for transfer in self._transfer_list:
             transfer.add_error(exception)
         # clear all deferred buffers
         self._init_deferred_buffers()
+        self._aborts += 1
+        self._abort_error = exception
+        # wake up callers waiting for the packets that were dropped
+        with self._io_cond:
+            self._io_cond.notify_all()
         # finish all pending reads and ignore the data
         # Only do this if the error is a tranfer error.
         # Otherwise this could cause another exception
         if isinstance(exception, DAPAccessIntf.TransferError):
+            if queue_open:
+                self._interface.write(bytearray([Command.DAP_EXECUTE_COMMANDS, 0]))
+                pending_reads += 1
             for _ in range(pending_reads):
                 self._interface.read()
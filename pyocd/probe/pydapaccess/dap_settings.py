@@ -17,3 +17,4 @@
 class DAPSettings():
 	
 	limit_packets = False
+	batch_commands = True
@@ -107,7 +107,7 @@ class HidApiUSB(Interface):
         for _ in range(self.packet_size - len(data)):
             data.append(0)
         #logging.debug("send: %s", data)
-        self.device.write([0] + data)
+        self.device.write([0] + list(data))
         return
 
 
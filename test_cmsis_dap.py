@@ -0,0 +1,373 @@
+import array
+import asyncio
+import collections
+import struct
+import threading
+import time
+
+import pytest
+
+from pyocd.probe.pydapaccess.cmsis_dap_core import Command
+from pyocd.probe.pydapaccess.dap_access_api import DAPAccessIntf
+from pyocd.probe.pydapaccess.dap_access_cmsis_dap import DAPAccessCMSISDAP
+from pyocd.probe.pydapaccess.dap_settings import DAPSettings
+
+REG = DAPAccessIntf.REG
+
+ACK_OK = 1
+ACK_FAULT = 4
+
+
+class FakeInterface(object):
+    ''' a CMSIS-DAP probe behind an Interface: DAP_Info, DAP_Transfer, DAP_TransferBlock,
+        DAP_SWJ_Sequence and, with batching, DAP_QueueCommands/DAP_ExecuteCommands
+
+    Register reads return the register's last written value, except AP 0xC (DRW), which counts up
+    from 1 with every word read. The number of packets held (written and not read back, queued
+    included) is checked against the packet count.
+    '''
+    vendor_name = 'Fake'
+    product_name = 'Fake CMSIS-DAP'
+    vid = 0x0d28
+    pid = 0x0204
+
+    def __init__(self, packet_size=64, packet_count=4, batching=True, latency=0):
+        self.packet_size = packet_size
+        self.packet_count = packet_count
+        self.batching = batching
+        self.latency = latency      # seconds until a response can be read
+        self.gate = None            # semaphore read() takes a permit from, if set
+        self.regs = collections.defaultdict(int)
+        self.counter = 0
+        self.fault_at = None        # counter value at which reading DRW faults, once
+        self.queued = []
+        self.responses = collections.deque()    # (time readable, response)
+        self.cond = threading.Condition()
+        self.sent = []              # command byte of every packet written
+        self.swj = []
+        self.max_held = 0
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_serial_number(self):
+        return '0001'
+
+    def get_packet_count(self):
+        return self.packet_count
+
+    def set_packet_count(self, count):
+        pass
+
+    def set_packet_size(self, size):
+        pass
+
+    def _read_reg(self, request):
+        if request & 0xd == 0xd:    # AP 0xC
+            if self.counter + 1 == self.fault_at:
+                self.fault_at = None
+                return None
+            self.counter += 1
+            return self.counter
+        return self.regs[request & 0xd]
+
+    def _execute(self, data):
+        ''' return the response to the command at the start of data, and the command's length '''
+        cmd = data[0]
+        if cmd == Command.DAP_INFO:
+            value = {0xf0: b'\x01', 0xfe: bytes([self.packet_count]),
+                     0xff: struct.pack('<H', self.packet_size)}.get(data[1], b'')
+            return bytes([cmd, len(value)]) + value, 2
+
+        if cmd == Command.DAP_TRANSFER:
+            requests = []
+            pos = 3
+            for _ in range(data[2]):
+                requests.append((data[pos], pos + 1))
+                pos += 1 if data[pos] & 2 else 5
+            response = bytearray([cmd, 0, ACK_OK])
+            for request, data_pos in requests:
+                if request & 2:
+                    value = self._read_reg(request)
+                    if value is None:
+                        response[2] = ACK_FAULT
+                        break
+                    response += struct.pack('<I', value)
+                else:
+                    self.regs[request & 0xd] = struct.unpack_from('<I', data, data_pos)[0]
+                response[1] += 1
+            return bytes(response), pos
+
+        if cmd == Command.DAP_TRANSFER_BLOCK:
+            count = struct.unpack_from('<H', data, 2)[0]
+            request = data[4]
+            length = 5 if request & 2 else 5 + 4 * count
+            response = bytearray(struct.pack('<BHB', cmd, 0, ACK_OK))
+            for i in range(count):
+                if request & 2:
+                    value = self._read_reg(request)
+                    if value is None:
+                        response[3] = ACK_FAULT
+                        break
+                    response += struct.pack('<I', value)
+                else:
+                    self.regs[request & 0xd] = struct.unpack_from('<I', data, 5 + 4 * i)[0]
+                struct.pack_into('<H', response, 1, i + 1)
+            return bytes(response), length
+
+        if cmd == Command.DAP_SWJ_SEQUENCE:
+            nbytes = ((data[1] or 256) + 7) // 8
+            self.swj.append(bytes(data[2:2 + nbytes]))
+            return bytes([cmd, 0]), 2 + nbytes
+
+        raise ValueError('unexpected command 0x%02x' % cmd)
+
+    def _execute_batch(self, data):
+        response = bytearray([Command.DAP_EXECUTE_COMMANDS, data[1]])
+        pos = 2
+        for _ in range(data[1]):
+            cmd_response, length = self._execute(data[pos:])
+            response += cmd_response
+            pos += length
+        return response
+
+    def _respond(self, response):
+        assert len(response) <= self.packet_size
+        response = bytes(response) + bytes(self.packet_size - len(response))
+        self.responses.append((time.time() + self.latency, array.array('B', response)))
+
+    def write(self, data):
+        data = bytes(data)
+        assert len(data) <= self.packet_size
+        with self.cond:
+            self.sent.append(data[0])
+            if data[0] in (Command.DAP_QUEUE_COMMANDS, Command.DAP_EXECUTE_COMMANDS) and not self.batching:
+                self._respond([0xff])     # DAP_Invalid
+            elif data[0] == Command.DAP_QUEUE_COMMANDS:
+                self.queued.append(data)
+            else:
+                for queued in self.queued:
+                    self._respond(self._execute_batch(queued))
+                self.queued = []
+                if data[0] == Command.DAP_EXECUTE_COMMANDS:
+                    self._respond(self._execute_batch(data))
+                else:
+                    self._respond(self._execute(data)[0])
+            held = len(self.responses) + len(self.queued)
+            assert held <= self.packet_count, 'probe overrun'
+            self.max_held = max(self.max_held, held)
+            self.cond.notify_all()
+
+    def read(self):
+        if self.gate is not None:
+            self.gate.acquire()
+        with self.cond:
+            if not self.latency:
+                assert self.responses, 'read with no response pending'
+            while not self.responses:
+                self.cond.wait()
+            when, response = self.responses.popleft()
+        delay = when - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return response
+
+
+def make_link(**kwargs):
+    interface = FakeInterface(**kwargs)
+    link = DAPAccessCMSISDAP(None, interface=interface)
+    link.open()
+    del interface.sent[:]
+    return link, interface
+
+
+def drw_words(start, count):
+    return list(range(start, start + count))
+
+
+@pytest.mark.parametrize('batching', [True, False])
+def test_batching_detection(batching):
+    link, interface = make_link(batching=batching)
+    assert link._has_batching == batching
+
+
+def test_batching_setting():
+    DAPSettings.batch_commands = False
+    try:
+        link, interface = make_link()
+    finally:
+        DAPSettings.batch_commands = True
+    assert not link._has_batching
+
+
+@pytest.mark.parametrize('batching', [True, False])
+def test_swj_sequence(batching):
+    link, interface = make_link(batching=batching)
+    link._jtag_to_swd()
+    assert interface.swj == [b'\xff' * 7, b'\x9e\xe7', b'\xff' * 7, b'\x00']
+    assert len(interface.sent) == (1 if batching else 4)
+
+
+def queue_reads(link, count, reads):
+    for i in range(count):
+        link.write_reg(REG.AP_0x4, i)
+        reads.append(link.reg_read_repeat(6, REG.AP_0xC, now=False))
+        link.reg_write_repeat(8, REG.AP_0xC, list(range(8)))
+        reads.append(link.read_reg(REG.AP_0x4, now=False))
+
+
+def expected_reads(count):
+    return [value for i in range(count) for value in (drw_words(1 + 6 * i, 6), i)]
+
+
+@pytest.mark.parametrize('batching', [True, False])
+def test_queue_execute(batching):
+    link, interface = make_link(batching=batching)
+    link.set_deferred_transfer(True)
+    reads = []
+    queue_reads(link, 8, reads)
+    assert [read() for read in reads] == expected_reads(8)
+    assert interface.max_held <= interface.packet_count
+    assert not interface.queued and not interface.responses
+    if batching:
+        # packets mixing DAP_Transfer and DAP_TransferBlock are queued, and the probe runs them
+        # when the next executing packet arrives
+        assert Command.DAP_QUEUE_COMMANDS in interface.sent
+        assert interface.sent[-1] != Command.DAP_QUEUE_COMMANDS
+    else:
+        assert Command.DAP_QUEUE_COMMANDS not in interface.sent
+        assert Command.DAP_EXECUTE_COMMANDS not in interface.sent
+
+
+@pytest.mark.parametrize('batching', [True, False])
+def test_fault_in_queued_packets(batching):
+    link, interface = make_link(batching=batching)
+    link.set_deferred_transfer(True)
+    interface.fault_at = 20
+    # the fault is raised by whichever call reads its response, every transfer in flight is
+    # aborted with it and the others complete as usual
+    reads = []
+    faults = 0
+    try:
+        queue_reads(link, 8, reads)
+    except DAPAccessIntf.TransferFaultError:
+        faults += 1
+    for read, value in zip(reads, expected_reads(8)):
+        try:
+            assert read() == value
+        except DAPAccessIntf.TransferFaultError:
+            faults += 1
+    assert faults > 0
+    with pytest.raises(DAPAccessIntf.TransferFaultError):
+        reads[6]()
+    if batching:
+        assert Command.DAP_QUEUE_COMMANDS in interface.sent
+
+    # the aborted packets are drained, nothing is left for later transfers
+    interface.fault_at = None
+    assert not interface.queued and not interface.responses
+    link.write_reg(REG.AP_0x4, 5)
+    assert link.read_reg(REG.AP_0x4) == 5
+    assert link.reg_read_repeat(3, REG.AP_0xC) == drw_words(interface.counter - 2, 3)
+
+
+@pytest.fixture
+def async_link():
+    link, interface = make_link(latency=0.002)
+    yield link, interface
+    if interface.gate is not None:
+        # don't leave the I/O thread blocked in read() if a test failed
+        interface.gate.release(1000)
+    link.close()
+
+
+def test_async_reads(async_link):
+    link, interface = async_link
+    link.write_reg(REG.AP_0x4, 7)
+    futures = [link.read_reg_async(REG.AP_0x4) for _ in range(20)]
+    futures += [link.reg_read_repeat_async(30, REG.AP_0xC) for _ in range(10)]
+    assert [future.result(5) for future in futures[:20]] == [7] * 20
+    assert [future.result(5) for future in futures[20:]] == [drw_words(1 + 30 * i, 30) for i in range(10)]
+    # the I/O thread keeps the probe's packets in flight
+    assert interface.max_held == interface.packet_count
+
+    # synchronous calls from another thread are not split by the asynchronous ones
+    errors = []
+    def sync_calls():
+        try:
+            for i in range(50):
+                link.write_reg(REG.AP_0x0, i)
+                assert link.read_reg(REG.AP_0x0) == i
+        except Exception as error:
+            errors.append(error)
+    thread = threading.Thread(target=sync_calls)
+    thread.start()
+    futures = [link.reg_read_repeat_async(5, REG.AP_0xC) for _ in range(100)]
+    words = [word for future in futures for word in future.result(5)]
+    thread.join()
+    assert not errors
+    assert words == drw_words(301, 500)
+
+
+def test_asyncio(async_link):
+    link, interface = async_link
+    link.write_reg(REG.AP_0x4, 3)
+
+    async def main():
+        return await asyncio.gather(link.aread_reg(REG.AP_0x4), link.areg_read_repeat(20, REG.AP_0xC))
+
+    assert asyncio.run(main()) == [3, drw_words(1, 20)]
+
+
+def test_async_fault(async_link):
+    link, interface = async_link
+    interface.fault_at = 1
+    future = link.reg_read_repeat_async(4, REG.AP_0xC)
+    with pytest.raises(DAPAccessIntf.TransferFaultError):
+        future.result(5)
+    interface.fault_at = None
+    assert link.reg_read_repeat(4, REG.AP_0xC) == drw_words(1, 4)
+
+
+def test_async_fault_while_queueing(async_link):
+    ''' a fault read by the I/O thread while a multi-packet read is still being queued '''
+    link, interface = async_link
+    # 15 words fit in a response, so after a 5 word read every 20 word read spans two packets, the
+    # second of which is only sent when the next read needs the buffer. The probe's four packets
+    # are full with the second read's tail still buffered, so the third read is blocked waiting
+    # for a free slot. The fault is in the first 20 word read.
+    interface.fault_at = 10
+    interface.gate = threading.Semaphore(0)
+    futures = [link.reg_read_repeat_async(5, REG.AP_0xC)]
+    def issue():
+        for _ in range(10):
+            futures.append(link.reg_read_repeat_async(20, REG.AP_0xC))
+    thread = threading.Thread(target=issue)
+    thread.start()
+    deadline = time.time() + 5
+    while len(interface.responses) < interface.packet_count and time.time() < deadline:
+        time.sleep(0.001)
+    time.sleep(0.05)
+    assert len(futures) == 3 and thread.is_alive()
+    interface.gate.release(1000)
+    thread.join(5)
+
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result(5))
+        except DAPAccessIntf.TransferFaultError:
+            results.append(None)
+    assert results[:4] == [drw_words(1, 5), None, None, None]
+    # reads after the fault either failed with it or got words of their own
+    for words in results[3:]:
+        assert words is None or words == drw_words(words[0], 20)
+
+    # no stray responses are left to be credited to later transfers
+    interface.gate = None
+    link.write_reg(REG.AP_0x4, 9)
+    assert link.read_reg(REG.AP_0x4) == 9
+    assert link.reg_read_repeat(20, REG.AP_0xC) == drw_words(interface.counter - 19, 20)
@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+from array import array
+
+import pytest
+
+from pyocd.debug.elf.decoder import DwarfAddressDecoder, _FunctionTable, _running_max
+from pyocd.debug.elf.elf import ELFBinaryFile
+
+AXF = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'frame.axf')
+
+
+def make_table(entries):
+    entries = sorted(entries)
+    return _FunctionTable(starts=array('Q', (e[0] for e in entries)),
+                          ends=array('Q', (e[1] for e in entries)),
+                          maxends=_running_max(e[1] for e in entries),
+                          names=[e[2] for e in entries],
+                          offsets=array('Q', (0 for e in entries)))
+
+
+def lookup(table, addr):
+    i = DwarfAddressDecoder._table_index(table, addr)
+    return None if i is None else table.names[i]
+
+
+def test_table_index_nested():
+    table = make_table([(0x100, 0x200, 'outer'), (0x120, 0x140, 'inner'), (0x180, 0x190, 'late')])
+    assert lookup(table, 0xff) is None
+    assert lookup(table, 0x100) == 'outer'
+    # Addresses inside a nested entry resolve to the enclosing one, as the interval tree did.
+    assert lookup(table, 0x130) == 'outer'
+    assert lookup(table, 0x150) == 'outer'
+    assert lookup(table, 0x1a0) == 'outer'
+    assert lookup(table, 0x200) is None
+
+
+def test_table_index_overlap_and_gap():
+    table = make_table([(0x100, 0x180, 'a'), (0x140, 0x200, 'b'), (0x300, 0x310, 'c')])
+    assert lookup(table, 0x150) == 'a'
+    assert lookup(table, 0x190) == 'b'
+    assert lookup(table, 0x250) is None
+    assert lookup(table, 0x305) == 'c'
+    assert lookup(table, 0x310) is None
+
+
+@pytest.fixture
+def axf(tmp_path):
+    path = str(tmp_path / 'frame.axf')
+    shutil.copy(AXF, path)
+    return path
+
+
+def sample(path):
+    elf = ELFBinaryFile(path)
+    try:
+        decoder = elf.address_decoder
+        result = []
+        for addr in range(0x8000000, 0x8001000, 6):
+            fn = decoder.get_function_for_address(addr)
+            line = decoder.get_line_for_address(addr)
+            result.append((fn and (fn.name, fn.low_pc, fn.high_pc),
+                           line and (line.filename, line.dirname, line.line)))
+        return result
+    finally:
+        elf.close()
+
+
+def test_cache_round_trip(axf):
+    uncached = sample(axf)
+    assert os.path.exists(axf + '.dwarfcache')
+    with open(axf + '.dwarfcache') as f:
+        cache = json.load(f)
+    assert cache['lines'] and cache['functions']
+
+    elf = ELFBinaryFile(axf)
+    try:
+        decoder = elf.address_decoder
+        assert decoder._line_tables and decoder._function_tables
+    finally:
+        elf.close()
+    assert sample(axf) == uncached
+
+
+def test_cache_rejected(axf):
+    uncached = sample(axf)
+    cache_path = axf + '.dwarfcache'
+    with open(cache_path) as f:
+        cache = json.load(f)
+
+    # A cache for different ELF contents is ignored.
+    cache['key'][3] = '0' * 40
+    with open(cache_path, 'w') as f:
+        json.dump(cache, f)
+    elf = ELFBinaryFile(axf)
+    try:
+        assert not elf.address_decoder._line_tables
+    finally:
+        elf.close()
+
+    # So is one that is not valid JSON, such as an old pickled cache.
+    with open(cache_path, 'wb') as f:
+        f.write(b'\x80\x04\x95')
+    assert sample(axf) == uncached
+
+
+def test_miss_uses_index(axf, tmp_path):
+    fresh = str(tmp_path / 'fresh.axf')
+    shutil.copy(AXF, fresh)
+    elf = ELFBinaryFile(axf)
+    try:
+        decoder = elf.address_decoder
+        # Nothing is hashed until there is a cache to check or write.
+        assert decoder._cache_key is None
+
+        # The first miss parses every CU; after that, misses are answered from the index.
+        assert decoder.get_function_for_address(0x10) is None
+        assert len(decoder._function_tables) == len(decoder._all_cus)
+        assert decoder.get_function_for_address(0x20) is None
+        assert decoder._function_index is not None
+        assert 0x10 in decoder._function_misses and 0x20 in decoder._function_misses
+        assert decoder.get_line_for_address(0x10) is None
+        assert decoder.get_line_for_address(0x20) is None
+        assert decoder._line_index is not None
+    finally:
+        elf.close()
+    # Hits found through the index match those found by searching CU by CU.
+    assert sample(axf) == sample(fresh)
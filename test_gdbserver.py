@@ -0,0 +1,308 @@
+import re
+import socket
+import time
+
+import pytest
+
+import xlink
+from gdbserver import GDBServer, GDBSession, RSPParser
+from pyocd.core.memory_map import MemoryMap, MemoryRegion, MemoryType
+
+RAM = 0x20000000
+
+
+class FakeBackend(xlink.Backend):
+    ''' 4 KiB of RAM at 0x20000000, registers r0-r12, sp, lr, pc and xpsr, and a breakpoint unit '''
+    caps = xlink.Backend.BLOCK_READ | xlink.Backend.HW_BREAK
+
+    def __init__(self):
+        self.mem = bytearray(0x1000)
+        self.core_regs = {name: i for i, name in enumerate(GDBServer.REGS)}
+        self.regs = {name: 0x100 + i for i, name in enumerate(GDBServer.REGS)}
+        self.running = False
+        self.breakpoints = set()
+        self.watchpoints = set()
+
+    def read_mem_U8(self, addr, count):
+        if not RAM <= addr <= addr + count <= RAM + len(self.mem):
+            raise Exception('bus fault')
+        return bytes(self.mem[addr-RAM : addr-RAM+count])
+
+    def write_mem_U8(self, addr, data):
+        if not RAM <= addr <= addr + len(data) <= RAM + len(self.mem):
+            raise Exception('bus fault')
+        self.mem[addr-RAM : addr-RAM+len(data)] = data
+
+    def read_reg(self, reg):
+        return self.regs[reg]
+
+    def write_reg(self, reg, val):
+        self.regs[reg] = val
+
+    def halt(self):
+        self.running = False
+
+    def go(self):
+        self.running = True
+
+    def step(self):
+        self.regs['pc'] += 2
+
+    def halted(self):
+        return not self.running
+
+    def set_breakpoint(self, addr):
+        self.breakpoints.add(addr)
+
+    def remove_breakpoint(self, addr):
+        self.breakpoints.remove(addr)
+
+    def set_watchpoint(self, addr, size, type):
+        self.watchpoints.add((addr, size, type))
+
+    def remove_watchpoint(self, addr, size, type):
+        self.watchpoints.remove((addr, size, type))
+
+
+def frame(payload):
+    return b'$' + payload + b'#%02x' % (sum(payload) & 0xFF)
+
+
+def packets(out):
+    ''' payloads of the packets in a session's output, checksums checked '''
+    result = []
+    for payload, checksum in re.findall(rb'\$([^#]*)#(..)', out, re.S):
+        assert int(checksum, 16) == sum(payload) & 0xFF
+        result.append(payload.decode('latin-1'))
+    return result
+
+
+@pytest.fixture
+def session():
+    backend = FakeBackend()
+    server = GDBServer(xlink.XLink(backend))
+    server.memory_map = MemoryMap(MemoryRegion(type=MemoryType.FLASH, start=0x8000000, length=0x10000, name='flash'))
+    session = GDBSession(server)
+    session.backend = backend
+    session.noack = True
+    return session
+
+
+def request(session, packet):
+    ''' the reply to one packet '''
+    if isinstance(packet, str):
+        packet = packet.encode('latin-1')
+    [reply] = packets(session.process('packet', packet))
+    return reply
+
+
+def test_parser_split():
+    parser = RSPParser()
+    data = b'+' + frame(b'qSupported:multiprocess+') + b'\x03' + frame(b'g')
+    events = []
+    for i in range(len(data)):     # a byte at a time: packets are only cut once complete
+        parser.feed(data[i:i+1])
+        events += list(parser.events())
+    assert events == [('packet', b'qSupported:multiprocess+'), ('interrupt', None), ('packet', b'g')]
+
+
+def test_parser_errors():
+    parser = RSPParser()
+    parser.feed(b'$g#00' + b'-' + b'$m0,4#zz' + frame(b'?'))
+    assert list(parser.events()) == [('bad', None), ('nak', None), ('bad', None), ('packet', b'?')]
+
+
+def test_parser_decode():
+    parser = RSPParser()
+    # '}' escapes the next byte xored with 0x20, '*' repeats the previous byte (n - 29) times
+    parser.feed(frame(b'X0,4:}\x03}]}\x04\x00') + frame(b'0* 1') + frame(b'a}\x03* b'))
+    assert [payload for kind, payload in parser.events()] == [b'X0,4:#}$\x00', b'00001', b'a####b']
+
+
+def test_parser_large():
+    parser = RSPParser(size=64)
+    payload = b'X20000000,1000:' + bytes(range(256)).replace(b'}', b'').replace(b'#', b'').replace(b'$', b'').replace(b'*', b'') * 16
+    parser.feed(frame(payload) * 3)
+    assert list(parser.events()) == [('packet', payload)] * 3
+
+
+def test_acks(session):
+    session.noack = False
+    assert session.process('packet', b'qC') == b'+' + frame(b'QC1')
+    assert session.process('bad', None) == b'-'
+    assert session.process('nak', None) == frame(b'QC1')
+
+    assert session.process('packet', b'QStartNoAckMode') == b'+' + frame(b'OK')
+    assert session.process('packet', b'qC') == frame(b'QC1')
+    assert session.process('bad', None) == b''
+
+
+def test_memory(session):
+    mem = session.backend.mem
+    mem[:8] = bytes(range(1, 9))
+    assert request(session, 'm20000000,8') == '0102030405060708'
+    assert request(session, 'm1000,4') == 'E01'
+
+    assert request(session, 'M20000010,3:aabbcc') == 'OK'
+    assert mem[0x10:0x13] == b'\xaa\xbb\xcc'
+    assert request(session, 'M1000,1:00') == 'E01'
+
+
+def test_binary_write(session):
+    mem = session.backend.mem
+    parser = RSPParser()
+    parser.feed(frame(b'X20000020,4:}\x03}]}\x04\x00'))
+    [(kind, payload)] = parser.events()
+    assert packets(session.process(kind, payload)) == ['OK']
+    assert mem[0x20:0x24] == b'#}$\x00'
+
+    assert request(session, 'X20000000,0:') == 'OK'     # probe for X support
+    assert request(session, b'X1000,1:\x01') == 'E01'
+
+
+def test_registers(session):
+    reply = request(session, 'g')
+    assert len(reply) == 17 * 8
+    assert reply[15*8:16*8] == (0x10f).to_bytes(4, 'little').hex()
+    assert request(session, 'p0') == (0x100).to_bytes(4, 'little').hex()
+    assert request(session, 'p20') == 'E01'
+
+    assert request(session, 'P0=78563412') == 'OK'
+    assert session.backend.regs['r0'] == 0x12345678
+    assert request(session, 'p0') == '78563412'
+
+
+def test_qxfer(session):
+    xml = session.server.target_xml
+    reply = request(session, 'qXfer:features:read:target.xml:0,10')
+    assert reply == 'm' + xml[:0x10]
+
+    # the last chunk is marked 'l', however much of it is left
+    doc = ''
+    while True:
+        reply = request(session, f'qXfer:features:read:target.xml:{len(doc):x},40')
+        doc += reply[1:]
+        if reply[0] == 'l':
+            break
+    assert doc == xml
+
+    reply = request(session, 'qXfer:memory-map:read::0,1000')
+    assert reply[0] == 'l'
+    assert '<memory type="rom" start="0x8000000" length="0x10000" />' in reply
+    assert request(session, 'qXfer:threads:read::0,1000') == ''
+
+
+def test_breakpoints(session):
+    backend = session.backend
+    assert request(session, 'Z0,8000100,2') == 'OK'
+    assert request(session, 'Z1,8000200,2') == 'OK'
+    assert backend.breakpoints == {0x8000100, 0x8000200}
+    assert request(session, 'z0,8000100,2') == 'OK'
+    assert backend.breakpoints == {0x8000200}
+    assert request(session, 'z0,8000100,2') == 'E01'   # not set
+
+    assert request(session, 'Z2,20000000,4') == 'OK'
+    assert request(session, 'Z4,20000010,2') == 'OK'
+    assert backend.watchpoints == {(RAM, 4, 'w'), (RAM + 0x10, 2, 'rw')}
+    assert request(session, 'z2,20000000,4') == 'OK'
+    assert backend.watchpoints == {(RAM + 0x10, 2, 'rw')}
+
+    # without a breakpoint unit the client sets its own breakpoints
+    backend.caps = xlink.Backend.BLOCK_READ
+    assert request(session, 'Z0,8000100,2') == ''
+
+
+def test_run_control(session):
+    backend = session.backend
+    assert packets(session.process('packet', b'vCont;c')) == []
+    assert backend.running and session.target_running
+
+    # Ctrl-C halts the core, and the stop is reported by the halt monitor
+    assert packets(session.process('interrupt', None)) == ['T02thread:1;']
+    assert not session.target_running
+
+    assert request(session, 's') == 'T05thread:1;'
+    assert backend.regs['pc'] == 0x111
+
+
+def test_nonstop(session):
+    backend = session.backend
+    assert request(session, 'QNonStop:1') == 'OK'
+    assert request(session, 'vCont;c') == 'OK'
+    assert request(session, '?') == 'OK'
+
+    backend.halt()
+    session.next_poll = 0
+    assert session.process(None, None) == b'%Stop:T05thread:1;#' + b'%02x' % (sum(b'Stop:T05thread:1;') & 0xFF)
+    assert request(session, 'vStopped') == 'OK'
+
+
+def test_probe_errors(session):
+    backend = session.backend
+    def fail():
+        raise Exception('probe lost')
+
+    # a failed halt is answered with an error instead of ending the session
+    backend.halt = fail
+    assert packets(session.process('interrupt', None)) == ['E01']
+    assert request(session, 'vCont;t') == 'E01'
+
+    # while running, the halt monitor keeps polling through errors
+    assert packets(session.process('packet', b'c')) == []
+    assert packets(session.process('interrupt', None)) == []
+    backend.halted = fail
+    session.next_poll = 0
+    assert session.process(None, None) == b''
+    assert session.target_running
+
+    del backend.halted
+    backend.running = False
+    session.next_poll = 0
+    assert packets(session.process(None, None)) == ['T05thread:1;']
+
+    # with the run state unknown, non-stop mode monitors the target
+    backend.halted = fail
+    assert request(session, 'QNonStop:1') == 'OK'
+    assert session.target_running
+
+
+def test_server():
+    backend = FakeBackend()
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        port = sock.getsockname()[1]
+    server = GDBServer(xlink.XLink(backend), port=port)
+    server.start()
+    end = time.time() + 5
+    while not server.running:
+        assert time.time() < end
+        time.sleep(0.01)
+
+    try:
+        with socket.create_connection(('localhost', port)) as conn:
+            conn.settimeout(5)
+            def reply():
+                data = b''
+                while not re.search(rb'#..$', data):
+                    data += conn.recv(0x10000)
+                return data
+
+            conn.sendall(frame(b'QStartNoAckMode'))
+            assert reply() == b'+' + frame(b'OK')
+
+            # a large X write arrives in pieces and is received straight into the parser's buffer
+            data = bytes(i % 251 for i in range(0x1000))
+            escaped = b''.join(b'}' + bytes([c ^ 0x20]) if c in b'}#$*' else bytes([c]) for c in data)
+            packet = frame(b'X20000000,1000:' + escaped)
+            for i in range(0, len(packet), 1000):
+                conn.sendall(packet[i:i+1000])
+                time.sleep(0.005)
+            assert reply() == frame(b'OK')
+            assert backend.mem == data
+
+            conn.sendall(frame(b'm20000ff0,10'))
+            assert reply() == frame(data[-16:].hex().encode())
+    finally:
+        server.stop()
+        server.join(5)
+    assert not server.is_alive()
@@ -0,0 +1,273 @@
+import re
+import socket
+import threading
+import time
+
+import pytest
+
+import xlink
+from openocd import OpenOCD
+
+REGS = '===== arm v7m registers\n(0) r0 (/32)\n(1) r1 (/32)\n(15) pc (/32)\n(16) xPSR (/32)'
+
+# register list of a Cortex-M4F
+REGS_M4F = '\n'.join(['===== arm v7m registers'] +
+                     [f'({i}) r{i} (/32)' for i in range(13)] +
+                     ['(13) sp (/32)', '(14) lr (/32)', '(15) pc (/32)', '(16) xPSR (/32)',
+                      '(17) msp (/32)', '(18) psp (/32)', '(20) primask (/1)', '(21) basepri (/8)',
+                      '(22) faultmask (/1)', '(23) control (/3)'] +
+                     [f'({42 + i}) d{i} (/64)' for i in range(16)] +
+                     ['(58) fpscr (/32)'])
+
+# the mock's memory holds the low byte of each address, and cannot be read from here up
+UNREADABLE = 0xF0000000
+
+CHANNELS = 'Channels: up=2, down=1\nUp-channels:\n0: Terminal 1024 0\n1: Log 256 0\nDown-channels:\n0: Terminal 16 0\n'
+
+
+def listener(port=0):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('localhost', port))
+    sock.listen(1)
+    return sock
+
+
+def free_ports(n):
+    ''' base of n consecutive free ports '''
+    for _ in range(20):
+        with listener() as sock:
+            base = sock.getsockname()[1]
+        try:
+            socks = [listener(base + i) for i in range(n)]
+        except OSError:
+            continue
+        for sock in socks:
+            sock.close()
+        return base
+    pytest.skip('no free port range')
+
+
+class MockOpenOCD(object):
+    ''' serves the Tcl RPC port, and an RTT TCP server per channel on 'rtt server start' '''
+
+    def __init__(self, rtt_port):
+        self.rtt_port = rtt_port
+        self.server = listener()
+        self.port = self.server.getsockname()[1]
+        self.cmds = []
+        self.rtt_listeners = {}
+        self.rtt_conns = {}
+        self.rtt_rx = {}
+        self.split = False      # send responses in two pieces
+        self.regs = REGS
+        self.conn = None
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def respond(self, cmd):
+        if cmd == 'reg':
+            return self.regs
+        if cmd.startswith('reg '):
+            return f'{cmd.split()[1]} (/32): 0x{0x100 + int(cmd.split()[1]):08x}'
+        if cmd == 'rtt channels':
+            return CHANNELS
+        if cmd.startswith('rtt server start '):
+            port, index = map(int, cmd.split()[3:5])
+            assert port == self.rtt_port + index
+            self.rtt_listeners[index] = sock = listener(port)
+            threading.Thread(target=self._serve_rtt, args=(index, sock), daemon=True).start()
+            return f'Listening on port {port} for rtt connections'
+        if cmd.startswith('rtt server stop '):
+            return ''
+        if cmd.startswith('echo '):
+            return cmd[5:]
+        if cmd.startswith('read_memory '):
+            return self.read_memory(*[int(x, 0) for x in cmd.split()[1:]])
+        if cmd.startswith('join [list '):  # read_many's batch; like Tcl, any failed read fails the script
+            reads = re.findall(r'\[read_memory (\w+) (\d+) (\d+)\]', cmd)
+            res = [self.read_memory(*[int(x, 0) for x in args]) for args in reads]
+            failed = [r for r in res if r.startswith('read_memory:')]
+            return failed[0] if failed else '|'.join(res)
+        return ''
+
+    @staticmethod
+    def read_memory(addr, width, count):
+        size = width // 8
+        if addr + count * size > UNREADABLE:
+            return 'read_memory: failed to read memory'
+        return ' '.join(f'{int.from_bytes(bytes((addr + i * size + j) & 0xff for j in range(size)), "little"):#x}'
+                        for i in range(count))
+
+    def _serve(self):
+        self.conn, _ = self.server.accept()
+        buf = b''
+        while True:
+            try:
+                chunk = self.conn.recv(4096)
+            except OSError:     # closed by the test
+                break
+            if not chunk:
+                break
+            buf += chunk
+            while b'\x1a' in buf:
+                cmd, buf = buf.split(b'\x1a', 1)
+                cmd = cmd.decode('latin-1')
+                self.cmds.append(cmd)
+                if cmd == 'exit':
+                    return
+                resp = self.respond(cmd).encode('latin-1') + b'\x1a'
+                if self.split:
+                    for part in (resp[:3], resp[3:]):
+                        self.conn.sendall(part)
+                        time.sleep(0.01)
+                else:
+                    self.conn.sendall(resp)
+
+    def _serve_rtt(self, index, sock):
+        conn, _ = sock.accept()
+        self.rtt_conns[index] = conn
+        self.rtt_rx[index] = b''
+        while True:
+            try:
+                chunk = conn.recv(4096)
+            except OSError:
+                break
+            if not chunk:
+                break
+            self.rtt_rx[index] += chunk
+
+    def close(self):
+        self.server.close()
+        for sock in list(self.rtt_listeners.values()) + list(self.rtt_conns.values()):
+            sock.close()
+        if self.conn:
+            self.conn.close()
+
+
+def wait_for(cond, timeout=2):
+    end = time.time() + timeout
+    while not cond():
+        assert time.time() < end
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def ocd():
+    rtt_port = free_ports(2)
+    mock = MockOpenOCD(rtt_port)
+    ocd = OpenOCD(port=mock.port, mode='arm', rtt_port=rtt_port)
+    ocd.mock = mock
+    yield ocd
+    try:
+        ocd.close()
+    except OSError:
+        pass
+    mock.close()
+
+
+def test_registers(ocd):
+    assert ocd.core_regs == {'r0': '0', 'r1': '1', 'pc': '15', 'xPSR': '16'}
+    assert ocd.read_regs(['pc', 'r1']) == {'pc': 0x10f, 'r1': 0x101}
+
+
+def test_target_description(ocd):
+    ocd.mock.regs = REGS_M4F
+    ocd.get_registers()
+    xlk = xlink.XLink(ocd)
+
+    xml, regs = xlk.target_description()
+    assert regs[:17] == [(f'r{i}', 32) for i in range(13)] + [('sp', 32), ('lr', 32), ('pc', 32), ('xpsr', 32)]
+    assert regs[17:23] == [(name, 32) for name in ('msp', 'psp', 'primask', 'basepri', 'faultmask', 'control')]
+    assert regs[23:] == [(f'd{i}', 64) for i in range(16)] + [('fpscr', 32)]
+    assert 'org.gnu.gdb.arm.vfp' in xml and 'fpu-single' not in xml
+
+    # without the core registers the GDB bridge keeps its default description
+    ocd.mock.regs = REGS
+    ocd.get_registers()
+    assert xlink.XLink(ocd).target_description() is None
+
+
+def test_read_memory(ocd):
+    assert ocd.read_mem_U32(0x20000000, 2) == [0x03020100, 0x07060504]
+    assert bytes(ocd.read_mem_U8(0x20000001, 9)) == bytes(range(1, 10))
+    assert ocd.mock.cmds[-3:] == ['read_memory 0x20000001 8 3', 'read_memory 0x20000004 32 1', 'read_memory 0x20000008 8 2']
+
+    # OpenOCD's error message is reported instead of failing to parse it
+    with pytest.raises(Exception, match='read_memory 0xf0000000 fail: read_memory: failed to read memory'):
+        ocd.read_mem_U32(UNREADABLE, 1)
+    ocd.mock.respond = lambda cmd: ''
+    with pytest.raises(Exception, match='fail: empty reply'):
+        ocd.read_mem_U8(0x20000000, 4)
+
+
+def test_read_many(ocd):
+    ranges = [(0x20000000 + i * 16, 4) for i in range(40)] + [(0x20001000, 200)]
+    bufs = ocd.read_many(ranges)
+    assert [bytes(buf) for buf in bufs] == [bytes((addr + j) & 0xff for j in range(size)) for addr, size in ranges]
+    assert sum(cmd.startswith('join [list ') for cmd in ocd.mock.cmds) == 2
+
+    # one unreadable range fails its batch's script: the batch is read range by range, so the
+    # error is about that range
+    with pytest.raises(Exception, match=f'read_memory {UNREADABLE:#x} fail'):
+        ocd.read_many([(0x20000000, 4), (UNREADABLE, 4)])
+
+
+def test_submit_pipelined(ocd):
+    ocd.mock.split = True   # responses arrive in pieces and must be reassembled
+    done = []
+    futs = [ocd.submit(f'echo {i}', callback=done.append) for i in range(10)]
+    assert [fut.result(2) for fut in futs] == [str(i) for i in range(10)]
+    wait_for(lambda: len(done) == 10)
+    assert done == [str(i) for i in range(10)]
+
+
+def test_closed_connection(ocd):
+    wait_for(lambda: ocd.mock.conn is not None)
+    ocd.mock.conn.shutdown(socket.SHUT_RDWR)
+    ocd.reader.join(2)
+
+    # submitted after the reader has exited: fails at once instead of timing out
+    fut = ocd.submit('echo lost')
+    with pytest.raises(Exception, match='connection closed'):
+        fut.result(0)
+
+
+def test_rtt(ocd):
+    ocd.rtt_start(0x20000100)
+    assert ocd.mock.cmds[-3:] == ['rtt setup 0x20000100 32 "SEGGER RTT"', 'rtt start', f'rtt server start {ocd.rtt_port} 0']
+
+    assert ocd.rtt_get_num_buffers(0) == 2
+    assert ocd.rtt_get_num_buffers(1) == 1
+    assert ocd.rtt_get_buffers(0) == [('Terminal', 1024), ('Log', 256)]
+    assert ocd.rtt_get_buffers(1) == [('Terminal', 16)]
+
+    # nothing streamed yet: return at once
+    assert ocd.rtt_read(0, 64) == b''
+
+    wait_for(lambda: 0 in ocd.mock.rtt_conns)
+    ocd.mock.rtt_conns[0].sendall(b'hello RTT')
+    data = b''
+    end = time.time() + 2
+    while len(data) < 9 and time.time() < end:
+        data += ocd.rtt_read(0, 64)
+    assert data == b'hello RTT'
+
+    # channel 1 gets its own server on the next port
+    assert ocd.rtt_write(1, b'cmd') == 3
+    assert f'rtt server start {ocd.rtt_port + 1} 1' in ocd.mock.cmds
+    wait_for(lambda: ocd.mock.rtt_rx.get(1) == b'cmd')
+
+    ocd.rtt_stop()
+    assert ocd.mock.cmds[-3:] == [f'rtt server stop {ocd.rtt_port}', f'rtt server stop {ocd.rtt_port + 1}', 'rtt stop']
+    assert ocd.rtt_socks == {}
+
+
+def test_rtt_server_closed(ocd):
+    ocd.rtt_start()
+    assert ocd.mock.cmds[-3] == 'rtt setup 0x20000000 0x10000 "SEGGER RTT"'
+    wait_for(lambda: 0 in ocd.mock.rtt_conns)
+    ocd.mock.rtt_conns[0].shutdown(socket.SHUT_RDWR)
+    with pytest.raises(Exception, match='RTT server closed'):
+        end = time.time() + 2
+        while time.time() < end:
+            ocd.rtt_read(0, 64)
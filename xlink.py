@@ -1,39 +1,442 @@
 import os
 import time
-import ctypes
+import heapq
+import struct
 import operator
+import itertools
 import threading
+import importlib
+import contextlib
+from xml.etree.ElementTree import Element, SubElement, tostring
 
 
-import jlink
-import openocd
-import keil
-import agdi_receiver
+class Backend(object):
+    ''' Interface XLink expects from a debug probe backend.
+
+    A backend declares what it can do efficiently in caps, so callers (e.g. the RTT engine) can pick
+    the best access path without knowing which probe is behind the XLink. The generic fallbacks below
+    are built on read_mem_U8/write_mem_U8, backends override them with native accesses where they can.
+    '''
+    BLOCK_READ   = (1 << 0)     # read_mem_* reads a whole range in one probe transaction
+    BATCHED_READ = (1 << 1)     # several ranges can be read in one round trip
+    NON_HALTING  = (1 << 2)     # memory can be accessed while the core is running
+    REG_LIST     = (1 << 3)     # read_regs reads a register list in one transaction
+    RESET_HALT   = (1 << 4)     # reset(halt=True) stops the core at the reset handler natively
+    NATIVE_RTT   = (1 << 5)     # the probe polls RTT itself, see rtt_start/rtt_read/rtt_write
+    HSS          = (1 << 6)     # the probe samples memory at a fixed period itself, see hss_start/hss_read
+    HW_BREAK     = (1 << 7)     # set_breakpoint/set_watchpoint use the core's breakpoint and watchpoint units
+
+    caps = 0
+
+    mode = 'arm'
+    core_regs = {}      # 'name: index' pair
+
+    def open(self, mode, core, speed):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    # byte reads return a bytes-like object (bytes, bytearray or memoryview),
+    # byte writes accept any bytes-like object or sequence of ints
+    def read_mem_U8(self, addr, count):
+        raise NotImplementedError
+
+    def write_mem_U8(self, addr, data):
+        raise NotImplementedError
+
+    MERGE_GAP = 64  # read_many reads ranges at most this far apart in one access
+
+    def read_many(self, ranges):
+        ''' read several (addr, size) ranges, return a memoryview of each one's bytes
+
+        Generic version: nearby ranges are merged into one read_mem_U8 and sliced out of its result.
+        '''
+        order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+
+        result = [None] * len(ranges)
+        i = 0
+        while i < len(order):
+            start = ranges[order[i]][0]
+            end = start + ranges[order[i]][1]
+            j = i + 1
+            while j < len(order) and ranges[order[j]][0] <= end + self.MERGE_GAP:
+                end = max(end, ranges[order[j]][0] + ranges[order[j]][1])
+                j += 1
+
+            data = memoryview(self.read_mem_U8(start, end - start)).toreadonly()
+            for k in order[i:j]:
+                addr, size = ranges[k]
+                result[k] = data[addr - start : addr - start + size]
+            i = j
+
+        return result
+
+    def _spans(self, addr, count):
+        ''' split a byte range into (addr, count, width) spans: unaligned head and tail bytes, and aligned words '''
+        spans = []
+        head = min(-addr & 3, count)
+        if head:
+            spans.append((addr, head, 8))
+        words = (count - head) // 4
+        if words:
+            spans.append((addr + head, words, 32))
+        tail = count - head - words * 4
+        if tail:
+            spans.append((addr + count - tail, tail, 8))
+        return spans
+
+    def read_mem_U16(self, addr, count):
+        data = self.read_mem_U8(addr, count * 2)
+        return list(memoryview(data).cast('H'))
+
+    def read_mem_U32(self, addr, count):
+        data = self.read_mem_U8(addr, count * 4)
+        return list(memoryview(data).cast('I'))     # MCU and PC both little-endian
+
+    def write_mem_U32(self, addr, data):
+        self.write_mem_U8(addr, struct.pack('<%dI' % len(data), *data))
+
+    def read_U32(self, addr):
+        return self.read_mem_U32(addr, 1)[0]
+
+    def write_U8(self, addr, val):
+        self.write_mem_U8(addr, bytes([val]))
+
+    def write_U16(self, addr, val):
+        self.write_mem_U8(addr, val.to_bytes(2, 'little'))
+
+    def write_U32(self, addr, val):
+        self.write_mem_U32(addr, [val])
+
+    def read_reg(self, reg):
+        raise NotImplementedError
+
+    def read_regs(self, rlist):
+        return {reg: self.read_reg(reg) for reg in rlist}
+
+    def write_reg(self, reg, val):
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+    def halt(self):
+        raise NotImplementedError
+
+    def step(self):
+        raise NotImplementedError
+
+    def go(self):
+        raise NotImplementedError
+
+    def halted(self):
+        raise NotImplementedError
+
+    # only for backends with HW_BREAK; watchpoint type: 'r', 'w' or 'rw'
+    def set_breakpoint(self, addr):
+        raise NotImplementedError
+
+    def remove_breakpoint(self, addr):
+        raise NotImplementedError
+
+    def set_watchpoint(self, addr, size, type):
+        raise NotImplementedError
+
+    def remove_watchpoint(self, addr, size, type):
+        raise NotImplementedError
+
+    # target description for the GDB bridge, None if the backend can't provide one
+    def target_description(self):
+        ''' return (target.xml, [(register name, bitsize)] in GDB register number order) '''
+        return None
+
+    # GDB features of a Cortex-M, made of the core_regs names the backend has; each feature lists
+    # (name, type) candidates, and a feature is used if all registers of one of its candidates are present
+    M_PROFILE_FEATURES = [
+        ('org.gnu.gdb.arm.m-profile', [[(f'r{i}', 'int') for i in range(13)] + [('sp', 'data_ptr'), ('lr', 'int'), ('pc', 'code_ptr'), ('xpsr', 'int')]]),
+        ('org.gnu.gdb.arm.m-system', [[('msp', 'data_ptr'), ('psp', 'data_ptr'), ('primask', 'int'), ('basepri', 'int'), ('faultmask', 'int'), ('control', 'int')]]),
+        ('org.gnu.gdb.arm.vfp', [[(f'd{i}', 'ieee_double') for i in range(16)] + [('fpscr', 'int')]]),
+        # single precision registers only (J-Link: FPS0..FPS31), not GDB's vfp layout, so GDB shows them as raw registers
+        ('org.rttview.arm.fpu-single', [[(f's{i}', 'ieee_single') for i in range(32)] + [('fpscr', 'int')],
+                                        [(f'fps{i}', 'ieee_single') for i in range(32)] + [('fpscr', 'int')]]),
+    ]
+
+    def arm_target_description(self, bitsizes=None):
+        ''' target_description() of a Cortex-M from core_regs, bitsizes: {name: bitsize} reported by the probe, if any '''
+        if not self.mode.startswith('arm'):
+            return None
+
+        bitsizes = bitsizes or {}
+        root = Element('target')
+        SubElement(root, 'architecture').text = 'arm'
+        regs = []
+        features = []
+        for feature_name, candidates in self.M_PROFILE_FEATURES:
+            if feature_name == 'org.rttview.arm.fpu-single' and 'org.gnu.gdb.arm.vfp' in features:
+                continue    # FPU already described with d registers
+
+            names = next((names for names in candidates if all(name in self.core_regs for name, type in names)), None)
+            if names is None:
+                if feature_name == 'org.gnu.gdb.arm.m-profile':
+                    return None     # core registers missing, leave the default description
+                continue
+
+            features.append(feature_name)
+            feature = SubElement(root, 'feature', name=feature_name)
+            for name, type in names:
+                bitsize = max(bitsizes.get(name, 0), 64 if type == 'ieee_double' else 32)    # narrower ones (primask: 1) are read as words
+                SubElement(feature, 'reg', name=name, bitsize=str(bitsize), type=type)
+                regs.append((name, bitsize))
+
+        return '<?xml version="1.0"?><!DOCTYPE target SYSTEM "gdb-target.dtd">' + tostring(root).decode(), regs
+
+    def memory_map(self):
+        ''' return a pyocd.core.memory_map.MemoryMap of the target '''
+        return None
+
+    # only for backends with NATIVE_RTT
+    def rtt_start(self, addr=None):
+        raise NotImplementedError
+
+    def rtt_stop(self):
+        raise NotImplementedError
+
+    def rtt_get_num_buffers(self, direction):
+        raise NotImplementedError
+
+    def rtt_get_buffers(self, direction):
+        raise NotImplementedError
+
+    def rtt_read(self, index, size):
+        raise NotImplementedError
+
+    def rtt_write(self, index, data):
+        raise NotImplementedError
+
+    # only for backends with HSS
+    def hss_get_caps(self):
+        raise NotImplementedError
+
+    def hss_start(self, blocks, period_us):
+        raise NotImplementedError
+
+    def hss_read(self, size):
+        raise NotImplementedError
+
+    def hss_stop(self):
+        raise NotImplementedError
+
+
+class DAPLink(Backend):
+    ''' Backend adapter for a pyOCD CortexM core accessed through a CMSIS-DAP probe '''
+    caps = Backend.BLOCK_READ | Backend.BATCHED_READ | Backend.NON_HALTING | Backend.REG_LIST | Backend.HW_BREAK
+
+    def __init__(self, core):
+        self.core = core
+        self.core_regs = {}
+
+        # bind pyOCD's methods directly, so calls don't go through an extra frame
+        self.write_U8      = core.write8
+        self.write_U16     = core.write16
+        self.write_U32     = core.write32
+        self.write_mem_U8  = core.write_memory_block8
+        self.write_mem_U32 = core.write_memory_block32
+        self.read_mem_U32  = core.read_memory_block32
+        self.read_U32      = core.read32
+        self.read_many     = core.ap.read_memory_many    # DAP transfers of all ranges pipelined
+        self.halt          = core.halt
+        self.step          = core.step
+        self.go            = core.resume
+        self.halted        = core.is_halted
+
+        # registers are read once per halt, the cache drops them whenever the core's run token changes
+        from pyocd.debug.cache import RegisterCache
+        from pyocd.debug.context import DebugContext
+        self.regcache = RegisterCache(DebugContext(core))
+
+    def open(self, mode, core, speed):
+        self.core.ap.dp.link.open()
+
+    def close(self):
+        self.core.ap.dp.link.close()
+
+    def reset(self):
+        self.core.reset()
+
+    def read_mem_U8(self, addr, count):
+        return bytes(self.core.read_memory_block8(addr, count))
+
+    def read_reg(self, reg):
+        return self.regcache.read_core_registers_raw([reg])[0]
+
+    def read_regs(self, rlist):
+        return dict(zip(rlist, self.regcache.read_core_registers_raw(rlist)))
+
+    def write_reg(self, reg, val):
+        self.regcache.write_core_registers_raw([reg], [val])
+
+    def _debug_units(self):
+        ''' the core is created without ROM table discovery, so add FPB and DWT at their architectural addresses '''
+        if getattr(self.core, 'fpb', None) is None:
+            from pyocd.coresight.fpb import FPB
+            from pyocd.coresight.dwt import DWT
+
+            fpb = FPB(self.core.ap, addr=0xE0002000)
+            fpb.init()
+            self.core.add_child(fpb)    # registers it with the core's BreakpointManager
+
+            dwt = DWT(self.core.ap, addr=0xE0001000)
+            dwt.init()
+            self.core.add_child(dwt)
+
+    def set_breakpoint(self, addr):
+        from pyocd.core.target import Target
+
+        self._debug_units()
+        if not self.core.set_breakpoint(addr, Target.BREAKPOINT_HW):
+            raise Exception(f'no breakpoint available for 0x{addr:08X}')
+
+    def remove_breakpoint(self, addr):
+        self._debug_units()
+        self.core.remove_breakpoint(addr)
+
+    WATCH_TYPE = {'r': 1, 'w': 2, 'rw': 3}  # pyocd.core.target.Target.WATCHPOINT_*
+
+    def set_watchpoint(self, addr, size, type):
+        self._debug_units()
+        if not self.core.set_watchpoint(addr, size, self.WATCH_TYPE[type]):
+            raise Exception(f'no watchpoint available for 0x{addr:08X}')
+
+    def remove_watchpoint(self, addr, size, type):
+        self._debug_units()
+        self.core.remove_watchpoint(addr, size, self.WATCH_TYPE[type])
+
+    def target_description(self):
+        if self.core.target_xml is None:    # core not init()ed, identify it just enough to list its registers
+            self.core._read_core_type()
+            self.core._check_for_fpu()
+            self.core.build_target_xml()
+
+        return self.core.target_xml.decode(), [(reg.name, reg.bitsize) for reg in self.core.register_list]
+
+    def memory_map(self):
+        return self.core.memory_map if self.core.memory_map.region_count else None
+
+
+# name: (module, class), imported on first use so that e.g. keil's win32com is only needed when Keil is used
+BACKENDS = {
+    'jlink':   ('jlink',         'JLink'),
+    'openocd': ('openocd',       'OpenOCD'),
+    'keil':    ('keil',          'Keil'),
+    'agdi':    ('agdi_receiver', 'AGDILink'),
+    'daplink': ('xlink',         'DAPLink'),
+}
+
+def register_backend(name, module, cls):
+    BACKENDS[name] = (module, cls)
+
+def get_backend(name):
+    module, cls = BACKENDS[name]
+    return getattr(importlib.import_module(module), cls)
+
+
+class Arbiter(object):
+    ''' Reentrant lock that grants the probe by priority class, first come first served within a class.
+
+    The owning thread may re-acquire it, so locked XLink methods can call each other, and a caller can
+    hold it across several calls to make them atomic against other threads (see XLink.transaction).
+    '''
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._owner = None
+        self._depth = 0
+        self._waiting = []      # heap of (priority, sequence) of blocked acquirers
+        self._seq = itertools.count()
+
+    def acquire(self, prio):
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+                return
+
+            entry = (prio, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            while self._owner is not None or self._waiting[0] != entry:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+
+            self._owner = me
+            self._depth = 1
+
+    def release(self):
+        with self._cond:
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                self._cond.notify_all()
+
+    def held(self):
+        ''' True if the calling thread holds the arbiter '''
+        return self._owner == threading.get_ident()
 
 
 class XLink(object):
+    # access priority classes, lower value is served first
+    PRIO_RTT    = 0     # RTT drain and variable polling: short accesses that need low latency
+    PRIO_NORMAL = 1
+    PRIO_BULK   = 2     # GDB memory windows and loads: large accesses that need throughput
+
+    BULK_CHUNK = 4096   # large reads release the probe between chunks of this size, so RTT can interleave
+
     def __init__(self, xlk):
         self.xlk = xlk
-        self.lock = threading.Lock()
+        self.arbiter = Arbiter()
+        self.tls = threading.local()    # per-thread access priority
 
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            self.reg_add_alias()
+        # backend is chosen once here, XLink methods call it without further dispatch
+        if isinstance(xlk, Backend):
+            self.backend = xlk
+        else:
+            self.backend = DAPLink(xlk)     # pyOCD CortexM
+
+        self.reg_add_alias()
+
+    @property
+    def caps(self):
+        return self.backend.caps
+
+    def set_priority(self, prio):
+        ''' set the access priority class of the calling thread '''
+        self.tls.prio = prio
+
+    def priority(self):
+        return getattr(self.tls, 'prio', self.PRIO_NORMAL)
+
+    @contextlib.contextmanager
+    def transaction(self, prio=None):
+        ''' hold the probe across several calls, e.g. an RTT read then RdOff write, so no other client interleaves '''
+        self.arbiter.acquire(self.priority() if prio is None else prio)
+        try:
+            yield self
+        finally:
+            self.arbiter.release()
 
     def locked(func):
         def wrapper(self, *args, **kwargs):
-            with self.lock:
+            self.arbiter.acquire(self.priority())
+            try:
                 return func(self, *args, **kwargs)
+            finally:
+                self.arbiter.release()
         return wrapper
 
     @locked
     def open(self, mode, core, speed):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            self.xlk.open(mode, core, speed)
+        self.backend.open(mode, core, speed)
 
-            self.reg_add_alias()
-            
-        else:
-            self.xlk.ap.dp.link.open()
+        self.reg_add_alias()
 
     def reg_add_alias(self):
         def add_alias(regs, name1, name2, name3=None):
@@ -47,178 +450,212 @@ class XLink(object):
                 regs[name1] = regs[name3]
                 regs[name2] = regs[name3]
 
-        self.xlk.core_regs = {k.lower() : v for k, v in self.xlk.core_regs.items()}
+        self.backend.core_regs = {k.lower() : v for k, v in self.backend.core_regs.items()}
 
         if self.mode.startswith('arm'):
-            add_alias(self.xlk.core_regs, 'r13', 'sp', 'r13 (sp)')
-            add_alias(self.xlk.core_regs, 'r14', 'lr', 'r14 (lr)')
-            add_alias(self.xlk.core_regs, 'r15', 'pc', 'r15 (pc)')
+            add_alias(self.backend.core_regs, 'r13', 'sp', 'r13 (sp)')
+            add_alias(self.backend.core_regs, 'r14', 'lr', 'r14 (lr)')
+            add_alias(self.backend.core_regs, 'r15', 'pc', 'r15 (pc)')
 
         elif self.mode.startswith('rv'):
-            add_alias(self.xlk.core_regs, 'x1',  'ra')
-            add_alias(self.xlk.core_regs, 'x2',  'sp')
-            add_alias(self.xlk.core_regs, 'x3',  'gp')
-            add_alias(self.xlk.core_regs, 'x4',  'tp')
-            add_alias(self.xlk.core_regs, 'x5',  't0')
-            add_alias(self.xlk.core_regs, 'x6',  't1')
-            add_alias(self.xlk.core_regs, 'x7',  't2')
-            add_alias(self.xlk.core_regs, 'x8',  's0', 'fp')
-            add_alias(self.xlk.core_regs, 'x9',  's1')
-            add_alias(self.xlk.core_regs, 'x10', 'a0')
-            add_alias(self.xlk.core_regs, 'x11', 'a1')
-            add_alias(self.xlk.core_regs, 'x12', 'a2')
-            add_alias(self.xlk.core_regs, 'x13', 'a3')
-            add_alias(self.xlk.core_regs, 'x14', 'a4')
-            add_alias(self.xlk.core_regs, 'x15', 'a5')
-            add_alias(self.xlk.core_regs, 'x16', 'a6')
-            add_alias(self.xlk.core_regs, 'x17', 'a7')
-            add_alias(self.xlk.core_regs, 'x18', 's2')
-            add_alias(self.xlk.core_regs, 'x19', 's3')
-            add_alias(self.xlk.core_regs, 'x20', 's4')
-            add_alias(self.xlk.core_regs, 'x21', 's5')
-            add_alias(self.xlk.core_regs, 'x22', 's6')
-            add_alias(self.xlk.core_regs, 'x23', 's7')
-            add_alias(self.xlk.core_regs, 'x24', 's8')
-            add_alias(self.xlk.core_regs, 'x25', 's9')
-            add_alias(self.xlk.core_regs, 'x26', 's10')
-            add_alias(self.xlk.core_regs, 'x27', 's11')
-            add_alias(self.xlk.core_regs, 'x28', 't3')
-            add_alias(self.xlk.core_regs, 'x29', 't4')
-            add_alias(self.xlk.core_regs, 'x30', 't5')
-            add_alias(self.xlk.core_regs, 'x31', 't6')
+            add_alias(self.backend.core_regs, 'x1',  'ra')
+            add_alias(self.backend.core_regs, 'x2',  'sp')
+            add_alias(self.backend.core_regs, 'x3',  'gp')
+            add_alias(self.backend.core_regs, 'x4',  'tp')
+            add_alias(self.backend.core_regs, 'x5',  't0')
+            add_alias(self.backend.core_regs, 'x6',  't1')
+            add_alias(self.backend.core_regs, 'x7',  't2')
+            add_alias(self.backend.core_regs, 'x8',  's0', 'fp')
+            add_alias(self.backend.core_regs, 'x9',  's1')
+            add_alias(self.backend.core_regs, 'x10', 'a0')
+            add_alias(self.backend.core_regs, 'x11', 'a1')
+            add_alias(self.backend.core_regs, 'x12', 'a2')
+            add_alias(self.backend.core_regs, 'x13', 'a3')
+            add_alias(self.backend.core_regs, 'x14', 'a4')
+            add_alias(self.backend.core_regs, 'x15', 'a5')
+            add_alias(self.backend.core_regs, 'x16', 'a6')
+            add_alias(self.backend.core_regs, 'x17', 'a7')
+            add_alias(self.backend.core_regs, 'x18', 's2')
+            add_alias(self.backend.core_regs, 'x19', 's3')
+            add_alias(self.backend.core_regs, 'x20', 's4')
+            add_alias(self.backend.core_regs, 'x21', 's5')
+            add_alias(self.backend.core_regs, 'x22', 's6')
+            add_alias(self.backend.core_regs, 'x23', 's7')
+            add_alias(self.backend.core_regs, 'x24', 's8')
+            add_alias(self.backend.core_regs, 'x25', 's9')
+            add_alias(self.backend.core_regs, 'x26', 's10')
+            add_alias(self.backend.core_regs, 'x27', 's11')
+            add_alias(self.backend.core_regs, 'x28', 't3')
+            add_alias(self.backend.core_regs, 'x29', 't4')
+            add_alias(self.backend.core_regs, 'x30', 't5')
+            add_alias(self.backend.core_regs, 'x31', 't6')
 
     @property
     def mode(self):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            return self.xlk.mode
-        else:
-            return 'arm'
+        return self.backend.mode
     
     @locked
     def write_U8(self, addr, val):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            self.xlk.write_U8(addr, val)
-        else:
-            self.xlk.write8(addr, val)
+        self.backend.write_U8(addr, val)
 
     @locked
     def write_U16(self, addr, val):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            self.xlk.write_U16(addr, val)
-        else:
-            self.xlk.write16(addr, val)
+        self.backend.write_U16(addr, val)
 
     @locked
     def write_U32(self, addr, val):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            self.xlk.write_U32(addr, val)
-        else:
-            self.xlk.write32(addr, val)
+        self.backend.write_U32(addr, val)
 
     @locked
     def write_mem_U8(self, addr, data):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            self.xlk.write_mem_U8(addr, data)
-        else:
-            self.xlk.write_memory_block8(addr, data)
+        self.backend.write_mem_U8(addr, data)
 
     @locked
     def write_mem_U32(self, addr, data):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            self.xlk.write_mem_U32(addr, data)
-        else:
-            self.xlk.write_memory_block32(addr, data)
+        self.backend.write_mem_U32(addr, data)
 
     @locked
     def write_mem(self, addr, data):
         return self.write_mem_U8(addr, data)
 
-    @locked
     def read_mem_U8(self, addr, count):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            return self.xlk.read_mem_U8(addr, count)
-        else:
-            return self.xlk.read_memory_block8(addr, count)
+        if count <= self.BULK_CHUNK or self.arbiter.held():
+            return self._read_mem_U8(addr, count)
+
+        data = bytearray()
+        for offset in range(0, count, self.BULK_CHUNK):
+            data.extend(self._read_mem_U8(addr + offset, min(self.BULK_CHUNK, count - offset)))
+        return data
+
+    @locked
+    def _read_mem_U8(self, addr, count):
+        return self.backend.read_mem_U8(addr, count)
+
+    @locked
+    def read_many(self, ranges):
+        ''' read several (addr, size) ranges in one go, return a read-only memoryview of each one's bytes
+
+        Backends with BATCHED_READ fetch all of them in one round trip, others merge nearby ranges.
+        '''
+        return self.backend.read_many(ranges)
 
     @locked
     def read_mem_U16(self, addr, count):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            return self.xlk.read_mem_U16(addr, count)
-        else:
-            return [self.xlk.read16(addr+i*2) for i in range(count)]
+        return self.backend.read_mem_U16(addr, count)
 
     @locked
     def read_mem_U32(self, addr, count):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            return self.xlk.read_mem_U32(addr, count)
-        else:
-            return self.xlk.read_memory_block32(addr, count)
+        return self.backend.read_mem_U32(addr, count)
 
     @locked
     def read_U32(self, addr):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            return self.xlk.read_U32(addr)
-        else:
-            return self.xlk.read32(addr)
+        return self.backend.read_U32(addr)
 
     @locked
     def read_reg(self, reg):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            return self.xlk.read_reg(reg.lower())
-        else:
-            return self.xlk.read_core_register_raw(reg)
+        return self.backend.read_reg(reg.lower())
 
     @locked
     def read_regs(self, rlist):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            return dict(zip(rlist, self.xlk.read_regs([reg.lower() for reg in rlist]).values()))
-        else:
-            return dict(zip(rlist, self.xlk.read_core_registers_raw(rlist)))
+        # backends key their result by the name they were given, which may repeat or alias after lower()
+        vals = self.backend.read_regs(list(dict.fromkeys(reg.lower() for reg in rlist)))
+        return {reg: vals[reg.lower()] for reg in rlist}
 
     @locked
     def write_reg(self, reg, val):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            self.xlk.write_reg(reg.lower(), val)
-        else:
-            self.xlk.write_core_register_raw(reg, val)
+        self.backend.write_reg(reg.lower(), val)
 
     @locked
     def reset(self):
-        self.xlk.reset()
+        self.backend.reset()
 
         if self.mode.startswith('rv'):
-            self.xlk.write_reg('pc', 0)     # OpenOCD: resume from current code position.
-            self.xlk.write_reg('dpc', 0)    # When resuming, PC is updated to value in dpc.
+            self.backend.write_reg('pc', 0)     # OpenOCD: resume from current code position.
+            self.backend.write_reg('dpc', 0)    # When resuming, PC is updated to value in dpc.
             self.go()
     
     @locked
     def halt(self):
-        self.xlk.halt()
+        self.backend.halt()
 
     @locked
     def step(self):
-        self.xlk.step()
+        self.backend.step()
 
     @locked
     def go(self):
-        if isinstance(self.xlk, (jlink.JLink, keil.Keil, agdi_receiver.AGDILink)):
-            self.xlk.go()
-        else:
-            self.xlk.resume()
+        self.backend.go()
 
     @locked
     def halted(self):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            return self.xlk.halted()
-        else:
-            return self.xlk.is_halted()
+        return self.backend.halted()
 
     @locked
     def close(self):
-        if isinstance(self.xlk, (jlink.JLink, openocd.OpenOCD, keil.Keil, agdi_receiver.AGDILink)):
-            self.xlk.close()
-        else:
-            self.xlk.ap.dp.link.close()
+        self.backend.close()
+
+    @locked
+    def set_breakpoint(self, addr):
+        self.backend.set_breakpoint(addr)
+
+    @locked
+    def remove_breakpoint(self, addr):
+        self.backend.remove_breakpoint(addr)
+
+    @locked
+    def set_watchpoint(self, addr, size, type):
+        self.backend.set_watchpoint(addr, size, type)
+
+    @locked
+    def remove_watchpoint(self, addr, size, type):
+        self.backend.remove_watchpoint(addr, size, type)
+
+    @locked
+    def target_description(self):
+        return self.backend.target_description()
+
+    def memory_map(self):
+        return self.backend.memory_map()
+
+    @locked
+    def rtt_start(self, addr=None):
+        self.backend.rtt_start(addr)
+
+    @locked
+    def rtt_stop(self):
+        self.backend.rtt_stop()
+
+    @locked
+    def rtt_get_num_buffers(self, direction):
+        return self.backend.rtt_get_num_buffers(direction)
+
+    @locked
+    def rtt_get_buffers(self, direction):
+        return self.backend.rtt_get_buffers(direction)
+
+    @locked
+    def rtt_read(self, index, size):
+        return self.backend.rtt_read(index, size)
+
+    @locked
+    def rtt_write(self, index, data):
+        return self.backend.rtt_write(index, data)
+
+    @locked
+    def hss_get_caps(self):
+        return self.backend.hss_get_caps()
+
+    @locked
+    def hss_start(self, blocks, period_us):
+        self.backend.hss_start(blocks, period_us)
+
+    @locked
+    def hss_read(self, size):
+        return self.backend.hss_read(size)
+
+    @locked
+    def hss_stop(self):
+        self.backend.hss_stop()
 
     CORE_TYPE_NAME = {
         0xC20: "Cortex-M0",
@@ -291,20 +728,15 @@ class XLink(object):
 
     @locked
     def reset_and_halt(self):
-        if isinstance(self.xlk, openocd.OpenOCD):
-            self.xlk.reset(halt=True)
-
-        elif isinstance(self.xlk, (jlink.JLink, keil.Keil, agdi_receiver.AGDILink)):
-            if self.mode.startswith('rv'):
-                self.xlk.reset()
+        if self.caps & Backend.RESET_HALT:
+            self.backend.reset(halt=True)
 
-            else:   # arm
-                self.resetStopOnReset()
-                self.write_reg('xpsr', 0x1000000)   # set thumb bit in case the reset handler points to an ARM address
+        elif self.mode.startswith('rv'):
+            self.backend.reset()
 
-        else:       # daplink only support arm
+        else:   # arm
             self.resetStopOnReset()
-            self.write_reg('xpsr', 0x1000000)
+            self.write_reg('xpsr', 0x1000000)   # set thumb bit in case the reset handler points to an ARM address
 
 
     #####################################################################